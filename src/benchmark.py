@@ -0,0 +1,464 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""
+Offline benchmark and load test.
+
+Runs entirely in-process and without network access: products are
+embedded with the deterministic hash embedder, the registrar and the
+proxy are stubbed with an httpx mock transport (with configurable
+latency) and HTTP requests are served through an ASGI transport.
+
+Scenarios:
+- ingest: a synthetic catalog streamed from the stub registrar and
+  loaded through RegistrarLoader (products/second)
+- search: SearchDb.asearch under increasing concurrency
+- search_artifacts: search plus artifact enrichment from the stub proxy
+- middleware: the same trivial endpoint with and without LoggingMiddleware
+- quantization: memory per product, recall@k against the exact index and
+  query latency of each vector compression of the NumPy engine
+
+Latencies are reported as p50/p95/p99 (milliseconds) with the
+achieved QPS, and written as JSON so that results from two commits
+can be compared (--compare).
+"""
+
+import asyncio
+import json
+import logging
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from typing import Awaitable, Callable, List, Optional
+
+import httpx
+from fastapi import FastAPI
+
+import constants
+import httpclient
+import middleware
+from loader import RegistrarLoader
+from middleware import LoggingMiddleware
+from searchdb import SearchDb
+from sync import SyncEngine
+from vectorstore import NumpyCollection, ENGINE_CHROMA, ENGINE_NUMPY, QUANTIZATIONS
+
+logger = logging.getLogger(__name__)
+
+RESULTS_VERSION = 1
+
+REGISTRAR_HOST = "registrar.bench"
+PROXY_HOST = "proxy.bench"
+STUB_PORT = 80
+REGISTRAR_SERVICE = "/api/registrar/products"
+
+# Prefixes of metrics where a higher value is better (all others are latencies)
+HIGHER_IS_BETTER = ("qps", "products_per_second", "recall_at_")
+
+VOCABULARY = [
+    "carbon", "emissions", "scope", "climate", "risk", "physical", "transition",
+    "temperature", "flood", "drought", "wildfire", "heat", "sea", "level", "energy",
+    "renewable", "solar", "wind", "hydro", "coal", "gas", "oil", "utility", "grid",
+    "portfolio", "alignment", "pathway", "net", "zero", "target", "disclosure",
+    "sovereign", "corporate", "bond", "equity", "loan", "asset", "exposure", "sector",
+    "region", "country", "annual", "quarterly", "forecast", "scenario", "model",
+    "dataset", "inventory", "intensity", "revenue", "capex", "facility", "location",
+    "water", "stress", "biodiversity", "land", "forest", "agriculture", "methane"
+]
+NAMESPACES = ["brodagroup.com", "osc.org", "finos.org", "example.com"]
+
+
+#####
+# SYNTHETIC DATA
+#####
+
+def generate_catalog(count: int, seed: int = 0) -> List[dict]:
+    """
+    Generate a reproducible catalog of data products
+    """
+    generator = random.Random(seed)
+    products = []
+    for index in range(count):
+        words = generator.sample(VOCABULARY, 3)
+        products.append({
+            "uuid": f"00000000-0000-4000-8000-{index:012d}",
+            "name": "-".join(words),
+            "description": " ".join(generator.choices(VOCABULARY, k=generator.randint(12, 40))),
+            "namespace": generator.choice(NAMESPACES),
+            "tags": generator.sample(VOCABULARY, 2)
+        })
+    return products
+
+
+def generate_queries(count: int, seed: int = 1) -> List[str]:
+    """
+    Generate a reproducible mix of short and long queries
+    """
+    generator = random.Random(seed)
+    return [" ".join(generator.sample(VOCABULARY, generator.randint(1, 6))) for _ in range(count)]
+
+
+#####
+# STATISTICS
+#####
+
+def percentile(ordered: List[float], fraction: float) -> float:
+    """
+    Get a percentile (nearest rank) of sorted values
+    """
+    if not ordered:
+        return 0.0
+    # Rounded first so that e.g. 0.95 * 100 is not taken as 95.00000000000001
+    rank = max(0, min(len(ordered) - 1, math.ceil(round(fraction * len(ordered), 9)) - 1))
+    return ordered[rank]
+
+
+def summarize(latencies: List[float], elapsed: float, errors: int = 0) -> dict:
+    """
+    Summarize request latencies (seconds) measured over an elapsed time
+    """
+    ordered = sorted(latencies)
+    milliseconds = lambda value: round(value * 1000.0, 3)
+    return {
+        "requests": len(ordered),
+        "errors": errors,
+        "qps": round(len(ordered) / elapsed, 2) if elapsed > 0 else 0.0,
+        "mean_ms": milliseconds(sum(ordered) / len(ordered)) if ordered else 0.0,
+        "p50_ms": milliseconds(percentile(ordered, 0.50)),
+        "p95_ms": milliseconds(percentile(ordered, 0.95)),
+        "p99_ms": milliseconds(percentile(ordered, 0.99)),
+        "max_ms": milliseconds(ordered[-1]) if ordered else 0.0
+    }
+
+
+async def run_load(call: Callable[[str], Awaitable], items: List[str], concurrency: int) -> dict:
+    """
+    Issue calls for every item with a fixed number in flight
+    """
+    latencies = []
+    errors = 0
+    iterator = iter(items)
+
+    async def worker():
+        nonlocal errors
+        for item in iterator:
+            start = time.perf_counter()
+            try:
+                await call(item)
+            except Exception as e:
+                errors += 1
+                logger.debug(f"Benchmark call failed, exception:{e}")
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(max(1, concurrency))])
+    return summarize(latencies, time.perf_counter() - start, errors)
+
+
+#####
+# STUB SERVICES
+#####
+
+class StubServices():
+    """
+    Registrar and proxy served by an httpx mock transport
+    """
+
+    def __init__(self, catalog: List[dict], proxy_latency_seconds: float = 0.0, artifacts: int = 2):
+        self.body = json.dumps(catalog).encode("utf-8")
+        self.proxy_latency_seconds = proxy_latency_seconds
+        self.artifacts = artifacts
+
+    def transport(self) -> httpx.MockTransport:
+        return httpx.MockTransport(self.handle)
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        if request.url.host == REGISTRAR_HOST:
+            return httpx.Response(200, content=self.body, headers={"Content-Type": "application/json"})
+        if request.url.host == PROXY_HOST:
+            if self.proxy_latency_seconds > 0:
+                await asyncio.sleep(self.proxy_latency_seconds)
+            _uuid = request.url.path.split("/")[-2]
+            return httpx.Response(200, json=[{"uuid": f"{_uuid}-{index}", "name": f"artifact-{index}"}
+                                             for index in range(self.artifacts)])
+        return httpx.Response(404)
+
+
+#####
+# SCENARIOS
+#####
+
+def create_db(args) -> SearchDb:
+    registrar = {
+        "host": REGISTRAR_HOST,
+        "port": STUB_PORT,
+        "service": REGISTRAR_SERVICE,
+        "batch_size": args.batch_size
+    }
+    proxy = {"host": PROXY_HOST, "port": STUB_PORT, "concurrency": args.proxy_concurrency,
+             "artifact_cache": {"enabled": args.artifact_cache}}
+    # Unique name: the in-memory chromadb client is shared by the process
+    return SearchDb(None, f"bench-{os.getpid()}-{time.time_ns()}", False, registrar,
+                    batch_size=args.batch_size,
+                    embedding={"backend": "hash", "dimensions": args.dimensions},
+                    query_workers=args.query_workers,
+                    query_queue_depth=max(args.concurrency) * 4,
+                    proxy=proxy,
+                    result_cache={"enabled": args.result_cache},
+                    retrieval={"mode": args.mode},
+                    engine=args.engine,
+                    numpy={"quantization": args.quantization})
+
+
+async def bench_ingest(db: SearchDb, args) -> dict:
+    loader = RegistrarLoader(SyncEngine(db), db.registrar)
+    start = time.perf_counter()
+    stats = await loader.load()
+    elapsed = time.perf_counter() - start
+    return {
+        "products": stats["consumed"],
+        "seconds": round(elapsed, 3),
+        "products_per_second": round(stats["consumed"] / elapsed, 2) if elapsed > 0 else 0.0
+    }
+
+
+async def bench_queries(call: Callable[[str], Awaitable], queries: List[str], levels: List[int]) -> dict:
+    # Warm up (thread pools, caches of the engine) before measuring
+    await run_load(call, queries[:min(len(queries), 10)], 1)
+    return {str(level): await run_load(call, queries, level) for level in levels}
+
+
+def _ping_app(with_middleware: bool) -> FastAPI:
+    app = FastAPI()
+    if with_middleware:
+        app.add_middleware(LoggingMiddleware)
+
+    @app.get("/ping")
+    async def ping():
+        return {"status": "ok"}
+
+    return app
+
+
+async def bench_middleware(args) -> dict:
+    middleware.configure({"sample_rate": args.log_sample_rate, "queue": False})
+    # Clients normally send these, otherwise every request logs a warning
+    headers = {constants.HEADER_USERNAME: constants.USERNAME, constants.HEADER_CORRELATION_ID: "benchmark"}
+    results = {}
+    for label, with_middleware in (("without", False), ("with", True)):
+        transport = httpx.ASGITransport(app=_ping_app(with_middleware))
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", headers=headers) as client:
+            async def call(_):
+                response = await client.get("/ping")
+                response.raise_for_status()
+            results[label] = await bench_queries(call, [""] * args.requests, args.concurrency)
+    results["overhead_p50_ms"] = {
+        level: round(results["with"][level]["p50_ms"] - results["without"][level]["p50_ms"], 3)
+        for level in results["with"]
+    }
+    return results
+
+
+def bench_quantization(db: SearchDb, queries: List[str], args) -> dict:
+    contents = db.export()
+    embeddings = db.embeddings(queries)
+    results = {}
+    for quantization in QUANTIZATIONS:
+        collection = NumpyCollection("quantization", quantization=quantization)
+        collection.upsert(ids=contents["ids"], embeddings=contents["embeddings"])
+        # The first query trains product quantization
+        collection.query(query_embeddings=embeddings[:1], n_results=args.n_results)
+        latencies = []
+        start = time.perf_counter()
+        for embedding in embeddings:
+            begin = time.perf_counter()
+            collection.query(query_embeddings=[embedding], n_results=args.n_results, include=[])
+            latencies.append(time.perf_counter() - begin)
+        stats = collection.stats()
+        results[quantization] = {
+            "bytes_per_product": stats["bytes_per_product"],
+            "full_bytes_per_product": stats["full_bytes_per_product"],
+            f"recall_at_{args.n_results}": round(collection.recall(k=args.n_results, queries=embeddings), 4),
+            **summarize(latencies, time.perf_counter() - start)
+        }
+    return results
+
+
+async def run(args) -> dict:
+    catalog = generate_catalog(args.products, seed=args.seed)
+    queries = generate_queries(args.queries, seed=args.seed + 1)
+    stubs = StubServices(catalog, proxy_latency_seconds=args.proxy_latency_ms / 1000.0)
+    httpclient.configure({"retries": 0}, transport=stubs.transport())
+    del catalog
+
+    scenarios = args.scenarios
+    results = {}
+    db = create_db(args)
+    try:
+        logger.info(f"Ingesting products:{args.products} engine:{args.engine}")
+        results["ingest"] = await bench_ingest(db, args)
+        if "search" in scenarios:
+            logger.info("Benchmarking search")
+            results["search"] = await bench_queries(
+                lambda query: db.asearch(query, n_results=args.n_results), queries, args.concurrency)
+        if "search_artifacts" in scenarios:
+            logger.info("Benchmarking search_artifacts")
+            results["search_artifacts"] = await bench_queries(
+                lambda query: db.search_artifacts(query, n_results=args.n_results), queries, args.concurrency)
+        if "middleware" in scenarios:
+            logger.info("Benchmarking middleware")
+            results["middleware"] = await bench_middleware(args)
+        if "quantization" in scenarios:
+            logger.info("Benchmarking quantization")
+            results["quantization"] = await asyncio.to_thread(bench_quantization, db, queries, args)
+    finally:
+        db.query_pool.shutdown()
+        await httpclient.get_manager().close()
+    return results
+
+
+#####
+# RESULTS
+#####
+
+def environment() -> dict:
+    """
+    Describe where the results were produced
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                                text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "timestamp": time.time()
+    }
+
+
+def flatten(results: dict, prefix: str = "") -> dict:
+    """
+    Flatten nested results into "scenario.level.metric" keys
+    """
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}.{key}" if prefix else str(key)
+        if isinstance(value, dict):
+            flat.update(flatten(value, name))
+        elif isinstance(value, (int, float)):
+            flat[name] = value
+    return flat
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> List[dict]:
+    """
+    Find metrics that are worse than the baseline by more than the
+    threshold (a fraction, e.g. 0.1 for 10%)
+    """
+    before = flatten(baseline["results"])
+    after = flatten(current["results"])
+    regressions = []
+    for name, old in before.items():
+        new = after.get(name)
+        metric = name.rsplit(".", 1)[-1]
+        if new is None or old <= 0 or not (metric.endswith("_ms") or metric.startswith(HIGHER_IS_BETTER)):
+            continue
+        # Maximums and overheads (a difference) are too noisy to compare as ratios
+        if metric == "max_ms" or ".overhead_" in name:
+            continue
+        change = (new - old) / old
+        worse = -change if metric.startswith(HIGHER_IS_BETTER) else change
+        if worse > threshold:
+            regressions.append({"metric": name, "baseline": old, "current": new,
+                                "change": round(change, 4)})
+    return regressions
+
+
+def _levels(value: str) -> List[int]:
+    return [int(level) for level in value.split(",") if level.strip()]
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run the offline search benchmark.")
+    parser.add_argument("--products", type=int, default=1000, help="Catalog size (default: 1000)")
+    parser.add_argument("--queries", type=int, default=500, help="Queries per concurrency level (default: 500)")
+    parser.add_argument("--requests", type=int, default=2000, help="Middleware requests per level (default: 2000)")
+    parser.add_argument("--concurrency", type=_levels, default=[1, 8, 32], help="Concurrency levels (default: 1,8,32)")
+    parser.add_argument("--scenarios", type=lambda value: value.split(","),
+                        default=["search", "search_artifacts", "middleware", "quantization"],
+                        help="Scenarios after ingest (default: search,search_artifacts,middleware,quantization)")
+    parser.add_argument("--engine", choices=[ENGINE_CHROMA, ENGINE_NUMPY], default=ENGINE_CHROMA)
+    parser.add_argument("--quantization", choices=QUANTIZATIONS, default="none",
+                        help="Vector compression of the numpy engine (default: none)")
+    parser.add_argument("--mode", default="vector", help="Retrieval mode (default: vector)")
+    parser.add_argument("--n-results", type=int, default=10)
+    parser.add_argument("--dimensions", type=int, default=384, help="Hash embedding dimensions (default: 384)")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--query-workers", type=int, default=8)
+    parser.add_argument("--result-cache", action="store_true", help="Enable the query result cache")
+    parser.add_argument("--artifact-cache", action="store_true", help="Enable the artifact cache")
+    parser.add_argument("--proxy-latency-ms", type=float, default=5.0, help="Stub proxy latency (default: 5)")
+    parser.add_argument("--proxy-concurrency", type=int, default=8)
+    parser.add_argument("--log-sample-rate", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--compare", help="Baseline results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="Regression threshold as a fraction (default: 0.10)")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(module)s %(levelname)s - %(message)s")
+    # Per-request logging would dominate the measurements
+    for name in ("searchdb", "utilities", "httpclient", "httpx", "sync", "loader", "workerpool", "middleware"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    report = {
+        "version": RESULTS_VERSION,
+        "environment": environment(),
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "results": asyncio.run(run(args))
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        directory = os.path.dirname(args.output)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(args.output, "w") as file:
+            file.write(text)
+        logger.info(f"Wrote results to {args.output}")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare, "r") as file:
+            baseline = json.load(file)
+        if baseline.get("parameters") != report["parameters"]:
+            logger.warning(f"Baseline {args.compare} was run with different parameters:{baseline.get('parameters')}")
+        regressions = compare(baseline, report, args.threshold)
+        for regression in regressions:
+            logger.warning(f"Regression {regression['metric']}: {regression['baseline']} -> "
+                           f"{regression['current']} ({regression['change']:+.1%})")
+        if regressions:
+            return 1
+        logger.info(f"No regressions over {args.threshold:.0%} against {args.compare}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -17,3 +17,13 @@ class BgsNotFoundException(BgsException):
     def __init__(self, message, original_exception=None):
         super().__init__(message)
         self.original_exception = original_exception
+
+class BgsBusyException(BgsException):
+    """
+    Resource is at capacity, the request should be retried later
+    """
+    def __init__(self, message, retry_after=1, status_code=503, original_exception=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.status_code = status_code
+        self.original_exception = original_exception
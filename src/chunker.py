@@ -0,0 +1,99 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""
+Chunking of long descriptions.
+
+A long description is split into overlapping windows of words, each
+stored (and embedded) as its own document with the id "<uuid>#<n>"
+and the product uuid as its parent.  Embedding models truncate long
+inputs and average the meaning of everything they are given, so
+smaller chunks match specific passages more precisely.  At query
+time chunk hits are aggregated back into one hit per product.
+"""
+
+from typing import Dict, List
+
+AGGREGATE_MAX = "max"
+AGGREGATE_SUM = "sum"
+AGGREGATES = (AGGREGATE_MAX, AGGREGATE_SUM)
+
+DEFAULT_CONFIG = {
+    "enabled": False,
+    # Words per chunk, and words shared by consecutive chunks
+    "size": 200,
+    "overlap": 40,
+    # Product score from its chunk scores: max (best passage) or sum
+    "aggregate": AGGREGATE_MAX,
+    # Chunks retrieved per requested result, since several chunks
+    # of one product can occupy the top ranks
+    "oversample": 4
+}
+
+CHUNK_SEPARATOR = "#"
+
+
+def configure(conf: dict = None) -> dict:
+    """
+    Get the chunking settings from the "chunking" section of
+    the database configuration
+
+    :raises ValueError: if the settings are inconsistent
+    """
+    conf = {**DEFAULT_CONFIG, **(conf or {})}
+    if conf["aggregate"] not in AGGREGATES:
+        raise ValueError(f"Unknown chunk aggregate:{conf['aggregate']}")
+    if int(conf["size"]) < 1 or not 0 <= int(conf["overlap"]) < int(conf["size"]):
+        raise ValueError(f"Invalid chunk size:{conf['size']} overlap:{conf['overlap']}")
+    return conf
+
+
+def chunk_text(text: str, size: int, overlap: int) -> List[str]:
+    """
+    Split text into windows of "size" words, consecutive windows
+    sharing "overlap" words; short text is a single chunk
+    """
+    words = (text or "").split()
+    if len(words) <= size:
+        return [text or ""]
+    step = size - overlap
+    chunks = []
+    for start in range(0, len(words), step):
+        chunks.append(" ".join(words[start:start + size]))
+        if start + size >= len(words):
+            break
+    return chunks
+
+
+def chunk_id(parent: str, index: int) -> str:
+    return f"{parent}{CHUNK_SEPARATOR}{index}"
+
+
+def aggregate(hits: List[dict], method: str = AGGREGATE_MAX) -> List[dict]:
+    """
+    Combine chunk hits into one hit per product, best first.
+
+    Each product keeps its best-scoring chunk (the passage that
+    matched) with its id replaced by the product id and its score
+    replaced by the aggregate score.
+
+    :param hits: hits with id, metadata (with "id" of the product) and score
+    :param method: AGGREGATE_MAX or AGGREGATE_SUM
+    """
+    best: Dict[str, dict] = {}
+    totals: Dict[str, float] = {}
+    for hit in hits:
+        parent = (hit.get("metadata") or {}).get("id", hit["id"])
+        totals[parent] = totals.get(parent, 0.0) + hit["score"]
+        if parent not in best or hit["score"] > best[parent]["score"]:
+            best[parent] = hit
+    products = []
+    for parent, hit in best.items():
+        score = totals[parent] if method == AGGREGATE_SUM else hit["score"]
+        products.append({**hit, "id": parent, "score": score})
+    # Stable for equal scores (keeps the order of the best chunks)
+    products.sort(key=lambda product: -product["score"])
+    return products
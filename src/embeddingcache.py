@@ -0,0 +1,144 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+import array
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_ENTRIES = 10000
+
+# SQLite limits the number of host parameters in a statement
+_SQLITE_CHUNK = 500
+
+
+class CachedEmbeddingFunction(EmbeddingFunction[Documents]):
+    """
+    Cache embeddings by (model name, text hash).
+
+    Embeddings are kept in a bounded in-memory LRU and, if a path
+    is given, in a SQLite store so they survive restarts.  Both hold
+    float32 vectors (4 bytes per dimension, rather than a Python float
+    object per dimension), converted to lists on the way out.  Only
+    texts missing from both tiers are passed (in a single call) to the
+    wrapped embedding function.
+    """
+
+    def __init__(self, embeddings: EmbeddingFunction, model_name: str,
+                 max_entries: int = DEFAULT_MAX_ENTRIES, path: Optional[str] = None):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.max_entries = max(0, int(max_entries))
+        self.memory: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.connection = None
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT NOT NULL, hash TEXT NOT NULL, vector BLOB NOT NULL, "
+                "PRIMARY KEY (model, hash))")
+            self.connection.commit()
+            logger.info(f"Using embedding cache path:{path}")
+
+    def __call__(self, input: Documents) -> Embeddings:
+        keys = [_text_hash(text) for text in input]
+        found: Dict[str, array.array] = {}
+
+        with self.lock:
+            for key in keys:
+                if key in found:
+                    continue
+                vector = self.memory.get(key)
+                if vector is not None:
+                    self.memory.move_to_end(key)
+                    found[key] = vector
+                    self.memory_hits += 1
+
+            missing = [key for key in dict.fromkeys(keys) if key not in found]
+            if missing and self.connection is not None:
+                for key, vector in self._disk_get(missing).items():
+                    found[key] = vector
+                    self._memory_put(key, vector)
+                    self.disk_hits += 1
+
+        texts = {}
+        for key, text in zip(keys, input):
+            if key not in found:
+                texts.setdefault(key, text)
+
+        if texts:
+            vectors = self.embeddings(list(texts.values()))
+            computed = {key: array.array("f", vector) for key, vector in zip(texts.keys(), vectors)}
+            with self.lock:
+                self.misses += len(computed)
+                for key, vector in computed.items():
+                    self._memory_put(key, vector)
+                if self.connection is not None:
+                    self._disk_put(computed)
+            found.update(computed)
+
+        return [found[key].tolist() for key in keys]
+
+    def stats(self) -> dict:
+        """
+        Get cache hit/miss counters
+        """
+        with self.lock:
+            return {
+                "model_name": self.model_name,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "memory_entries": len(self.memory)
+            }
+
+    def _memory_put(self, key: str, vector: array.array):
+        if self.max_entries == 0:
+            return
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def _disk_get(self, keys: List[str]) -> Dict[str, array.array]:
+        results = {}
+        for start in range(0, len(keys), _SQLITE_CHUNK):
+            chunk = keys[start:start + _SQLITE_CHUNK]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.connection.execute(
+                f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({placeholders})",
+                [self.model_name] + chunk)
+            for key, blob in rows:
+                results[key] = array.array("f", blob)
+        return results
+
+    def _disk_put(self, vectors: Dict[str, array.array]):
+        rows = [(self.model_name, key, vector.tobytes())
+                for key, vector in vectors.items()]
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO embeddings (model, hash, vector) VALUES (?, ?, ?)", rows)
+        self.connection.commit()
+
+
+def _text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
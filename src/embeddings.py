@@ -0,0 +1,133 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+import hashlib
+import math
+import os
+import re
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import chromadb.utils.embedding_functions as embedding_functions
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+
+from bgsexception import BgsException
+from embeddingcache import CachedEmbeddingFunction, DEFAULT_MAX_ENTRIES
+
+logger = logging.getLogger(__name__)
+
+BACKEND_OPENAI = "openai"
+BACKEND_ONNX = "onnx"
+BACKEND_HASH = "hash"
+
+DEFAULT_BACKEND = BACKEND_OPENAI
+DEFAULT_OPENAI_MODEL = "text-embedding-ada-002"
+DEFAULT_HASH_DIMENSIONS = 384
+DEFAULT_BATCH_SIZE = 64
+DEFAULT_WORKERS = 4
+
+_TOKEN_PATTERN = re.compile(r"\w+")
+
+
+class HashingEmbeddingFunction(EmbeddingFunction[Documents]):
+    """
+    Deterministic embedding based upon hashed word features.
+
+    Requires no model and no network, so it is intended for
+    tests and benchmarks rather than semantic quality.
+    """
+
+    def __init__(self, dimensions: int = DEFAULT_HASH_DIMENSIONS):
+        self.dimensions = int(dimensions)
+        self.model_name = f"hash-{self.dimensions}"
+
+    def __call__(self, input: Documents) -> Embeddings:
+        return [self._embed(text) for text in input]
+
+    def _embed(self, text: str) -> list:
+        vector = [0.0] * self.dimensions
+        for token in _TOKEN_PATTERN.findall(text.lower()):
+            digest = hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest()
+            value = int.from_bytes(digest, "little")
+            index = value % self.dimensions
+            sign = 1.0 if (value >> 63) & 1 else -1.0
+            vector[index] += sign
+
+        norm = math.sqrt(sum(v * v for v in vector))
+        if norm > 0:
+            vector = [v / norm for v in vector]
+        return vector
+
+
+class PooledEmbeddingFunction(EmbeddingFunction[Documents]):
+    """
+    Split embedding requests into batches and run the batches
+    concurrently on a pool of worker threads
+    """
+
+    def __init__(self, embeddings: EmbeddingFunction, model_name: str,
+                 batch_size: int = DEFAULT_BATCH_SIZE, workers: int = DEFAULT_WORKERS):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.batch_size = max(1, int(batch_size))
+        self.executor = ThreadPoolExecutor(max_workers=max(1, int(workers)),
+                                           thread_name_prefix="embedding")
+
+    def __call__(self, input: Documents) -> Embeddings:
+        batches = [input[start:start + self.batch_size]
+                   for start in range(0, len(input), self.batch_size)]
+        if len(batches) <= 1:
+            return self.embeddings(input) if input else []
+
+        results = []
+        for embeddings in self.executor.map(self.embeddings, batches):
+            results.extend(embeddings)
+        return results
+
+
+def create_embedding_function(conf: Optional[dict] = None) -> EmbeddingFunction:
+    """
+    Create the embedding function described by the "embedding"
+    section of the configuration
+
+    :param conf: embedding configuration (backend, model_name, batch_size, workers, cache)
+    :return: embedding function usable by a chromadb collection
+    """
+    conf = conf or {}
+    backend = conf.get("backend", DEFAULT_BACKEND)
+    logger.info(f"Using embedding backend:{backend}")
+
+    if backend == BACKEND_OPENAI:
+        model_name = conf.get("model_name", DEFAULT_OPENAI_MODEL)
+        embeddings = embedding_functions.OpenAIEmbeddingFunction(
+            api_key=os.environ.get('OPENAI_API_KEY'),
+            model_name=model_name
+        )
+    elif backend == BACKEND_ONNX:
+        # In-process all-MiniLM-L6-v2 (onnxruntime + tokenizers)
+        embeddings = embedding_functions.ONNXMiniLM_L6_V2(
+            preferred_providers=["CPUExecutionProvider"])
+        model_name = embedding_functions.ONNXMiniLM_L6_V2.MODEL_NAME
+        # The model is downloaded and loaded on first use; do it once here
+        # rather than racing from every pool worker
+        embeddings(["warm-up"])
+    elif backend == BACKEND_HASH:
+        embeddings = HashingEmbeddingFunction(conf.get("dimensions", DEFAULT_HASH_DIMENSIONS))
+        model_name = embeddings.model_name
+    else:
+        raise BgsException(f"Unknown embedding backend:{backend}")
+
+    embeddings = PooledEmbeddingFunction(embeddings, model_name,
+                                         batch_size=conf.get("batch_size", DEFAULT_BATCH_SIZE),
+                                         workers=conf.get("workers", DEFAULT_WORKERS))
+
+    cache = conf.get("cache") or {}
+    if cache.get("enabled", False):
+        embeddings = CachedEmbeddingFunction(embeddings, model_name,
+                                             max_entries=cache.get("max_entries", DEFAULT_MAX_ENTRIES),
+                                             path=cache.get("path"))
+    return embeddings
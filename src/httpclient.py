@@ -0,0 +1,356 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+import asyncio
+import logging
+import random
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from bgsexception import BgsException
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONFIG = {
+    "max_connections": 100,
+    "max_keepalive_connections": 20,
+    "timeout_seconds": 30.0,
+    "http2": False,
+    "retries": 2,
+    "backoff_seconds": 0.1,
+    "failure_threshold": 5,
+    "reset_seconds": 30.0
+}
+
+# Only these methods are retried, others may not be safe to repeat
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+RETRY_STATUS_CODES = {502, 503, 504}
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half-open"
+
+
+class CircuitBreaker():
+    """
+    Stop calling a host after repeated failures.
+
+    After "failure_threshold" consecutive failures the circuit opens
+    and calls fail immediately; after "reset_seconds" a single trial
+    call is let through (half-open) and its outcome closes or
+    re-opens the circuit.
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.reset_seconds = float(reset_seconds)
+        self.state = CIRCUIT_CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.state == CIRCUIT_CLOSED:
+                return True
+            # Let one trial call through per reset period (a trial
+            # that never reports back must not wedge the circuit)
+            now = time.monotonic()
+            if now - self.opened_at >= self.reset_seconds:
+                self.state = CIRCUIT_HALF_OPEN
+                self.opened_at = now
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.state = CIRCUIT_CLOSED
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == CIRCUIT_HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != CIRCUIT_OPEN:
+                    logger.warning(f"Opening circuit after failures:{self.failures}")
+                self.state = CIRCUIT_OPEN
+                self.opened_at = time.monotonic()
+
+
+class _HostPool():
+    """
+    Connection pools, circuit breaker and counters for one host
+    """
+
+    def __init__(self, conf: dict):
+        self.breaker = CircuitBreaker(conf["failure_threshold"], conf["reset_seconds"])
+        self.client: Optional[httpx.AsyncClient] = None
+        self.session: Optional[requests.Session] = None
+        self.requests = 0
+        self.failures = 0
+        self.retries = 0
+        self.rejected = 0
+        self.in_flight = 0
+
+
+class HttpClientManager():
+    """
+    Application-scoped manager for outbound HTTP connections.
+
+    Keeps one keep-alive connection pool per host (httpx for async
+    callers, a requests session for synchronous callers), retries
+    idempotent requests with exponential backoff and guards each
+    host with a circuit breaker.
+    """
+
+    def __init__(self, conf: Optional[dict] = None,
+                 transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.conf = {**DEFAULT_CONFIG, **(conf or {})}
+        # Custom async transport (e.g. httpx.MockTransport for stubbed services)
+        self.transport = transport
+        self.hosts: Dict[str, _HostPool] = {}
+        self.lock = threading.Lock()
+        self.http2 = bool(self.conf["http2"])
+        if self.http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("HTTP/2 requested but the 'h2' package is not installed, using HTTP/1.1")
+                self.http2 = False
+
+    async def start(self):
+        """
+        Start the manager (called at application startup)
+        """
+        logger.info(f"Starting HTTP client manager, config:{self.conf}")
+
+    async def close(self):
+        """
+        Close every connection pool (called at application shutdown)
+        """
+        with self.lock:
+            pools = list(self.hosts.values())
+            self.hosts = {}
+        for pool in pools:
+            if pool.client is not None:
+                await pool.client.aclose()
+            if pool.session is not None:
+                pool.session.close()
+        logger.info("Closed HTTP client manager")
+
+    async def request(self, method: str, host: str, port: int, service: str, **kwargs) -> httpx.Response:
+        """
+        Issue an ASYNC request using the pool for the host
+
+        :raises BgsException: if the circuit for the host is open
+        :raises httpx.HTTPError: if the request fails after all retries
+        """
+        pool = self._pool(host, port)
+        if pool.client is None:
+            pool.client = self._create_client()
+        url = f"http://{host}:{port}{service}"
+        attempts = self._attempts(method)
+
+        for attempt in range(attempts):
+            self._admit(pool, url)
+            pool.requests += 1
+            pool.in_flight += 1
+            try:
+                response = await pool.client.request(method, url, **kwargs)
+            except httpx.TransportError:
+                pool.failures += 1
+                pool.breaker.record_failure()
+                if attempt + 1 >= attempts:
+                    raise
+                pool.retries += 1
+                await asyncio.sleep(self._backoff(attempt))
+                continue
+            finally:
+                pool.in_flight -= 1
+
+            if response.status_code in RETRY_STATUS_CODES:
+                pool.failures += 1
+                pool.breaker.record_failure()
+                if attempt + 1 < attempts:
+                    pool.retries += 1
+                    await response.aclose()
+                    await asyncio.sleep(self._backoff(attempt))
+                    continue
+            else:
+                pool.breaker.record_success()
+            return response
+
+    @asynccontextmanager
+    async def stream(self, method: str, host: str, port: int, service: str,
+                     **kwargs) -> AsyncIterator[httpx.Response]:
+        """
+        Issue an ASYNC request whose body is read incrementally, e.g.
+
+            async with manager.stream("GET", host, port, service) as response:
+                async for chunk in response.aiter_bytes():
+                    ...
+
+        Streams are not retried (part of the body may already be consumed)
+
+        :raises BgsException: if the circuit for the host is open
+        :raises httpx.HTTPError: if the request fails
+        """
+        pool = self._pool(host, port)
+        if pool.client is None:
+            pool.client = self._create_client()
+        url = f"http://{host}:{port}{service}"
+        self._admit(pool, url)
+        pool.requests += 1
+        pool.in_flight += 1
+        try:
+            async with pool.client.stream(method, url, **kwargs) as response:
+                if response.status_code in RETRY_STATUS_CODES:
+                    pool.failures += 1
+                    pool.breaker.record_failure()
+                else:
+                    pool.breaker.record_success()
+                yield response
+        except httpx.TransportError:
+            pool.failures += 1
+            pool.breaker.record_failure()
+            raise
+        finally:
+            pool.in_flight -= 1
+
+    def srequest(self, method: str, host: str, port: int, service: str, **kwargs) -> requests.Response:
+        """
+        Issue a SYNCHRONOUS request using the pool for the host
+
+        :raises BgsException: if the circuit for the host is open
+        :raises requests.RequestException: if the request fails after all retries
+        """
+        pool = self._pool(host, port)
+        with self.lock:
+            if pool.session is None:
+                pool.session = self._create_session()
+        url = f"http://{host}:{port}{service}"
+        kwargs.setdefault("timeout", self.conf["timeout_seconds"])
+        attempts = self._attempts(method)
+
+        for attempt in range(attempts):
+            self._admit(pool, url)
+            with self.lock:
+                pool.requests += 1
+                pool.in_flight += 1
+            try:
+                response = pool.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                with self.lock:
+                    pool.failures += 1
+                pool.breaker.record_failure()
+                if attempt + 1 >= attempts:
+                    raise
+                with self.lock:
+                    pool.retries += 1
+                time.sleep(self._backoff(attempt))
+                continue
+            finally:
+                with self.lock:
+                    pool.in_flight -= 1
+
+            if response.status_code in RETRY_STATUS_CODES:
+                with self.lock:
+                    pool.failures += 1
+                pool.breaker.record_failure()
+                if attempt + 1 < attempts:
+                    with self.lock:
+                        pool.retries += 1
+                    time.sleep(self._backoff(attempt))
+                    continue
+            else:
+                pool.breaker.record_success()
+            return response
+
+    def stats(self) -> dict:
+        """
+        Get pool usage information per host
+        """
+        with self.lock:
+            pools = dict(self.hosts)
+        return {
+            key: {
+                "requests": pool.requests,
+                "failures": pool.failures,
+                "retries": pool.retries,
+                "rejected": pool.rejected,
+                "in_flight": pool.in_flight,
+                "circuit": pool.breaker.state,
+                "max_connections": self.conf["max_connections"]
+            }
+            for key, pool in pools.items()
+        }
+
+    def _pool(self, host: str, port: int) -> _HostPool:
+        key = f"{host}:{port}"
+        with self.lock:
+            pool = self.hosts.get(key)
+            if pool is None:
+                pool = _HostPool(self.conf)
+                self.hosts[key] = pool
+            return pool
+
+    def _admit(self, pool: _HostPool, url: str):
+        if not pool.breaker.allow():
+            pool.rejected += 1
+            raise BgsException(f"Circuit open for {url}")
+
+    def _attempts(self, method: str) -> int:
+        if method.upper() in IDEMPOTENT_METHODS:
+            return 1 + max(0, int(self.conf["retries"]))
+        return 1
+
+    def _backoff(self, attempt: int) -> float:
+        delay = float(self.conf["backoff_seconds"]) * (2 ** attempt)
+        return delay + random.uniform(0, delay)
+
+    def _create_client(self) -> httpx.AsyncClient:
+        limits = httpx.Limits(max_connections=self.conf["max_connections"],
+                              max_keepalive_connections=self.conf["max_keepalive_connections"])
+        return httpx.AsyncClient(limits=limits, timeout=self.conf["timeout_seconds"],
+                                 http2=self.http2, transport=self.transport)
+
+    def _create_session(self) -> requests.Session:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.conf["max_keepalive_connections"])
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+
+_manager: Optional[HttpClientManager] = None
+
+
+def configure(conf: Optional[dict] = None,
+              transport: Optional[httpx.AsyncBaseTransport] = None) -> HttpClientManager:
+    """
+    Create the application HTTP client manager from the "http"
+    section of the configuration
+    """
+    global _manager
+    _manager = HttpClientManager(conf, transport=transport)
+    return _manager
+
+
+def get_manager() -> HttpClientManager:
+    """
+    Get the application HTTP client manager (with default
+    configuration if none has been configured)
+    """
+    global _manager
+    if _manager is None:
+        _manager = HttpClientManager()
+    return _manager
@@ -0,0 +1,297 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""
+Background ingestion pipeline.
+
+Submitted products are placed on a bounded queue and acknowledged
+immediately with a job id.  A single batcher coalesces queued
+products into numbered batches, embedding workers embed them (one
+embedding call per batch) and a single writer commits them to the
+collection in batch order, so a later submission of a product always
+wins over an earlier one.  When the queue is full, submissions
+are rejected so that ingest spikes push back on clients instead of
+degrading query latency.
+"""
+
+import asyncio
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from bgsexception import BgsException, BgsBusyException
+from searchdb import SearchDb, SOURCE_API
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONFIG = {
+    # Products waiting to be embedded
+    "queue_depth": 10000,
+    # Concurrent embedding workers
+    "workers": 2,
+    # Products per embedding call
+    "batch_size": 64,
+    # Time to wait for more products before embedding a partial batch
+    "linger_seconds": 0.05,
+    # Seconds clients are asked to wait when the queue is full
+    "retry_after_seconds": 1,
+    # Finished jobs kept for status queries
+    "max_jobs": 1000
+}
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+
+class IngestionPipeline():
+    """
+    Bounded queue -> batcher -> embedding workers -> writer
+    """
+
+    def __init__(self, db: SearchDb, conf: Optional[dict] = None):
+        self.db = db
+        self.conf = {**DEFAULT_CONFIG, **(conf or {})}
+        self.queue_depth = max(1, int(self.conf["queue_depth"]))
+        self.workers = max(1, int(self.conf["workers"]))
+        self.batch_size = max(1, int(self.conf["batch_size"]))
+        self.linger_seconds = float(self.conf["linger_seconds"])
+        self.max_jobs = max(1, int(self.conf["max_jobs"]))
+
+        # Queues are created on start, within the running event loop
+        self.queue: Optional[asyncio.Queue] = None
+        self.embeds: Optional[asyncio.Queue] = None
+        self.batches: Optional[asyncio.Queue] = None
+        self.tasks: List[asyncio.Task] = []
+        # Batches are numbered by the batcher as they are taken from the
+        # queue and written in that order, whichever embedder finishes first
+        self.next_batch = 0
+        self.next_write = 0
+        self.turn: Optional[asyncio.Condition] = None
+        self.embed_executor = ThreadPoolExecutor(self.workers, thread_name_prefix="ingest-embed")
+        # A single writer keeps collection writes ordered
+        self.write_executor = ThreadPoolExecutor(1, thread_name_prefix="ingest-write")
+
+        self.jobs: OrderedDict = OrderedDict()
+        self.submitted = 0
+        self.written = 0
+        self.failed = 0
+        self.rejected = 0
+
+    async def start(self):
+        """
+        Start the workers (called at application startup)
+        """
+        self.queue = asyncio.Queue(maxsize=self.queue_depth)
+        # Numbered batches waiting for an embedder
+        self.embeds = asyncio.Queue(maxsize=self.workers)
+        # Embedded batches waiting for the writer (bounded so that
+        # embedding cannot run far ahead of writing)
+        self.batches = asyncio.Queue(maxsize=2 * self.workers)
+        self.turn = asyncio.Condition()
+        self.tasks = [asyncio.create_task(self._batcher())]
+        self.tasks.extend(asyncio.create_task(self._embedder()) for _ in range(self.workers))
+        self.tasks.append(asyncio.create_task(self._writer()))
+        logger.info(f"Started ingestion pipeline, config:{self.conf}")
+
+    async def stop(self, timeout: float = 30.0):
+        """
+        Finish queued work (up to the timeout) and stop the workers
+        """
+        if self.queue is not None:
+            try:
+                await asyncio.wait_for(self._drain(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Stopping ingestion with queued products:{self.queue.qsize()}")
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        self.embed_executor.shutdown(wait=False)
+        self.write_executor.shutdown(wait=False)
+        logger.info("Stopped ingestion pipeline")
+
+    async def _drain(self):
+        await self.queue.join()
+        await self.batches.join()
+
+    def submit(self, products: List[dict], source: str = SOURCE_API) -> dict:
+        """
+        Queue products for ingestion
+
+        :param products: data products (uuid, name, description, optional namespace and tags)
+        :param source: origin of the data products
+        :return: the job tracking the products
+        :raises ValueError: if the products can never fit in the queue
+        :raises BgsBusyException: if the queue cannot hold the products now
+        """
+        if self.queue is None:
+            raise BgsException("Ingestion pipeline is not running")
+        if len(products) > self.queue.maxsize:
+            self.rejected += 1
+            raise ValueError(f"Too many products requested:{len(products)} queue_depth:{self.queue.maxsize}, "
+                             f"submit them in smaller batches")
+        # All or nothing, so a job is never partially queued
+        if self.queue.qsize() + len(products) > self.queue.maxsize:
+            self.rejected += 1
+            raise BgsBusyException(f"Ingestion queue full, queued:{self.queue.qsize()} requested:{len(products)}",
+                                   retry_after=self.conf["retry_after_seconds"], status_code=429)
+
+        job = {
+            "id": str(uuid.uuid4()),
+            "status": JOB_QUEUED if products else JOB_DONE,
+            "total": len(products),
+            "written": 0,
+            "failed": 0,
+            "errors": [],
+            "created": time.time(),
+            "finished": None if products else time.time()
+        }
+        self.jobs[job["id"]] = job
+        self._expire_jobs()
+        for product in products:
+            self.queue.put_nowait((job["id"], product, source))
+        self.submitted += len(products)
+        return self.job(job["id"])
+
+    def job(self, job_id: str) -> Optional[dict]:
+        """
+        Get the status of a job (None if unknown or expired)
+        """
+        job = self.jobs.get(job_id)
+        return None if job is None else {**job, "errors": list(job["errors"])}
+
+    def stats(self) -> dict:
+        """
+        Get queue and throughput counters
+        """
+        return {
+            "queued": self.queue.qsize() if self.queue else 0,
+            "queue_depth": self.queue_depth,
+            "batches_pending": self.batches.qsize() if self.batches else 0,
+            "submitted": self.submitted,
+            "written": self.written,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "jobs": len(self.jobs)
+        }
+
+    async def _batcher(self):
+        # The only consumer of the queue, so batch numbers follow
+        # submission order
+        while True:
+            items = [await self.queue.get()]
+            # Give a burst a moment to fill the batch
+            if self.linger_seconds > 0 and self.queue.qsize() < self.batch_size - 1:
+                await asyncio.sleep(self.linger_seconds)
+            while len(items) < self.batch_size and not self.queue.empty():
+                items.append(self.queue.get_nowait())
+            sequence = self.next_batch
+            self.next_batch += 1
+            await self.embeds.put((sequence, items))
+
+    async def _embedder(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            sequence, items = await self.embeds.get()
+            try:
+                groups = []
+                for group, products, source in _deduplicate(items):
+                    self._mark_running(group)
+                    try:
+                        prepared = await loop.run_in_executor(
+                            self.embed_executor, self.db.prepare, products, source)
+                    except Exception as e:
+                        groups.append((group, None, e))
+                        continue
+                    groups.append((group, prepared, None))
+                # Do not run ahead of the writer by more than the
+                # batches it can hold (bounds the embedded data kept)
+                async with self.turn:
+                    await self.turn.wait_for(lambda: sequence - self.next_write < self.batches.maxsize)
+                await self.batches.put((sequence, groups))
+            finally:
+                for _ in items:
+                    self.queue.task_done()
+                self.embeds.task_done()
+
+    async def _writer(self):
+        loop = asyncio.get_running_loop()
+        pending = {}
+        while True:
+            sequence, groups = await self.batches.get()
+            pending[sequence] = groups
+            while self.next_write in pending:
+                for group, prepared, error in pending.pop(self.next_write):
+                    if error is None:
+                        try:
+                            await loop.run_in_executor(self.write_executor, self.db.write, prepared)
+                        except Exception as e:
+                            error = e
+                    self._finish(group, error)
+                self.next_write += 1
+                self.batches.task_done()
+                async with self.turn:
+                    self.turn.notify_all()
+
+    def _mark_running(self, items: list):
+        for job_id, _, _ in items:
+            job = self.jobs.get(job_id)
+            if job is not None and job["status"] == JOB_QUEUED:
+                job["status"] = JOB_RUNNING
+
+    def _finish(self, items: list, error: Optional[Exception] = None):
+        if error is not None:
+            logger.error(f"Ingestion failed for products:{len(items)}, exception:{error}")
+            self.failed += len(items)
+        else:
+            self.written += len(items)
+        for job_id, _, _ in items:
+            job = self.jobs.get(job_id)
+            if job is None:
+                continue
+            if error is not None:
+                job["failed"] += 1
+                if str(error) not in job["errors"] and len(job["errors"]) < 10:
+                    job["errors"].append(str(error))
+            else:
+                job["written"] += 1
+            if job["written"] + job["failed"] == job["total"]:
+                job["status"] = JOB_DONE if job["failed"] == 0 else JOB_FAILED
+                job["finished"] = time.time()
+
+    def _expire_jobs(self):
+        # Forget the oldest finished jobs beyond the retention limit
+        excess = len(self.jobs) - self.max_jobs
+        if excess <= 0:
+            return
+        for job_id in [job_id for job_id, job in self.jobs.items()
+                       if job["status"] in (JOB_DONE, JOB_FAILED)][:excess]:
+            del self.jobs[job_id]
+
+
+def _deduplicate(items: list) -> list:
+    """
+    Group queued items by source for preparation, keeping only the
+    last submission of each product (the earlier ones are superseded
+    and finish with it)
+
+    :param items: (job id, product, source) in submission order
+    :return: (items to finish, products to write, source) per source
+    """
+    last = {product["uuid"]: position for position, (_, product, _) in enumerate(items)}
+    groups = OrderedDict()
+    for position, item in enumerate(items):
+        winner = last[item[1]["uuid"]]
+        group, products = groups.setdefault(items[winner][2], ([], []))
+        group.append(item)
+        if winner == position:
+            products.append(item[1])
+    return [(group, products, source) for source, (group, products) in groups.items()]
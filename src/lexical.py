@@ -0,0 +1,191 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""
+In-process BM25 inverted index and rank fusion.
+
+The index mirrors the vector collection (it is maintained by the
+same write path) so exact names and identifiers can be matched
+lexically, and so identifier-like queries can be answered without
+computing an embedding.
+"""
+
+import heapq
+import math
+import re
+import threading
+from typing import Dict, Iterable, List, Optional
+
+DEFAULT_K1 = 1.2
+DEFAULT_B = 0.75
+# Reciprocal rank fusion constant (dampens the weight of top ranks)
+DEFAULT_RRF_K = 60
+
+_TOKEN = re.compile(r"\w+")
+# Characters that suggest an identifier (ticker, code, uuid...)
+_IDENTIFIER_CHARS = set("0123456789-_./:")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split text into lowercase word tokens
+    """
+    return _TOKEN.findall((text or "").lower())
+
+
+def is_identifier(query: str) -> bool:
+    """
+    Check whether a query looks like an identifier (a single token
+    with digits or punctuation, or an all-uppercase ticker) rather
+    than natural language
+    """
+    query = query.strip()
+    if not query or len(query.split()) > 1:
+        return False
+    if any(char in _IDENTIFIER_CHARS for char in query):
+        return True
+    return len(query) > 1 and query.isupper()
+
+
+def matches(where: Optional[dict], metadata: dict) -> bool:
+    """
+    Evaluate a chromadb "where" clause (equality, $eq, $and, $or)
+    against document metadata
+    """
+    if not where:
+        return True
+    for key, condition in where.items():
+        if key == "$and":
+            if not all(matches(clause, metadata) for clause in condition):
+                return False
+        elif key == "$or":
+            if not any(matches(clause, metadata) for clause in condition):
+                return False
+        elif isinstance(condition, dict):
+            if "$eq" not in condition or metadata.get(key) != condition["$eq"]:
+                return False
+        elif metadata.get(key) != condition:
+            return False
+    return True
+
+
+def rrf(rankings: Iterable[List[str]], k: int = DEFAULT_RRF_K) -> Dict[str, float]:
+    """
+    Fuse rankings with reciprocal rank fusion
+
+    :param rankings: lists of document identifiers, best first
+    :param k: fusion constant
+    :return: dictionary of document identifier to fused score
+    """
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, _id in enumerate(ranking):
+            scores[_id] = scores.get(_id, 0.0) + 1.0 / (k + rank + 1)
+    return scores
+
+
+class LexicalIndex():
+    """
+    BM25 inverted index over document text.
+
+    Documents are keyed by identifier; adding an existing identifier
+    replaces it.  The document and metadata are kept so that lexical
+    results can be returned without touching the vector collection.
+    """
+
+    def __init__(self, k1: float = DEFAULT_K1, b: float = DEFAULT_B):
+        self.k1 = float(k1)
+        self.b = float(b)
+        # term -> {identifier: term frequency}
+        self.postings: Dict[str, Dict[str, int]] = {}
+        self.lengths: Dict[str, int] = {}
+        self.documents: Dict[str, tuple] = {}
+        self.terms: Dict[str, set] = {}
+        self.total_length = 0
+        self.lock = threading.Lock()
+
+    def add(self, ids: List[str], texts: List[str], documents: List[str], metadatas: List[dict]):
+        """
+        Add (or replace) documents
+
+        :param ids: document identifiers
+        :param texts: text to index for each document
+        :param documents: document returned in results
+        :param metadatas: metadata returned in results (and used by filters)
+        """
+        with self.lock:
+            for _id, text, document, metadata in zip(ids, texts, documents, metadatas):
+                self._remove(_id)
+                tokens = tokenize(text)
+                frequencies: Dict[str, int] = {}
+                for token in tokens:
+                    frequencies[token] = frequencies.get(token, 0) + 1
+                for term, frequency in frequencies.items():
+                    self.postings.setdefault(term, {})[_id] = frequency
+                self.terms[_id] = set(frequencies)
+                self.lengths[_id] = len(tokens)
+                self.total_length += len(tokens)
+                self.documents[_id] = (document, metadata)
+
+    def delete(self, ids: List[str]):
+        """
+        Remove documents
+        """
+        with self.lock:
+            for _id in ids:
+                self._remove(_id)
+
+    def _remove(self, _id: str):
+        for term in self.terms.pop(_id, ()):
+            posting = self.postings[term]
+            del posting[_id]
+            if not posting:
+                del self.postings[term]
+        self.total_length -= self.lengths.pop(_id, 0)
+        self.documents.pop(_id, None)
+
+    def count(self) -> int:
+        return len(self.documents)
+
+    def search(self, query: str, n_results: int, where: Optional[dict] = None) -> List[dict]:
+        """
+        Find the best matching documents
+
+        :param query: query text
+        :param n_results: maximum number of results
+        :param where: chromadb "where" clause applied to metadata
+        :return: results (best first) with id, data, metadata and score
+        """
+        terms = set(tokenize(query))
+        with self.lock:
+            total = len(self.documents)
+            if total == 0 or not terms:
+                return []
+            average = self.total_length / total or 1.0
+            scores: Dict[str, float] = {}
+            allowed: Dict[str, bool] = {}
+            for term in terms:
+                posting = self.postings.get(term)
+                if not posting:
+                    continue
+                idf = math.log(1.0 + (total - len(posting) + 0.5) / (len(posting) + 0.5))
+                for _id, frequency in posting.items():
+                    if where:
+                        if _id not in allowed:
+                            allowed[_id] = matches(where, self.documents[_id][1])
+                        if not allowed[_id]:
+                            continue
+                    norm = self.k1 * (1.0 - self.b + self.b * self.lengths[_id] / average)
+                    scores[_id] = scores.get(_id, 0.0) + idf * frequency * (self.k1 + 1.0) / (frequency + norm)
+
+            # Ties are broken by identifier so that paging is stable
+            best = heapq.nsmallest(n_results, scores.items(), key=lambda item: (-item[1], item[0]))
+            return [{
+                "id": _id,
+                "data": self.documents[_id][0],
+                "metadata": self.documents[_id][1],
+                "score": score
+            } for _id, score in best]
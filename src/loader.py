@@ -0,0 +1,231 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""
+Streaming registrar loader.
+
+Products are read from the registrar incrementally, either by
+parsing the response (a JSON array or NDJSON) as it streams in or
+by requesting pages, and are synchronized batch by batch.  Memory
+use is bounded by the batch size (plus the set of product ids seen,
+needed to detect removed products), and products become searchable
+as soon as their batch is written.
+
+Progress is checkpointed so that an interrupted load resumes where
+it stopped instead of starting over.  The checkpoint holds the offset
+reached; the ids applied (needed to tell which products were removed
+once the load completes) are appended to a companion file, so each
+checkpoint only writes the ids of its own batches.
+"""
+
+import asyncio
+import codecs
+import json
+import logging
+import os
+import time
+import uuid
+from typing import AsyncIterator, List, Optional
+
+import constants
+import httpclient
+from sync import SyncEngine
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONFIG = {
+    # Products per sync batch
+    "batch_size": 500,
+    # Request pages of this size (offset/limit query parameters)
+    # instead of streaming one response; 0 streams
+    "page_size": 0,
+    # Progress file for resuming an interrupted load (None disables)
+    "checkpoint_path": None,
+    # Batches between checkpoints
+    "checkpoint_batches": 10
+}
+
+# Companion file of the checkpoint holding the ids applied, one per line
+SEEN_SUFFIX = ".seen"
+
+
+async def iter_json_items(chunks: AsyncIterator[bytes]) -> AsyncIterator:
+    """
+    Incrementally parse a JSON array, or NDJSON, into its items
+
+    :param chunks: body of the document, in arbitrary chunks
+    :raises ValueError: if the document is malformed
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    array = None
+    finished = False
+    async for chunk in chunks:
+        buffer += text.decode(chunk)
+        position = 0
+        while not finished:
+            # Skip whitespace (and separators between array items)
+            while position < len(buffer) and (buffer[position].isspace() or (array and buffer[position] == ",")):
+                position += 1
+            if position >= len(buffer):
+                break
+            if array is None:
+                array = buffer[position] == "["
+                if array:
+                    position += 1
+                continue
+            if array and buffer[position] == "]":
+                finished = True
+                break
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # Incomplete item, wait for more data
+                break
+            yield item
+        buffer = buffer[position:]
+    buffer += text.decode(b"", final=True)
+    if (array and not finished) or (not array and buffer.strip()):
+        raise ValueError("Truncated or malformed JSON document")
+
+
+class RegistrarLoader():
+    """
+    Load registrar products into the search collection
+    """
+
+    def __init__(self, sync_engine: SyncEngine, registrar: dict):
+        self.sync_engine = sync_engine
+        self.registrar = registrar
+        self.conf = {**DEFAULT_CONFIG, **{key: value for key, value in registrar.items() if key in DEFAULT_CONFIG}}
+        self.batch_size = max(1, int(self.conf["batch_size"]))
+        self.page_size = max(0, int(self.conf["page_size"]))
+
+    async def load(self) -> dict:
+        """
+        Synchronize the collection with the registrar
+
+        :return: sync statistics (with the offset resumed from, if any)
+        """
+        checkpoint = self._read_checkpoint()
+        offset = checkpoint["offset"] if checkpoint else 0
+        session = self.sync_engine.begin(seen=checkpoint["seen"] if checkpoint else None)
+        if checkpoint:
+            logger.info(f"Resuming load from offset:{offset}")
+        else:
+            self._remove_checkpoint()
+
+        consumed = offset
+        batches = 0
+        batch = []
+        # Ids applied since the last checkpoint
+        unrecorded = []
+        async for product in self._products(offset):
+            batch.append(product)
+            if len(batch) >= self.batch_size:
+                # Sync embeds and writes, so keep it off the event loop
+                await asyncio.to_thread(session.apply, batch)
+                consumed += len(batch)
+                unrecorded.extend(product["uuid"] for product in batch)
+                batch = []
+                batches += 1
+                if batches % max(1, int(self.conf["checkpoint_batches"])) == 0:
+                    await asyncio.to_thread(self._write_checkpoint, consumed, unrecorded)
+                    unrecorded = []
+        if batch:
+            await asyncio.to_thread(session.apply, batch)
+            consumed += len(batch)
+
+        # Only a complete pass may remove products
+        stats = await asyncio.to_thread(self.sync_engine.complete, session)
+        self._remove_checkpoint()
+        stats["consumed"] = consumed
+        stats["resumed_from"] = offset
+        return stats
+
+    async def _products(self, offset: int) -> AsyncIterator[dict]:
+        if self.page_size:
+            async for product in self._paged(offset):
+                yield product
+            return
+        skipped = 0
+        async for product in self._stream(self.registrar["service"]):
+            # A stream cannot be restarted part way, skip what was applied
+            if skipped < offset:
+                skipped += 1
+                continue
+            yield product
+
+    async def _paged(self, offset: int) -> AsyncIterator[dict]:
+        while True:
+            separator = "&" if "?" in self.registrar["service"] else "?"
+            service = f"{self.registrar['service']}{separator}offset={offset}&limit={self.page_size}"
+            count = 0
+            async for product in self._stream(service):
+                count += 1
+                yield product
+            offset += count
+            if count < self.page_size:
+                return
+
+    async def _stream(self, service: str) -> AsyncIterator[dict]:
+        headers = {
+            constants.HEADER_USERNAME: constants.USERNAME,
+            constants.HEADER_CORRELATION_ID: str(uuid.uuid4())
+        }
+        logger.info(f"Streaming products service:{service} headers:{headers}")
+        async with httpclient.get_manager().stream(
+                self.registrar.get("method", "GET"), self.registrar["host"],
+                self.registrar["port"], service, headers=headers) as response:
+            response.raise_for_status()
+            async for product in iter_json_items(response.aiter_bytes()):
+                yield product
+
+    #####
+    # CHECKPOINT
+    #####
+
+    def _read_checkpoint(self) -> Optional[dict]:
+        path = self.conf["checkpoint_path"]
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r") as file:
+                checkpoint = json.load(file)
+            # Ids appended after the checkpoint was written are not part of it
+            with open(path + SEEN_SUFFIX, "r+b") as file:
+                file.truncate(int(checkpoint["seen_bytes"]))
+                seen = set(file.read().decode("utf-8").splitlines())
+            return {"offset": int(checkpoint["offset"]), "seen": seen}
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Ignoring unreadable checkpoint path:{path}, exception:{e}")
+            return None
+
+    def _write_checkpoint(self, offset: int, ids: List[str]):
+        """
+        Record the offset reached and append the ids applied since the
+        previous checkpoint
+        """
+        path = self.conf["checkpoint_path"]
+        if not path:
+            return
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path + SEEN_SUFFIX, "ab") as file:
+            file.write("".join(f"{_id}\n" for _id in ids).encode("utf-8"))
+            seen_bytes = file.tell()
+        temporary = path + ".tmp"
+        with open(temporary, "w") as file:
+            json.dump({"offset": offset, "seen_bytes": seen_bytes, "updated": time.time()}, file)
+        os.replace(temporary, path)
+
+    def _remove_checkpoint(self):
+        path = self.conf["checkpoint_path"]
+        for name in (path, path and path + SEEN_SUFFIX):
+            if name and os.path.exists(name):
+                os.remove(name)
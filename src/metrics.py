@@ -0,0 +1,419 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""
+Metrics registry with counters, gauges and latency histograms.
+
+Label values must come from small, fixed sets (route templates,
+status classes, operation names) so that the number of series
+stays bounded.  Metrics can be exposed as JSON or in the
+Prometheus text exposition format, and the registries of several
+processes can be exported and merged.
+"""
+
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Latency buckets (seconds)
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# How gauges of several processes are combined (NaN values are ignored)
+AGGREGATE_SUM = "sum"
+AGGREGATE_MAX = "max"
+AGGREGATE_MIN = "min"
+
+
+class _Metric():
+    type = None
+
+    def __init__(self, name: str, description: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.children: Dict[tuple, object] = {}
+
+    def labels(self, **labels):
+        """
+        Get the child metric for a set of label values
+        """
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self.lock:
+            child = self.children.get(key)
+            if child is None:
+                child = self._create_child()
+                self.children[key] = child
+            return child
+
+    def _default(self):
+        if self.labelnames:
+            raise ValueError(f"Metric:{self.name} requires labels:{self.labelnames}")
+        return self.labels()
+
+    def _create_child(self):
+        raise NotImplementedError
+
+    def samples(self) -> List[Tuple[dict, object]]:
+        with self.lock:
+            items = list(self.children.items())
+        return [(dict(zip(self.labelnames, key)), child) for key, child in items]
+
+
+class _CounterChild():
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        with self.lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def _create_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1.0):
+        self._default().inc(amount)
+
+
+class _GaugeChild():
+    def __init__(self):
+        self.value = 0.0
+        self.function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float):
+        self.value = float(value)
+
+    def set_function(self, function: Callable[[], float]):
+        """
+        Compute the gauge value when it is collected
+        """
+        self.function = function
+
+    def get(self) -> float:
+        if self.function is not None:
+            try:
+                return float(self.function())
+            except Exception:
+                return math.nan
+        return self.value
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, description: str, labelnames: Tuple[str, ...] = (),
+                 aggregate: str = AGGREGATE_SUM):
+        super().__init__(name, description, labelnames)
+        self.aggregate = aggregate
+
+    def _create_child(self):
+        return _GaugeChild()
+
+    def set(self, value: float):
+        self._default().set(value)
+
+    def set_function(self, function: Callable[[], float]):
+        self._default().set_function(function)
+
+
+class _HistogramChild():
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextmanager
+    def time(self):
+        """
+        Observe the duration of the enclosed block
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+            count = self.count
+        cumulative = []
+        running = 0
+        for bound, bucket in zip(self.buckets, counts):
+            running += bucket
+            cumulative.append((bound, running))
+        return {
+            "count": count,
+            "sum": total,
+            "buckets": cumulative,
+            "p50": _quantile(cumulative, count, 0.50),
+            "p95": _quantile(cumulative, count, 0.95),
+            "p99": _quantile(cumulative, count, 0.99)
+        }
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, description: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, description, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _create_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+
+class Registry():
+    """
+    Collection of metrics with JSON and Prometheus exposition
+    """
+
+    def __init__(self):
+        self.metrics: Dict[str, _Metric] = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"Duplicate metric:{metric.name}")
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, description: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, description, labelnames))
+
+    def gauge(self, name: str, description: str, labelnames: Tuple[str, ...] = (),
+              aggregate: str = AGGREGATE_SUM) -> Gauge:
+        return self.register(Gauge(name, description, labelnames, aggregate))
+
+    def histogram(self, name: str, description: str, labelnames: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, description, labelnames, buckets))
+
+    def export(self) -> dict:
+        """
+        Get the raw state of every metric (for merging, see merge)
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        output = {}
+        for metric in metrics:
+            series = []
+            for labels, child in metric.samples():
+                values = [labels[name] for name in metric.labelnames]
+                if metric.type == "histogram":
+                    with child.lock:
+                        series.append([values, {"counts": list(child.counts), "sum": child.sum, "count": child.count}])
+                elif metric.type == "gauge":
+                    series.append([values, _json_value(child.get())])
+                else:
+                    series.append([values, child.value])
+            output[metric.name] = series
+        return output
+
+    def merge(self, exports: List[dict]) -> "Registry":
+        """
+        Combine exported states (e.g. one per process) into a new
+        registry with the same metrics: counters and histograms are
+        added, gauges are aggregated as declared
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        merged = Registry()
+        for metric in metrics:
+            if metric.type == "histogram":
+                target = merged.histogram(metric.name, metric.description, metric.labelnames, metric.buckets)
+            elif metric.type == "gauge":
+                target = merged.gauge(metric.name, metric.description, metric.labelnames, metric.aggregate)
+            else:
+                target = merged.counter(metric.name, metric.description, metric.labelnames)
+
+            gauges: Dict[tuple, List[float]] = {}
+            for export in exports:
+                for values, value in export.get(metric.name, []):
+                    child = target.labels(**dict(zip(metric.labelnames, values)))
+                    if metric.type == "histogram":
+                        if len(value["counts"]) != len(child.counts):
+                            continue
+                        child.counts = [a + b for a, b in zip(child.counts, value["counts"])]
+                        child.sum += value["sum"]
+                        child.count += value["count"]
+                    elif metric.type == "gauge":
+                        if value is not None:
+                            gauges.setdefault(tuple(values), []).append(value)
+                    else:
+                        child.inc(value)
+            for values, observed in gauges.items():
+                child = target.labels(**dict(zip(metric.labelnames, values)))
+                if metric.aggregate == AGGREGATE_MAX:
+                    child.set(max(observed))
+                elif metric.aggregate == AGGREGATE_MIN:
+                    child.set(min(observed))
+                else:
+                    child.set(sum(observed))
+        return merged
+
+    def to_dict(self) -> dict:
+        """
+        Get all metrics as a JSON-compatible dictionary
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        output = {}
+        for metric in metrics:
+            series = []
+            for labels, child in metric.samples():
+                if metric.type == "histogram":
+                    snapshot = child.snapshot()
+                    snapshot["buckets"] = {_format_bound(bound): count for bound, count in snapshot["buckets"]}
+                    for quantile in ("p50", "p95", "p99"):
+                        if snapshot[quantile] is not None:
+                            snapshot[quantile] = _json_value(snapshot[quantile])
+                    series.append({"labels": labels, **snapshot})
+                elif metric.type == "gauge":
+                    series.append({"labels": labels, "value": _json_value(child.get())})
+                else:
+                    series.append({"labels": labels, "value": child.value})
+            output[metric.name] = {
+                "type": metric.type,
+                "description": metric.description,
+                "series": series
+            }
+        return output
+
+    def to_prometheus(self) -> str:
+        """
+        Get all metrics in the Prometheus text exposition format
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for labels, child in metric.samples():
+                if metric.type == "histogram":
+                    snapshot = child.snapshot()
+                    for bound, count in snapshot["buckets"]:
+                        lines.append(f"{metric.name}_bucket{_format_labels(labels, le=_format_bound(bound))} {count}")
+                    lines.append(f"{metric.name}_bucket{_format_labels(labels, le='+Inf')} {snapshot['count']}")
+                    lines.append(f"{metric.name}_sum{_format_labels(labels)} {snapshot['sum']}")
+                    lines.append(f"{metric.name}_count{_format_labels(labels)} {snapshot['count']}")
+                elif metric.type == "gauge":
+                    lines.append(f"{metric.name}{_format_labels(labels)} {_format_value(child.get())}")
+                else:
+                    lines.append(f"{metric.name}{_format_labels(labels)} {_format_value(child.value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _quantile(cumulative: List[Tuple[float, int]], count: int, quantile: float) -> Optional[float]:
+    """
+    Estimate a quantile from cumulative bucket counts (the upper
+    bound of the bucket containing the quantile)
+    """
+    if count == 0:
+        return None
+    rank = quantile * count
+    for bound, running in cumulative:
+        if running >= rank:
+            return bound
+    return math.inf
+
+
+def _format_bound(bound: float) -> str:
+    return repr(float(bound))
+
+
+def _format_value(value: float) -> str:
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+def _json_value(value: float) -> Optional[float]:
+    return None if math.isnan(value) or math.isinf(value) else value
+
+
+def _format_labels(labels: dict, **extra) -> str:
+    labels = {**labels, **extra}
+    if not labels:
+        return ""
+    escaped = [f'{name}="{_escape(value)}"' for name, value in labels.items()]
+    return "{" + ",".join(escaped) + "}"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def status_class(status_code: int) -> str:
+    """
+    Reduce a status code to its class (e.g. 404 -> "4xx")
+    """
+    return f"{status_code // 100}xx"
+
+
+#####
+# SERVICE METRICS
+#####
+
+REGISTRY = Registry()
+
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    "search_http_request_duration_seconds", "HTTP request latency",
+    ("route", "method", "status"))
+EMBEDDING_SECONDS = REGISTRY.histogram(
+    "search_embedding_duration_seconds", "Embedding call latency", ("operation",))
+VECTOR_QUERY_SECONDS = REGISTRY.histogram(
+    "search_vector_query_duration_seconds", "Vector (ANN) query latency")
+LEXICAL_QUERY_SECONDS = REGISTRY.histogram(
+    "search_lexical_query_duration_seconds", "Lexical (BM25) query latency")
+RERANK_SECONDS = REGISTRY.histogram(
+    "search_rerank_duration_seconds", "Cross-encoder re-ranking latency (one forward pass per request)",
+    ("outcome",))
+ARTIFACT_FANOUT_SECONDS = REGISTRY.histogram(
+    "search_artifact_fanout_duration_seconds", "Artifact enrichment latency (all lookups of a request)")
+COLLECTION_SIZE = REGISTRY.gauge(
+    "search_collection_size", "Number of documents in the search collection", aggregate=AGGREGATE_MAX)
+INGEST_QUEUE_SIZE = REGISTRY.gauge(
+    "search_ingest_queue_size", "Products waiting in the ingestion queue")
+SYNC_LAG_SECONDS = REGISTRY.gauge(
+    "search_sync_lag_seconds", "Seconds since the last successful registrar sync", aggregate=AGGREGATE_MIN)
+CACHE_HITS = REGISTRY.gauge(
+    "search_cache_hits", "Cache hits", ("cache",))
+CACHE_MISSES = REGISTRY.gauge(
+    "search_cache_misses", "Cache misses", ("cache",))
+COALESCED_REQUESTS = REGISTRY.gauge(
+    "search_coalesced_requests", "Requests that shared an identical in-flight computation", ("operation",))
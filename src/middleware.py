@@ -1,163 +1,191 @@
 import logging
 from fastapi import Request
-import base64
+import random
+import os
+import time
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.responses import StreamingResponse
-from starlette.types import Send
 from starlette.datastructures import MutableHeaders
 import uuid
 
 import state
+import metrics
+import tracing
 
 STATE_TRACEID = "state-traceid"
-STATE_METRICS = "state-metrics"
 
 HEADER_USERNAME = "OSC-DM-Username"
 HEADER_CORRELATION_ID = "OSC-DM-Correlation-ID"
 USERNAME_UNKNOWN = "unknown"
 
+# Request/response logging settings (see configure)
+DEFAULT_SETTINGS = {
+    # Fraction of requests whose request and response are logged
+    "sample_rate": 1.0,
+    # Maximum number of characters of a body that are logged
+    "max_payload": 1024,
+    # Log responses with a 5xx status even if not sampled
+    "log_errors": True,
+    # Format and write log records on a background thread
+    "queue": True
+}
+_settings = dict(DEFAULT_SETTINGS)
+
+
+def configure(conf: dict = None) -> dict:
+    """
+    Configure request/response logging from the "logging"
+    section of the configuration
+
+    Returns:
+    - dict: the settings in effect
+    """
+    global _settings
+    _settings = {**DEFAULT_SETTINGS, **(conf or {})}
+    return _settings
+
 class LoggingMiddleware(BaseHTTPMiddleware):
     """
     FastAPI middleware is used to add processing to
     each request.  This is used to perform several capabilities:
     - add "TRACE" identifiers to request and responses that
     link requests to their responses
-    - track basic statistics about service usage for
-    URLs and username (HEADER_USERNAME in header)
+    - record request latency per route template, method and
+    status class (see metrics.HTTP_REQUEST_SECONDS)
     - create correlation id that can allow messages
     to be tracked end-to-end (assuming each communication
     participate propagates key headers)
+
+    Only a sample of requests (sample_rate) is logged in full, bodies
+    are read only for sampled requests and are truncated to max_payload.
+    Missing correlation id and username headers are likewise only
+    reported for sampled requests.
+    Log calls pass their arguments lazily so that, with queue logging
+    (see utilities.start_queue_logging), formatting happens off the
+    request path.
     """
     async def dispatch(self, request: Request, call_next):
         logger = logging.getLogger(__name__)
-
-        body = {}
-        if request.method not in ["GET", "HEAD", "OPTIONS"]:
-            try:
-                body = await request.json()
-            except Exception:
-                try:
-                    body = await request.body()
-                    body = _safe_decode(body)
-                except Exception as e:
-                    body = f"Failed to read body: {str(e)}"
+        settings = _settings
+        sampled = settings["sample_rate"] >= 1.0 or random.random() < settings["sample_rate"]
 
         # Get the correlation id, and add it if it does not exist
         correlation_id = request.headers.get(HEADER_CORRELATION_ID)
         if correlation_id is None:
-            logger.warning(f"Missing header:{HEADER_CORRELATION_ID} url:{str(request.url)} headers:{request.headers} ")
             correlation_id = str(uuid.uuid4())
             headers = MutableHeaders(request._headers)
             headers[HEADER_CORRELATION_ID] = correlation_id
             request._headers = headers
-            logger.warning(f"Added header:{HEADER_CORRELATION_ID}:{correlation_id} url:{str(request.url)} headers:{request.headers} ")
+            if sampled:
+                logger.warning("Missing header:%s url:%s, added:%s", HEADER_CORRELATION_ID, request.url.path, correlation_id)
 
         # Get the username, and add it if it does not exist
         username = request.headers.get(HEADER_USERNAME)
         if username is None:
-            logger.warning(f"Missing header:{HEADER_USERNAME} url:{str(request.url)} headers:{request.headers} ")
             username = USERNAME_UNKNOWN
             headers = MutableHeaders(request._headers)
             headers[HEADER_USERNAME] = username
             request._headers = headers
-            logger.warning(f"Added header:{HEADER_USERNAME}:{username} url:{str(request.url)} headers:{request.headers} ")
+            if sampled:
+                logger.warning("Missing header:%s url:%s, added:%s", HEADER_USERNAME, request.url.path, username)
 
         # Get a trace identifier to track requests and responses logs
-        trace_id = state.gstate(STATE_TRACEID)
-        if not trace_id:
-            trace_id = 0
-            state.gstate(STATE_TRACEID, trace_id)
-        trace_id = state.gstate(STATE_TRACEID)
+        # (claimed before awaiting so concurrent requests never share one,
+        # and prefixed by the process id to stay unique across processes)
+        count = state.gstate(STATE_TRACEID) or 0
+        state.gstate(STATE_TRACEID, count + 1)
+        trace_id = f"{os.getpid()}-{count}"
 
         url = str(request.url)
-        request_info = {
-            "url": url,
-            "method": request.method,
-            "headers": dict(request.headers),
-            "parameters": dict(request.query_params),
-            "body": body
-        }
-        logger.info(f"TRACE-{trace_id}:{correlation_id}-REQ:{request_info}")
-
-        response = await call_next(request)
-        status_code = response.status_code
+        if sampled:
+            body = ""
+            if request.method not in ["GET", "HEAD", "OPTIONS"]:
+                try:
+                    body = _preview(await request.body(), settings["max_payload"])
+                except Exception as e:
+                    body = f"Failed to read body: {str(e)}"
+            request_info = {
+                "url": url,
+                "method": request.method,
+                "headers": dict(request.headers),
+                "parameters": dict(request.query_params),
+                "body": body
+            }
+            logger.info("TRACE-%s:%s-REQ:%s", trace_id, correlation_id, request_info)
+
+        # Continue the caller's trace (if any), with the correlation id as baggage
+        with tracing.span(request.method, headers=request.headers, kind=tracing.KIND_SERVER,
+                          **{"http.method": request.method, "http.url": url,
+                             "osc.correlation_id": correlation_id,
+                             "osc.username": username}) as current, \
+                tracing.correlation(correlation_id):
+            start = time.perf_counter()
+            response = await call_next(request)
+            elapsed = time.perf_counter() - start
+            status_code = response.status_code
+            route = getattr(request.scope.get("route"), "path", "unmatched")
+            current.update_name(f"{request.method} {route}")
+            current.set_attribute("http.route", route)
+            current.set_attribute("http.status_code", status_code)
 
         # Add the correlation id and username to the response
         response.headers[HEADER_CORRELATION_ID] = correlation_id
         response.headers[HEADER_USERNAME] = username
 
-        # Handle username counts
-        metrics = state.gstate(STATE_METRICS)
-        if not metrics:
-            metrics = {}
-            state.gstate(STATE_METRICS, metrics)
-        metrics = state.gstate(STATE_METRICS)
-
-        # Update counts for username
-        username = request.headers.get(HEADER_USERNAME)
-        if not username:
-            username = USERNAME_UNKNOWN
-        if username not in metrics:
-            metrics[username] = {}
-        if url not in metrics[username]:
-            metrics[username][url] = {}
-        if status_code not in metrics[username][url]:
-            metrics[username][url][status_code] = 0
-        metrics[username][url][status_code] += 1
-        logger.info(f"Using metrics:{metrics}")
-
-        # Log response
-        response_body = ""
-        if isinstance(response, StreamingResponse):
-            original_body_iterator = response.body_iterator
-            logging_response = _LoggingStreamingResponse(original_body_iterator, status_code=response.status_code, headers=dict(response.headers))
-            response_body = logging_response.body
-        else:
-            response_body = response.body.decode("utf-8") if hasattr(response, 'body') else str(response)
-
-        response_info = {
-            "status_code": response.status_code,
-            "headers": response.headers,
-            "body": response_body
-        }
-        logger.info(f"TRACE-{trace_id}:{correlation_id}-RSP:{response_info}")
-
-        state.gstate(STATE_TRACEID, trace_id + 1)
+        # Record latency using the route template (not the URL) to bound cardinality
+        metrics.HTTP_REQUEST_SECONDS.labels(
+            route=route, method=request.method, status=metrics.status_class(status_code)).observe(elapsed)
+
+        # Log response (the body is captured as it streams to the client)
+        if sampled:
+            if isinstance(response, StreamingResponse):
+                response.body_iterator = _logged_body(
+                    response.body_iterator, settings["max_payload"], logger,
+                    trace_id, correlation_id, status_code, response.headers)
+            else:
+                response_body = _preview(response.body, settings["max_payload"]) \
+                    if hasattr(response, 'body') else str(response)
+                response_info = {
+                    "status_code": status_code,
+                    "headers": dict(response.headers),
+                    "body": response_body
+                }
+                logger.info("TRACE-%s:%s-RSP:%s", trace_id, correlation_id, response_info)
+        elif status_code >= 500 and settings["log_errors"]:
+            logger.warning("TRACE-%s:%s-RSP: status_code:%s url:%s", trace_id, correlation_id, status_code, url)
 
         return response
 
     @staticmethod
     def get_metrics():
-        usernames = state.gstate(STATE_METRICS)
-        return usernames
-
-
-class _LoggingStreamingResponse(StreamingResponse):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.body_chunks = []
-
-    async def stream_response(self, send: Send):
-        async for chunk in self.body_iterator:
-            self.body_chunks.append(chunk)
-            await send({
-                "type": "http.response.body",
-                "body": chunk,
-                "more_body": True
-            })
-
-        await send({
-            "type": "http.response.body",
-            "body": b"",
-            "more_body": False
-        })
-
-    @property
-    def body(self):
-        return b"".join(self.body_chunks).decode("utf-8")
-
-def _safe_decode(data):
-    try:
-        return data.decode('utf-8')
-    except UnicodeDecodeError:
-        return base64.b64encode(data).decode('utf-8')
+        return metrics.REGISTRY.to_dict()
+
+
+async def _logged_body(body_iterator, max_payload: int, logger, trace_id,
+                       correlation_id, status_code, headers):
+    """
+    Pass a response body through, logging (up to max_payload
+    bytes of) it once it has been sent
+    """
+    captured = bytearray()
+    async for chunk in body_iterator:
+        if len(captured) < max_payload:
+            captured.extend(chunk[:max_payload - len(captured)])
+        yield chunk
+
+    response_info = {
+        "status_code": status_code,
+        "headers": dict(headers),
+        "body": _preview(bytes(captured), max_payload)
+    }
+    logger.info("TRACE-%s:%s-RSP:%s", trace_id, correlation_id, response_info)
+
+
+def _preview(data: bytes, max_payload: int) -> str:
+    """
+    Decode at most max_payload bytes of a body for logging
+    """
+    text = data[:max_payload].decode("utf-8", errors="replace")
+    if len(data) > max_payload:
+        text += f"...({len(data) - max_payload} more bytes)"
+    return text
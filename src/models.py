@@ -5,20 +5,68 @@
 # https://opensource.org/licenses/MIT.
 #
 # Created: 2024-04-22 by graeham.broda@gmail.com
-from pydantic import BaseModel
-from typing import Optional, List
+from pydantic import BaseModel, Field
+from typing import Optional, List, Literal
+
+# Largest page of results a single query may request
+MAX_K = 100
+# Largest number of queries in a batch query
+MAX_BATCH = 100
+# Largest number of candidates a query may ask to re-rank, and
+# largest re-ranking time budget
+MAX_RERANK = 200
+MAX_RERANK_BUDGET_MS = 10000
 
 
 class AddData(BaseModel):
     uuid: str
     name: str
     description: str
+    namespace: Optional[str] = None
+    tags: Optional[List[str]] = None
+
 
+class QueryOptions(BaseModel):
+    # Number of results to return
+    k: int = Field(default=1, ge=1, le=MAX_K)
+    # Paging: either an explicit offset or the cursor from a previous response
+    offset: int = Field(default=0, ge=0)
+    cursor: Optional[str] = None
+    # Results whose vector similarity (BM25 score for queries answered
+    # lexically, including identifiers in auto mode) is below this value
+    # are dropped; in hybrid mode this applies before fusion, so results
+    # found only lexically are kept
+    min_score: Optional[float] = None
+    # Retrieval mode (default: the configured mode)
+    mode: Optional[Literal["auto", "hybrid", "vector", "lexical"]] = None
+    # Cross-encoder re-ranking (defaults: the configured ones, no
+    # effect unless re-ranking is configured)
+    rerank: Optional[bool] = None
+    rerank_top_n: Optional[int] = Field(default=None, ge=1, le=MAX_RERANK)
+    rerank_budget_ms: Optional[float] = Field(default=None, gt=0, le=MAX_RERANK_BUDGET_MS)
+    # Metadata filters
+    name: Optional[str] = None
+    namespace: Optional[str] = None
+    tags: Optional[List[str]] = None
 
-class QueryData(BaseModel):
+
+class QueryData(QueryOptions):
     query: str
 
 
+class BatchQueryData(QueryOptions):
+    # Options apply to every query in the batch
+    queries: List[str] = Field(min_length=1, max_length=MAX_BATCH)
+
+
+class RebuildData(BaseModel):
+    # HNSW settings of the rebuilt collection (default: current settings)
+    space: Optional[Literal["l2", "cosine", "ip"]] = None
+    M: Optional[int] = Field(default=None, ge=2, le=128)
+    construction_ef: Optional[int] = Field(default=None, ge=1)
+    search_ef: Optional[int] = Field(default=None, ge=1)
+
+
 # Downloadable resource
 class Resource(BaseModel):
     mimetype: str
@@ -0,0 +1,160 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""
+Multi-process serving.
+
+One writer process owns registrar sync, ingestion and index writes
+and publishes the index as a snapshot.  N reader processes share
+the public listening socket, reload the snapshot when it changes and
+forward writes to the writer.  Each process periodically publishes
+its metrics to a shared directory so any process can report metrics
+aggregated across all of them.
+"""
+
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import socket
+from typing import Callable, List, Optional
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+ROLE_SINGLE = "single"
+ROLE_WRITER = "writer"
+ROLE_READER = "reader"
+
+DEFAULT_CONFIG = {
+    # Reader processes (1 or less runs everything in a single process)
+    "workers": 1,
+    # Internal address of the writer process
+    "writer_host": "127.0.0.1",
+    "writer_port": 8001,
+    # How often readers check for a new snapshot
+    "reload_seconds": 5.0,
+    # Per-process metrics files
+    "metrics_dir": "/tmp/osc-dm-search-srv-metrics",
+    "metrics_interval_seconds": 5.0
+}
+
+
+def configure(conf: Optional[dict] = None) -> dict:
+    """
+    Get the multi-process settings from the "multiprocess" section
+    of the configuration
+    """
+    return {**DEFAULT_CONFIG, **(conf or {})}
+
+
+def bind_socket(host: str, port: int) -> socket.socket:
+    """
+    Create the listening socket shared by the reader processes
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.set_inheritable(True)
+    return sock
+
+
+def spawn(count: int, target: Callable, *args) -> List[multiprocessing.Process]:
+    """
+    Start processes running target(*args); processes are spawned
+    (not forked) so that no threads or clients are inherited
+    """
+    context = multiprocessing.get_context("spawn")
+    processes = []
+    for index in range(count):
+        process = context.Process(target=target, args=args, name=f"reader-{index}", daemon=True)
+        process.start()
+        processes.append(process)
+    logger.info(f"Started reader processes:{[process.pid for process in processes]}")
+    return processes
+
+
+def stop(processes: List[multiprocessing.Process], timeout: float = 10.0):
+    """
+    Terminate processes and wait for them to exit
+    """
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join(timeout)
+
+
+class MetricsPublisher():
+    """
+    Publish this process' metrics and aggregate those of all processes
+    """
+
+    def __init__(self, directory: str, role: str, registry: metrics.Registry = metrics.REGISTRY):
+        self.directory = directory
+        self.role = role
+        self.registry = registry
+        self.path = os.path.join(directory, f"{role}-{os.getpid()}.json")
+
+    def publish(self):
+        """
+        Write the metrics of this process
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as file:
+            json.dump({"pid": os.getpid(), "role": self.role, "metrics": self.registry.export()}, file)
+        os.replace(temporary, self.path)
+
+    async def run(self, interval_seconds: float):
+        """
+        Publish periodically (until cancelled)
+        """
+        while True:
+            try:
+                await asyncio.to_thread(self.publish)
+            except Exception as e:
+                logger.warning(f"Error publishing metrics, exception:{e}")
+            await asyncio.sleep(interval_seconds)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def collect(self) -> metrics.Registry:
+        """
+        Get a registry combining this process (live) with the last
+        published metrics of every other running process
+        """
+        exports = [self.registry.export()]
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if not name.endswith(".json") or path == self.path:
+                    continue
+                try:
+                    with open(path, "r") as file:
+                        published = json.load(file)
+                except (OSError, ValueError):
+                    continue
+                # Skip processes that have exited
+                if not _alive(published.get("pid")):
+                    continue
+                exports.append(published["metrics"])
+        return self.registry.merge(exports)
+
+
+def _alive(pid: Optional[int]) -> bool:
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
@@ -0,0 +1,226 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""
+Cross-encoder re-ranking.
+
+A cross-encoder reads the query and a candidate passage together,
+which ranks more precisely than comparing two independently computed
+embeddings but costs a model evaluation per candidate.  It is used
+as a second stage over the top candidates of the first (vector or
+lexical) stage: the (query, passage) pairs of a request are scored
+in one batched forward pass on the CPU, and if that does not finish
+within the time budget the first-stage order is kept.
+"""
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+import metrics
+from bgsexception import BgsException
+from lexical import tokenize
+
+logger = logging.getLogger(__name__)
+
+BACKEND_ONNX = "onnx"
+BACKEND_OVERLAP = "overlap"
+
+DEFAULT_CONFIG = {
+    # Load the model (requests can only re-rank if it is loaded)
+    "enabled": False,
+    # Re-rank requests that do not say otherwise
+    "default": True,
+    "backend": BACKEND_ONNX,
+    # Hugging Face model, and the directory holding its model.onnx and
+    # tokenizer.json (downloaded into it when missing)
+    "model_name": "cross-encoder/ms-marco-MiniLM-L-6-v2",
+    "model_path": "/app/models/ms-marco-MiniLM-L-6-v2",
+    # Candidates re-scored per query
+    "top_n": 20,
+    # Time allowed to re-score a request before falling back
+    "budget_ms": 100,
+    # Tokens per (query, passage) pair
+    "max_length": 256,
+    # Threads used by a forward pass
+    "threads": 2
+}
+
+OUTCOME_DONE = "done"
+OUTCOME_TIMEOUT = "timeout"
+OUTCOME_ERROR = "error"
+
+
+class OverlapCrossEncoder():
+    """
+    Deterministic pair scorer based upon the query terms found in
+    the passage.  Requires no model, so it is intended for tests and
+    benchmarks rather than ranking quality.
+    """
+
+    model_name = BACKEND_OVERLAP
+
+    def score(self, pairs: List[Tuple[str, str]]) -> List[float]:
+        scores = []
+        for query, passage in pairs:
+            terms = set(tokenize(query))
+            found = terms & set(tokenize(passage))
+            scores.append(len(found) / len(terms) if terms else 0.0)
+        return scores
+
+
+class OnnxCrossEncoder():
+    """
+    Cross-encoder exported to ONNX, run with onnxruntime
+    """
+
+    def __init__(self, model_name: str, model_path: str, max_length: int, threads: int):
+        try:
+            import onnxruntime
+            from tokenizers import Tokenizer
+        except ImportError as e:
+            raise BgsException("Re-ranking requires the 'onnxruntime' and 'tokenizers' packages", e)
+
+        self.model_name = model_name
+        model_file, tokenizer_file = _model_files(model_name, model_path)
+        self.tokenizer = Tokenizer.from_file(tokenizer_file)
+        self.tokenizer.enable_truncation(max_length=int(max_length))
+        self.tokenizer.enable_padding()
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = max(1, int(threads))
+        self.session = onnxruntime.InferenceSession(model_file, options, providers=["CPUExecutionProvider"])
+        self.inputs = {model_input.name for model_input in self.session.get_inputs()}
+        logger.info(f"Loaded cross-encoder model:{model_name} file:{model_file}")
+
+    def score(self, pairs: List[Tuple[str, str]]) -> List[float]:
+        encodings = self.tokenizer.encode_batch(pairs)
+        feeds = {
+            "input_ids": np.array([encoding.ids for encoding in encodings], dtype=np.int64),
+            "attention_mask": np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64),
+            "token_type_ids": np.array([encoding.type_ids for encoding in encodings], dtype=np.int64)
+        }
+        logits = self.session.run(None, {name: value for name, value in feeds.items() if name in self.inputs})[0]
+        # One relevance logit per pair
+        return np.asarray(logits, dtype=np.float32).reshape(len(pairs), -1)[:, 0].tolist()
+
+
+def _model_files(model_name: str, model_path: str) -> Tuple[str, str]:
+    """
+    Find (or download) the ONNX model and tokenizer of a model
+    """
+    candidates = [os.path.join(model_path, "model.onnx"), os.path.join(model_path, "onnx", "model.onnx")]
+    model_file = next((path for path in candidates if os.path.exists(path)), None)
+    tokenizer_file = os.path.join(model_path, "tokenizer.json")
+    if model_file and os.path.exists(tokenizer_file):
+        return model_file, tokenizer_file
+
+    try:
+        from huggingface_hub import hf_hub_download
+    except ImportError as e:
+        raise BgsException(f"Cross-encoder model not found path:{model_path}", e)
+    logger.info(f"Downloading cross-encoder model:{model_name} path:{model_path}")
+    model_file = hf_hub_download(model_name, "onnx/model.onnx", local_dir=model_path)
+    tokenizer_file = hf_hub_download(model_name, "tokenizer.json", local_dir=model_path)
+    return model_file, tokenizer_file
+
+
+def create_cross_encoder(conf: dict):
+    backend = conf["backend"]
+    if backend == BACKEND_ONNX:
+        return OnnxCrossEncoder(conf["model_name"], conf["model_path"], conf["max_length"], conf["threads"])
+    if backend == BACKEND_OVERLAP:
+        return OverlapCrossEncoder()
+    raise BgsException(f"Unknown re-ranking backend:{backend}")
+
+
+class Reranker():
+    """
+    Second-stage re-ranking of search candidates within a time budget
+    """
+
+    def __init__(self, conf: Optional[dict] = None, model=None):
+        self.conf = {**DEFAULT_CONFIG, **(conf or {})}
+        self.model = model or create_cross_encoder(self.conf)
+        # One forward pass at a time: requests queued behind a slow
+        # pass run out of budget and fall back instead of piling up
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="rerank")
+        self.lock = threading.Lock()
+        self.counts = {OUTCOME_DONE: 0, OUTCOME_TIMEOUT: 0, OUTCOME_ERROR: 0}
+
+    def options(self, overrides: Optional[dict] = None) -> dict:
+        """
+        Get the settings of a request (enabled, top_n, budget_ms)
+        from its overrides and the configured defaults
+        """
+        options = {"enabled": bool(self.conf["default"]), "top_n": int(self.conf["top_n"]),
+                   "budget_ms": float(self.conf["budget_ms"])}
+        options.update({key: value for key, value in (overrides or {}).items()
+                        if key in options and value is not None})
+        return options
+
+    def rerank(self, requests: List[Tuple[str, List[dict]]], top_n: int,
+               budget_ms: float) -> Optional[List[List[dict]]]:
+        """
+        Re-order the first top_n hits of each query by cross-encoder
+        score (which becomes their score); hits beyond top_n keep their
+        order after them
+
+        :param requests: (query, hits) pairs, hits with data and metadata
+        :return: re-ordered hits per query, or None if the budget ran
+            out or scoring failed (the caller keeps the original order)
+        """
+        pairs = [(query, _passage(hit)) for query, hits in requests for hit in hits[:top_n]]
+        if not pairs:
+            return [hits for _, hits in requests]
+
+        start = time.perf_counter()
+        future = self.executor.submit(self.model.score, pairs)
+        try:
+            scores = future.result(timeout=budget_ms / 1000.0)
+        except TimeoutError:
+            future.cancel()
+            metrics.RERANK_SECONDS.labels(outcome=OUTCOME_TIMEOUT).observe(budget_ms / 1000.0)
+            self._count(OUTCOME_TIMEOUT)
+            logger.warning(f"Re-ranking exceeded budget_ms:{budget_ms} pairs:{len(pairs)}, using first-stage order")
+            return None
+        except Exception as e:
+            self._count(OUTCOME_ERROR)
+            logger.error(f"Re-ranking failed, using first-stage order, exception:{e}")
+            return None
+        metrics.RERANK_SECONDS.labels(outcome=OUTCOME_DONE).observe(time.perf_counter() - start)
+        self._count(OUTCOME_DONE)
+
+        output = []
+        position = 0
+        for _, hits in requests:
+            head = [{**hit, "score": float(score)}
+                    for hit, score in zip(hits[:top_n], scores[position:position + len(hits[:top_n])])]
+            position += len(head)
+            head.sort(key=lambda hit: -hit["score"])
+            output.append(head + hits[top_n:])
+        return output
+
+    def stats(self) -> dict:
+        """
+        Get the model and the count of each outcome
+        """
+        with self.lock:
+            return {"model": self.model.model_name, **self.counts}
+
+    def _count(self, outcome: str):
+        with self.lock:
+            self.counts[outcome] += 1
+
+
+def _passage(hit: dict) -> str:
+    name = (hit.get("metadata") or {}).get("name", "")
+    return f"{name}. {hit['data']}" if name else hit["data"]
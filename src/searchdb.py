@@ -6,17 +6,211 @@
 #
 # Created: 2024-04-22 by graeham.broda@gmail.com
 import chromadb
-import chromadb.utils.embedding_functions as embedding_functions
 import utilities
 import constants
-# from bgsexception import BgsException
+import metrics
+import tracing
+import chunker
+from reranker import Reranker
+from embeddings import create_embedding_function
+from workerpool import WorkerPool, DEFAULT_WORKERS, DEFAULT_QUEUE_DEPTH
+from resultcache import ResultCache, DEFAULT_MAX_ENTRIES, DEFAULT_TTL_SECONDS
+from singleflight import SingleFlight
+from vectorstore import NumpyCollection, ENGINE_CHROMA, ENGINE_NUMPY, DEFAULT_CONFIG as DEFAULT_NUMPY
+from lexical import LexicalIndex, is_identifier, rrf, DEFAULT_K1, DEFAULT_B, DEFAULT_RRF_K
+from bgsexception import BgsException
 # from state import get_global
 
+import asyncio
+import contextlib
 import os
+import re
+import time
+import threading
 import uuid
+import base64
+import hashlib
+import json
 import logging
+from typing import Dict, List, Optional
 logger = logging.getLogger(__name__)
 
+# Origin of a document, recorded in its metadata so that
+# registrar synchronization never removes products that
+# were added directly through the API
+SOURCE_REGISTRAR = "registrar"
+SOURCE_API = "api"
+
+# Number of products embedded and written per collection call
+DEFAULT_BATCH_SIZE = 100
+
+# Artifact enrichment (osc-dm-proxy-srv) defaults
+DEFAULT_PROXY = {
+    "host": "osc-dm-proxy-srv",
+    "port": 8000,
+    "concurrency": 10,
+    "timeout_seconds": 5.0,
+    # Artifact lists per product uuid, kept briefly to absorb bursts
+    "artifact_cache": {
+        "enabled": True,
+        "max_entries": 1000,
+        "ttl_seconds": 30.0
+    }
+}
+
+
+# Retrieval modes: "vector" (dense only), "lexical" (BM25 only, no
+# embedding), "hybrid" (both, fused with reciprocal rank fusion) and
+# "auto" (lexical for identifier-like queries, otherwise hybrid)
+MODE_VECTOR = "vector"
+MODE_LEXICAL = "lexical"
+MODE_HYBRID = "hybrid"
+MODE_AUTO = "auto"
+MODES = (MODE_AUTO, MODE_HYBRID, MODE_VECTOR, MODE_LEXICAL)
+
+DEFAULT_RETRIEVAL = {
+    "mode": MODE_AUTO,
+    "rrf_k": DEFAULT_RRF_K,
+    "k1": DEFAULT_K1,
+    "b": DEFAULT_B
+}
+
+
+# Minimum time between saves of the NumPy engine (each writes the
+# whole collection); writes in between are saved by flush
+DEFAULT_SAVE_INTERVAL_SECONDS = 5.0
+
+
+# ANN (chromadb HNSW) index settings, fixed when a collection is
+# created (see SearchDb.rebuild); the defaults are those of chromadb
+DEFAULT_HNSW = {
+    "space": "l2",
+    "M": 16,
+    "construction_ef": 100,
+    "search_ef": 10
+}
+
+
+# Tags are stored as one boolean metadata key per tag so
+# that tag filters can be pushed down into the "where" clause
+TAG_PREFIX = "tag:"
+
+
+def content_hash(product: dict) -> str:
+    """
+    Compute a stable hash of the searchable content of a data product
+
+    :param product: data product (name, description, namespace, tags)
+    :return: hex digest identifying the content
+    """
+    content = json.dumps([product["name"], product["description"],
+                          product.get("namespace"), sorted(product.get("tags") or [])],
+                         ensure_ascii=False)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def encode_cursor(offset: int) -> str:
+    """
+    Encode a result offset as an opaque paging cursor
+    """
+    return base64.urlsafe_b64encode(json.dumps({"offset": offset}).encode("utf-8")).decode("utf-8")
+
+
+def decode_cursor(cursor: str) -> int:
+    """
+    Decode a paging cursor into a result offset
+
+    :raises ValueError: if the cursor is malformed
+    """
+    try:
+        offset = int(json.loads(base64.urlsafe_b64decode(cursor.encode("utf-8")))["offset"])
+    except Exception as e:
+        raise ValueError(f"Invalid cursor:{cursor}") from e
+    if offset < 0:
+        raise ValueError(f"Invalid cursor:{cursor}")
+    return offset
+
+
+def build_where(name: Optional[str] = None, namespace: Optional[str] = None,
+                tags: Optional[List[str]] = None) -> Optional[dict]:
+    """
+    Build a chromadb "where" clause from metadata filters
+
+    :param name: data product name (exact match)
+    :param namespace: data product namespace (exact match)
+    :param tags: tags that must all be present
+    :return: where clause, or None if there are no filters
+    """
+    conditions = []
+    if name:
+        conditions.append({"name": name})
+    if namespace:
+        conditions.append({"namespace": namespace})
+    for tag in tags or []:
+        conditions.append({TAG_PREFIX + tag: True})
+
+    if not conditions:
+        return None
+    if len(conditions) == 1:
+        return conditions[0]
+    return {"$and": conditions}
+
+
+def _metadata(product: dict, source: str) -> dict:
+    """
+    Build the collection metadata for a data product
+    """
+    meta = {
+        "name": product["name"],
+        "id": product["uuid"],
+        "hash": content_hash(product),
+        "source": source
+    }
+    if product.get("namespace"):
+        meta["namespace"] = product["namespace"]
+    tags = product.get("tags") or []
+    if tags:
+        meta["tags"] = ",".join(tags)
+        for tag in tags:
+            meta[TAG_PREFIX + tag] = True
+    return meta
+
+
+def _hnsw_metadata(hnsw: dict) -> dict:
+    """
+    Build chromadb collection metadata from HNSW settings
+    """
+    return {f"hnsw:{key}": value for key, value in hnsw.items()}
+
+
+def _hnsw_settings(metadata: Optional[dict]) -> dict:
+    """
+    Get the HNSW settings of a collection from its metadata
+    """
+    return {key: (metadata or {}).get(f"hnsw:{key}", value) for key, value in DEFAULT_HNSW.items()}
+
+
+def _query_key(generation: int, query: str, n_results: int, offset: int,
+               where: Optional[dict], min_score: Optional[float], mode: str,
+               rerank: Optional[dict] = None) -> tuple:
+    """
+    Build the result cache key for a query
+    """
+    normalized = " ".join(query.lower().split())
+    return (generation, normalized, n_results, offset,
+            json.dumps(where, sort_keys=True), min_score, mode,
+            json.dumps(rerank, sort_keys=True))
+
+
+def _public_metadata(meta: dict) -> dict:
+    """
+    Strip internal tag keys from metadata returned to clients
+    """
+    meta = {key: value for key, value in (meta or {}).items() if not key.startswith(TAG_PREFIX)}
+    if "tags" in meta:
+        meta["tags"] = meta["tags"].split(",")
+    return meta
+
 
 class SearchDb():
 
@@ -24,94 +218,877 @@ class SearchDb():
                  source_location: str,
                  collection_name: str,
                  persist: bool,
-                 registrar: dict
+                 registrar: dict,
+                 batch_size: int = DEFAULT_BATCH_SIZE,
+                 embedding: dict = None,
+                 query_workers: int = DEFAULT_WORKERS,
+                 query_queue_depth: int = DEFAULT_QUEUE_DEPTH,
+                 proxy: dict = None,
+                 result_cache: dict = None,
+                 retrieval: dict = None,
+                 engine: str = ENGINE_CHROMA,
+                 numpy: dict = None,
+                 chunking: dict = None,
+                 rerank: dict = None,
+                 hnsw: dict = None,
+                 coalesce: bool = True,
+                 read_only: bool = False
                  ):
 
-
-        if persist:
-            self.client = chromadb.PersistentClient(path=source_location)
-        else:
-            self.client = chromadb.Client()
         self.collection_name = collection_name
+        self.embeddings = create_embedding_function(embedding)
 
-        embeddings = embedding_functions.OpenAIEmbeddingFunction(
-            api_key=os.environ.get('OPENAI_API_KEY'),
-            model_name="text-embedding-ada-002"
-        )
+        # Vector storage: chromadb, or a NumPy matrix for small catalogs
+        self.engine = engine
+        self.source_location = source_location
+        self.persist = persist
+        self.numpy = {**DEFAULT_NUMPY, **(numpy or {})}
+        self.save_interval = float(self.numpy.pop("save_interval_seconds", DEFAULT_SAVE_INTERVAL_SECONDS))
+        self.saved: Optional[float] = None
+        self.unsaved = False
+        self.hnsw = {**DEFAULT_HNSW, **(hnsw or {})}
+        # A read-only database follows the files saved by another
+        # process (see reload), mapping rather than copying the vectors
+        self.read_only = read_only
+        self.loaded_files: Optional[tuple] = None
+        if read_only:
+            if engine != ENGINE_NUMPY or not persist:
+                raise ValueError("Only a persistent numpy engine database can be opened read-only")
+            self.numpy["mmap"] = True
+        if engine == ENGINE_CHROMA:
+            if persist:
+                self.client = chromadb.PersistentClient(path=source_location)
+            else:
+                self.client = chromadb.Client()
+        elif engine == ENGINE_NUMPY:
+            self.client = None
+        else:
+            raise ValueError(f"Unknown database engine:{engine}")
 
-        self.collection = self.client.get_or_create_collection(name=self.collection_name, embedding_function=embeddings)
+        # The collection is rebuilt into a new version (the collection
+        # name, then "<name>-v<n>") that is swapped in; writes are
+        # serialized, and journaled while a rebuild is copying
+        self.write_lock = threading.RLock()
+        self.rebuild_lock = threading.Lock()
+        self.journal: Optional[dict] = None
+        # Readers in flight per collection object, so that a rebuild
+        # drops the old collection only once they have finished
+        self.readers: Dict[int, int] = {}
+        self.readers_changed = threading.Condition()
+        self.collection_version = self._current_version()
+        if read_only:
+            # Loaded by reload, which tolerates files being replaced
+            self.collection = NumpyCollection(self._physical_name(self.collection_version))
+        else:
+            self.collection = self._open_collection(self.collection_version, self.hnsw)
         self.registrar = registrar
+        self.proxy = {**DEFAULT_PROXY, **(proxy or {})}
+        artifact_cache = {**DEFAULT_PROXY["artifact_cache"], **(self.proxy.get("artifact_cache") or {})}
+        self.artifact_cache = None
+        if artifact_cache["enabled"]:
+            self.artifact_cache = ResultCache(artifact_cache["max_entries"], artifact_cache["ttl_seconds"])
+        self.batch_size = max(1, int(batch_size))
+        # Distance function of the collection, used to derive scores
+        self.space = self.collection.metadata.get("hnsw:space", "l2") if self.collection.metadata else "l2"
+
+        # Index generation, bumped on every write so that cached
+        # results are invalidated exactly when the collection changes
+        self.generation = 0
+        self.generation_lock = threading.Lock()
+        self.result_cache = None
+        if result_cache and result_cache.get("enabled", False):
+            self.result_cache = ResultCache(result_cache.get("max_entries", DEFAULT_MAX_ENTRIES),
+                                            result_cache.get("ttl_seconds", DEFAULT_TTL_SECONDS))
+
+        # Lexical index kept alongside the collection (rebuilt
+        # from the collection when it is persistent)
+        self.retrieval = {**DEFAULT_RETRIEVAL, **(retrieval or {})}
+        if self.retrieval["mode"] not in MODES:
+            raise ValueError(f"Unknown retrieval mode:{self.retrieval['mode']}")
+        self.lexical = self._build_lexical(self.collection)
+
+        # Long descriptions stored as several chunk documents
+        self.chunking = chunker.configure(chunking)
+
+        # Optional second stage re-scoring the top candidates
+        self.reranker = Reranker(rerank) if rerank and rerank.get("enabled", False) else None
 
-    def add_data(self, _id: str, name: str, description: str):
+        # Queries (embedding and vector search) are blocking, so
+        # async callers run them on a bounded pool of threads
+        self.query_pool = WorkerPool("query", query_workers, query_queue_depth)
+
+        # Identical concurrent queries (and artifact lookups of the
+        # same product) share one in-flight computation
+        self.query_flight = SingleFlight("query") if coalesce else None
+        self.artifact_flight = SingleFlight("artifact") if coalesce else None
+
+        if read_only:
+            try:
+                self.reload()
+            except Exception as e:
+                logger.warning(f"Collection not loaded yet, exception:{e}")
+
+    def add_data(self, _id: str, name: str, description: str, source: str = SOURCE_API):
         '''
+        Add (or replace) a data product, keyed by its identifier
 
         :param id: identifier of the data product
         :param name: name of the data product
         :param description: description of the data product which will be searched on
+        :param source: origin of the data product (SOURCE_API or SOURCE_REGISTRAR)
         :return:
         '''
-        meta = {
+        product = {
+            "uuid": _id,
             "name": name,
-            "id": _id
+            "description": description
+        }
+        self.add_many([product], source=source)
+
+    def add_many(self, products: List[dict], source: str = SOURCE_API, batch_size: int = None) -> int:
+        '''
+        Add (or replace) many data products, keyed by their identifiers.
+        Products are written in batches, with one embedding call
+        and one collection write per batch.
+
+        :param products: data products (uuid, name, description, optional namespace and tags)
+        :param source: origin of the data products (SOURCE_API or SOURCE_REGISTRAR)
+        :param batch_size: products per batch (default: configured batch size)
+        :return: number of products written
+        '''
+        batch_size = max(1, int(batch_size)) if batch_size else self.batch_size
+        for start in range(0, len(products), batch_size):
+            batch = products[start:start + batch_size]
+            logger.info(f"Adding batch start:{start} size:{len(batch)}")
+            with tracing.span("searchdb.add", batch_size=len(batch)):
+                self._upsert(self.prepare(batch, source))
+        self._save()
+        return len(products)
+
+    def prepare(self, products: List[dict], source: str = SOURCE_API) -> dict:
+        '''
+        Embed data products, ready to be written (see write)
+
+        :param products: data products (uuid, name, description, optional namespace and tags)
+        :param source: origin of the data products (SOURCE_API or SOURCE_REGISTRAR)
+        :return: ids, documents, metadatas and embeddings
+        '''
+        if self.chunking["enabled"]:
+            ids, documents, metadatas = self._chunk(products, source)
+        else:
+            ids = [product["uuid"] for product in products]
+            documents = [product["description"] for product in products]
+            metadatas = [_metadata(product, source) for product in products]
+        with tracing.span("embed"), metrics.EMBEDDING_SECONDS.labels(operation="add").time():
+            embeddings = self.embeddings(documents)
+        return {
+            "ids": ids,
+            "documents": documents,
+            "metadatas": metadatas,
+            "embeddings": embeddings
         }
-        self.collection.add(
-            documents=description,
-            metadatas=meta,
-            ids=str(uuid.uuid4())
-        )
-
-    def search(self, query, n_results=1):
-
-        logger.info("query: {}".format(query))
-        results = self.collection.query(
-            query_texts=[query],
-            n_results=n_results
-        )
-        logger.info("results: {}".format(results))
-        res = []
-        if len(results) != 0:
-            for index, _ in enumerate(results["ids"][0]):
+
+    def _chunk(self, products: List[dict], source: str) -> tuple:
+        '''
+        Split descriptions into chunk documents ("<uuid>#<n>"), each
+        carrying the metadata of its product (so "id" is the parent)
+        '''
+        ids, documents, metadatas = [], [], []
+        for product in products:
+            meta = _metadata(product, source)
+            chunks = chunker.chunk_text(product["description"], int(self.chunking["size"]),
+                                        int(self.chunking["overlap"]))
+            for index, chunk in enumerate(chunks):
+                ids.append(chunker.chunk_id(product["uuid"], index))
+                documents.append(chunk)
+                metadatas.append({**meta, "chunk": index, "chunks": len(chunks)})
+        return ids, documents, metadatas
+
+    def write(self, prepared: dict):
+        '''
+        Write embedded data products (see prepare) to the collection
+        '''
+        self._upsert(prepared)
+        self._save()
+
+    def _upsert(self, prepared: dict):
+        with tracing.span("upsert"), self.write_lock:
+            # A product re-written with fewer chunks (or after chunking
+            # was switched on or off) leaves documents to remove
+            parents = list({meta["id"]: None for meta in prepared["metadatas"]})
+            stale = set(self._stored_ids(parents)) - set(prepared["ids"])
+            if stale:
+                self._write_delete(list(stale))
+                self.lexical.delete(list(stale))
+            self._write_upsert(prepared["ids"], prepared["embeddings"],
+                               prepared["metadatas"], prepared["documents"])
+            self._index_lexical(prepared["ids"], prepared["documents"], prepared["metadatas"])
+        self._bump_generation()
+
+    def manifest(self) -> Dict[str, dict]:
+        '''
+        Get the metadata of every data product in the collection
+
+        :return: dictionary of data product identifier to metadata
+        '''
+        return {(meta or {}).get("id", _id): meta for _id, meta in self._documents().items()}
+
+    def _documents(self) -> Dict[str, dict]:
+        '''
+        Get the metadata of every document (product or chunk)
+        '''
+        with self._reading() as collection:
+            results = collection.get(include=["metadatas"])
+        return dict(zip(results["ids"], results["metadatas"]))
+
+    def _stored_ids(self, products: List[str]) -> List[str]:
+        '''
+        Get the identifiers of the documents (whole or chunked) stored
+        for data products; the first chunk records the chunk count
+        '''
+        if not products:
+            return []
+        with self._reading() as collection:
+            found = collection.get(ids=products + [chunker.chunk_id(_id, 0) for _id in products],
+                                   include=["metadatas"])
+        ids = []
+        for _id, meta in zip(found["ids"], found["metadatas"]):
+            ids.append(_id)
+            meta = meta or {}
+            ids.extend(chunker.chunk_id(meta["id"], index) for index in range(1, int(meta.get("chunks", 1))))
+        return ids
+
+    def delete(self, ids: List[str]):
+        '''
+        Remove data products (and all their chunks) from the collection
+
+        :param ids: identifiers of the data products to remove
+        '''
+        self._delete_documents(self._stored_ids(ids))
+
+    def _delete_documents(self, ids: List[str]):
+        if ids:
+            self._write_delete(ids)
+            self.lexical.delete(ids)
+            self._bump_generation()
+            self._save()
+
+    def _save(self):
+        # chromadb persists on write, the NumPy engine is saved explicitly
+        # (at most once per save interval, see flush)
+        if self.engine == ENGINE_NUMPY:
+            with self.write_lock:
+                self.unsaved = True
+                if self.saved is None or time.monotonic() - self.saved >= self.save_interval:
+                    self.flush()
+
+    def flush(self):
+        '''
+        Save writes that were not saved yet (NumPy engine)
+        '''
+        with self.write_lock:
+            if self.engine == ENGINE_NUMPY and self.unsaved:
+                self.collection.save()
+                self.saved = time.monotonic()
+                self.unsaved = False
+
+    def _write_upsert(self, ids: List[str], embeddings, metadatas: List[dict], documents: List[str]):
+        with self.write_lock:
+            self.collection.upsert(ids=ids, embeddings=embeddings, metadatas=metadatas, documents=documents)
+            if self.journal is not None:
+                self.journal["deleted"].difference_update(ids)
+                self.journal["upserted"].update(ids)
+
+    def _write_delete(self, ids: List[str]):
+        with self.write_lock:
+            self.collection.delete(ids=ids)
+            if self.journal is not None:
+                self.journal["upserted"].difference_update(ids)
+                self.journal["deleted"].update(ids)
+
+    #####
+    # COLLECTION VERSIONS AND REBUILD
+    #####
+
+    def _physical_name(self, version: int) -> str:
+        return self.collection_name if version == 0 else f"{self.collection_name}-v{version}"
+
+    def _versions(self) -> List[int]:
+        '''
+        Get the versions of the collection that exist
+        '''
+        if self.engine == ENGINE_CHROMA:
+            names = [collection.name for collection in self.client.list_collections()]
+        elif self.persist and os.path.isdir(self.source_location):
+            names = [name[:-len(".json")] for name in os.listdir(self.source_location) if name.endswith(".json")]
+        else:
+            names = []
+        pattern = re.compile(re.escape(self.collection_name) + r"(?:-v(\d+))?")
+        versions = []
+        for name in names:
+            match = pattern.fullmatch(name)
+            if match:
+                versions.append(int(match.group(1) or 0))
+        return sorted(versions)
+
+    def _current_version(self) -> int:
+        '''
+        Get the version in use.  The previous version is dropped as
+        soon as a rebuild is swapped in, so any newer version is a
+        rebuild that did not finish and is dropped.
+        '''
+        versions = self._versions()
+        if not versions:
+            return 0
+        # The writer owns the files (a newer version may be its rebuild in progress)
+        if self.read_only:
+            return versions[0]
+        for version in versions[1:]:
+            logger.warning(f"Dropping unfinished rebuild collection:{self._physical_name(version)}")
+            self._drop_collection(self._open_collection(version, self.hnsw), version)
+        return versions[0]
+
+    def _open_collection(self, version: int, hnsw: dict):
+        name = self._physical_name(version)
+        if self.engine == ENGINE_NUMPY:
+            path = os.path.join(self.source_location, name) if self.persist else None
+            return NumpyCollection(name, path=path, **self.numpy)
+        try:
+            collection = self.client.get_collection(name=name, embedding_function=self.embeddings)
+        except ValueError:
+            return self.client.create_collection(name=name, metadata=_hnsw_metadata(hnsw),
+                                                 embedding_function=self.embeddings)
+        # Settings only apply to the collection they are created with
+        current = _hnsw_settings(collection.metadata)
+        if current != hnsw:
+            logger.warning(f"Collection:{name} has hnsw:{current}, configured:{hnsw}; "
+                           f"rebuild the collection to apply the configuration")
+        return collection
+
+    def _drop_collection(self, collection, version: int):
+        if self.engine == ENGINE_NUMPY:
+            collection.drop()
+        else:
+            self.client.delete_collection(name=self._physical_name(version))
+
+    def rebuild(self, hnsw: Optional[dict] = None) -> dict:
+        '''
+        Rebuild the collection into a new collection and swap it in,
+        which applies new HNSW settings and compacts the index
+        (entries of deleted and replaced documents are not copied).
+
+        Runs online: queries use the current collection until the
+        swap and writes made while copying are replayed (from a
+        journal of written and deleted ids) before it.
+
+        :param hnsw: HNSW settings overriding the current ones
+        :return: rebuild statistics
+        :raises BgsException: if a rebuild is already running
+        '''
+        if not self.rebuild_lock.acquire(blocking=False):
+            raise BgsException("A rebuild is already running")
+        try:
+            start = time.perf_counter()
+            settings = {**self.hnsw, **(hnsw or {})}
+            with self.write_lock:
+                source = self.collection
+                version = self.collection_version + 1
+                target = self._open_collection(version, settings)
+                self.journal = {"upserted": set(), "deleted": set()}
+            logger.info(f"Rebuilding collection:{self._physical_name(self.collection_version)} "
+                        f"into:{self._physical_name(version)} hnsw:{settings}")
+            try:
+                copied = self._copy(source, target, source.get(include=[])["ids"])
+                with self.write_lock:
+                    if self.journal["deleted"]:
+                        target.delete(ids=list(self.journal["deleted"]))
+                    replayed = self._copy(source, target, list(self.journal["upserted"]))
+                    if self.engine == ENGINE_NUMPY:
+                        target.save()
+                    # Swap, then wait for the queries still running on the
+                    # old version; it is dropped before writes resume, so
+                    # that a restart can tell the new version is complete
+                    with self.readers_changed:
+                        self.collection = target
+                        self.collection_version = version
+                        self.hnsw = settings
+                        self.space = target.metadata.get("hnsw:space", "l2") if target.metadata else "l2"
+                        self.readers_changed.wait_for(lambda: id(source) not in self.readers)
+                    self._drop_collection(source, version - 1)
+                    self.journal = None
+                self._bump_generation()
+            except Exception:
+                with self.write_lock:
+                    self.journal = None
+                self._drop_collection(target, version)
+                raise
+            stats = {
+                "collection": self._physical_name(version),
+                "documents": self.collection.count(),
+                "copied": copied,
+                "replayed": replayed,
+                "hnsw": settings,
+                "seconds": round(time.perf_counter() - start, 3)
+            }
+            logger.info(f"Rebuilt collection, stats:{stats}")
+            return stats
+        finally:
+            self.rebuild_lock.release()
+
+    @contextlib.contextmanager
+    def _reading(self):
+        '''
+        Use the current collection for reading, keeping it from being
+        dropped by a rebuild until done
+        '''
+        with self.readers_changed:
+            collection = self.collection
+            self.readers[id(collection)] = self.readers.get(id(collection), 0) + 1
+        try:
+            yield collection
+        finally:
+            with self.readers_changed:
+                self.readers[id(collection)] -= 1
+                if not self.readers[id(collection)]:
+                    del self.readers[id(collection)]
+                    self.readers_changed.notify_all()
+
+    def _copy(self, source, target, ids: List[str]) -> int:
+        '''
+        Copy documents, with their embeddings, between collections
+        '''
+        for start in range(0, len(ids), self.batch_size):
+            batch = source.get(ids=ids[start:start + self.batch_size],
+                               include=["embeddings", "documents", "metadatas"])
+            if batch["ids"]:
+                target.upsert(ids=batch["ids"], embeddings=batch["embeddings"],
+                              metadatas=batch["metadatas"], documents=batch["documents"])
+        return len(ids)
+
+    def reload(self) -> bool:
+        '''
+        Bring a read-only database up to date with the files last
+        saved by the writer.  The new collection (with its lexical
+        index) is loaded aside and swapped in; queries in flight
+        finish on the previous one.
+
+        :return: whether anything changed
+        :raises ValueError: if the files are being replaced (retry later)
+        '''
+        version = self._current_version()
+        signature = self._file_signature(version)
+        if signature is None or (version, signature) == self.loaded_files:
+            return False
+        collection = self._open_collection(version, self.hnsw)
+        if self._file_signature(version) != signature:
+            raise ValueError(f"Collection:{collection.name} changed while loading")
+        lexical = self._build_lexical(collection)
+        with self.readers_changed:
+            self.collection = collection
+            self.collection_version = version
+            self.lexical = lexical
+        self.loaded_files = (version, signature)
+        self._bump_generation()
+        logger.info(f"Reloaded collection:{collection.name} documents:{collection.count()}")
+        return True
+
+    def _file_signature(self, version: int) -> Optional[tuple]:
+        '''
+        Identify the saved files of a numpy collection version (None
+        if they do not exist), to tell when they have been replaced
+        '''
+        signature = []
+        for suffix in (".npy", ".json"):
+            try:
+                info = os.stat(os.path.join(self.source_location, self._physical_name(version)) + suffix)
+            except OSError:
+                return None
+            signature.append((info.st_ino, info.st_mtime_ns, info.st_size))
+        return tuple(signature)
+
+    def _build_lexical(self, collection) -> LexicalIndex:
+        lexical = LexicalIndex(self.retrieval["k1"], self.retrieval["b"])
+        results = collection.get(include=["documents", "metadatas"])
+        if results["ids"]:
+            self._index_lexical(results["ids"], results["documents"], results["metadatas"], lexical)
+            logger.info(f"Rebuilt lexical index, documents:{lexical.count()}")
+        return lexical
+
+    def _index_lexical(self, ids: List[str], documents: List[str], metadatas: List[dict],
+                       lexical: Optional[LexicalIndex] = None):
+        texts = [f"{(meta or {}).get('name', '')} {document}" for document, meta in zip(documents, metadatas)]
+        (lexical or self.lexical).add(ids, texts, documents, metadatas)
+
+    def export(self) -> dict:
+        '''
+        Get every document of the collection, including embeddings
+
+        :return: dictionary with ids, documents, metadatas and embeddings
+        '''
+        with self._reading() as collection:
+            return collection.get(include=["documents", "metadatas", "embeddings"])
+
+    def restore(self, ids: List[str], embeddings, documents: List[str], metadatas: List[dict],
+                replace: bool = False):
+        '''
+        Write documents with precomputed embeddings (e.g. from a snapshot)
+
+        :param replace: make the collection match the documents exactly:
+            unchanged documents (same content hash) are skipped and
+            documents that are not given are removed
+        '''
+        if replace:
+            documents_before = self._documents()
+            self._delete_documents(list(set(documents_before) - set(ids)))
+            changed = [index for index, (_id, meta) in enumerate(zip(ids, metadatas))
+                       if (documents_before.get(_id) or {}).get("hash") != (meta or {}).get("hash")]
+            if not changed:
+                return
+            ids = [ids[index] for index in changed]
+            embeddings = [embeddings[index] for index in changed]
+            documents = [documents[index] for index in changed]
+            metadatas = [metadatas[index] for index in changed]
+
+        for start in range(0, len(ids), self.batch_size):
+            end = start + self.batch_size
+            self._write_upsert(ids[start:end], [list(map(float, vector)) for vector in embeddings[start:end]],
+                               metadatas[start:end], documents[start:end])
+            self._index_lexical(ids[start:end], documents[start:end], metadatas[start:end])
+        self._bump_generation()
+        self._save()
+
+    def model_name(self) -> Optional[str]:
+        '''
+        Get the name of the embedding model
+        '''
+        return getattr(self.embeddings, "model_name", None)
+
+    def _bump_generation(self):
+        with self.generation_lock:
+            self.generation += 1
+        # Entries of older generations can never be hit again
+        if self.result_cache:
+            self.result_cache.clear()
+
+    def embedding_stats(self) -> dict:
+        '''
+        Get embedding cache counters (empty if caching is disabled)
+        '''
+        stats = getattr(self.embeddings, "stats", None)
+        return stats() if stats else {}
+
+    def rerank_stats(self) -> dict:
+        '''
+        Get re-ranking counters (empty if re-ranking is disabled)
+        '''
+        return self.reranker.stats() if self.reranker else {}
+
+    def result_stats(self) -> dict:
+        '''
+        Get result cache counters (empty if caching is disabled)
+        '''
+        if not self.result_cache:
+            return {}
+        return {"generation": self.generation, **self.result_cache.stats()}
+
+    def artifact_stats(self) -> dict:
+        """
+        Get artifact cache counters (empty if caching is disabled)
+        """
+        if not self.artifact_cache:
+            return {}
+        return self.artifact_cache.stats()
+
+    def coalesce_stats(self) -> dict:
+        """
+        Get request coalescing counters (empty if coalescing is disabled)
+        """
+        if not self.query_flight:
+            return {}
+        return {"query": self.query_flight.stats(), "artifact": self.artifact_flight.stats()}
+
+    def vector_stats(self) -> dict:
+        '''
+        Get vector storage information
+        '''
+        with self._reading() as collection:
+            if self.engine == ENGINE_NUMPY:
+                return {**collection.stats(), "collection": collection.name}
+            return {"engine": self.engine, "space": _hnsw_settings(collection.metadata)["space"],
+                    "size": collection.count(), "collection": collection.name,
+                    "hnsw": _hnsw_settings(collection.metadata)}
+
+    def count(self) -> int:
+        '''
+        Get the number of documents in the collection
+        '''
+        with self._reading() as collection:
+            return collection.count()
+
+    def search(self, query, n_results=1, offset=0, where=None, min_score=None, mode=None, rerank=None):
+        '''
+        Execute a search
+
+        :param query: natural language query
+        :param n_results: maximum number of results to return (k)
+        :param offset: number of leading results to skip (paging)
+        :param where: chromadb "where" clause (see build_where)
+        :param min_score: drop results whose first-stage score is below
+            this value: the vector similarity in "vector" and "hybrid"
+            mode (applied before fusion, so results found only
+            lexically are kept) and the BM25 score in "lexical" mode
+        :param mode: retrieval mode (MODES, default: configured mode)
+        :param rerank: re-ranking settings of the request (enabled,
+            top_n, budget_ms), overriding the configured ones
+        :return: results with data, metadata, distance and score
+        '''
+        return self.search_many([query], n_results=n_results, offset=offset,
+                                where=where, min_score=min_score, mode=mode, rerank=rerank)[0]
+
+    def search_many(self, queries: List[str], n_results=1, offset=0, where=None, min_score=None, mode=None,
+                    rerank=None):
+        '''
+        Execute several searches with one embedding call and one
+        collection query.  Queries answered by the result cache or
+        by the lexical index alone are not embedded or queried.
+
+        The score of a result depends on the mode: similarity for
+        "vector", BM25 for "lexical" and the fused (RRF) score for
+        "hybrid"; distance is None for results found only lexically.
+        With chunking, chunk hits are aggregated into one result per
+        data product whose data is its best-matching passage.  With
+        re-ranking, the top candidates of all queries are re-scored in
+        one cross-encoder pass and the score is the cross-encoder score
+        (the first-stage order and scores are kept if it runs out of
+        time).
+
+        :param queries: natural language queries
+        :return: list of results (as returned by search) per query
+        '''
+        mode = mode or self.retrieval["mode"]
+        if mode not in MODES:
+            raise ValueError(f"Unknown retrieval mode:{mode}")
+        logger.info("queries: {} n_results:{} offset:{} where:{} mode:{}".format(
+            queries, n_results, offset, where, mode))
+        rerank = self.reranker.options(rerank) if self.reranker else None
+        if rerank and not rerank["enabled"]:
+            rerank = None
+        generation = self.generation
+        keys = [_query_key(generation, query, n_results, offset, where, min_score, mode, rerank)
+                for query in queries]
+        output = [self.result_cache.get(key) if self.result_cache else None for key in keys]
+        missing = [position for position, res in enumerate(output) if res is None]
+        depth = offset + n_results
+        # Re-ranking needs its candidates even when fewer results are asked for
+        candidates = max(depth, int(rerank["top_n"])) if rerank else depth
+        chunked = self.chunking["enabled"]
+        # Several chunks of one product can fill the top ranks
+        retrieve = candidates * max(1, int(self.chunking["oversample"])) if chunked else candidates
+
+        # Lexical retrieval first: identifier-like queries that match
+        # lexically are answered without an embedding
+        modes = {}
+        lexical_hits = {}
+        for position in missing:
+            query_mode = mode
+            if mode == MODE_AUTO:
+                query_mode = MODE_LEXICAL if is_identifier(queries[position]) else MODE_HYBRID
+            if query_mode != MODE_VECTOR:
+                with tracing.span("lexical"), metrics.LEXICAL_QUERY_SECONDS.time():
+                    lexical_hits[position] = self.lexical.search(queries[position], retrieve, where)
+                if chunked:
+                    lexical_hits[position] = chunker.aggregate(lexical_hits[position], self.chunking["aggregate"])
+                if query_mode == MODE_LEXICAL and min_score is not None:
+                    lexical_hits[position] = [hit for hit in lexical_hits[position] if hit["score"] >= min_score]
+                if mode == MODE_AUTO and query_mode == MODE_LEXICAL and not lexical_hits[position]:
+                    query_mode = MODE_HYBRID
+            modes[position] = query_mode
+
+        vector_hits = {}
+        vector_positions = [position for position in missing if modes[position] != MODE_LEXICAL]
+        if vector_positions:
+            with tracing.span("embed", queries=len(vector_positions)), \
+                    metrics.EMBEDDING_SECONDS.labels(operation="query").time():
+                embeddings = self.embeddings([queries[position] for position in vector_positions])
+            with tracing.span("ann", n_results=retrieve), metrics.VECTOR_QUERY_SECONDS.time(), \
+                    self._reading() as collection:
+                results = collection.query(
+                    query_embeddings=embeddings,
+                    n_results=retrieve,
+                    where=where,
+                    include=["documents", "metadatas", "distances"]
+                )
+                space = _hnsw_settings(collection.metadata)["space"]
+            logger.info("results: {}".format(results))
+            for row, position in enumerate(vector_positions):
+                vector_hits[position] = [{
+                    "id": _id,
+                    "data": results["documents"][row][index],
+                    "metadata": results["metadatas"][row][index],
+                    "distance": results["distances"][row][index],
+                    "score": self.score(results["distances"][row][index], space)
+                } for index, _id in enumerate(results["ids"][row])]
+                if chunked:
+                    vector_hits[position] = chunker.aggregate(vector_hits[position], self.chunking["aggregate"])
+                # Fused (RRF) and re-ranked scores are not similarities,
+                # so the threshold applies to the similarity beforehand
+                if min_score is not None:
+                    vector_hits[position] = [hit for hit in vector_hits[position] if hit["score"] >= min_score]
+
+        ranked = {}
+        for position in missing:
+            if modes[position] == MODE_LEXICAL:
+                ranked[position] = lexical_hits[position]
+            elif modes[position] == MODE_VECTOR:
+                ranked[position] = vector_hits[position]
+            else:
+                ranked[position] = self._fuse(vector_hits[position], lexical_hits[position])
+
+        cacheable = True
+        if rerank and missing:
+            with tracing.span("rerank", queries=len(missing), top_n=rerank["top_n"]):
+                reranked = self.reranker.rerank([(queries[position], ranked[position]) for position in missing],
+                                                int(rerank["top_n"]), float(rerank["budget_ms"]))
+            if reranked is None:
+                # Never serve a fallback from the cache
+                cacheable = False
+            else:
+                ranked.update(zip(missing, reranked))
+
+        for position in missing:
+            hits = ranked[position]
+            res = []
+            for hit in hits[offset:depth]:
                 structured_result = {
-                    "data": results["documents"][0][index],
-                    "metadata": results["metadatas"][0][index]
+                    "data": hit["data"],
+                    "metadata": _public_metadata(hit["metadata"]),
+                    "distance": hit.get("distance"),
+                    "score": hit["score"]
                 }
                 res.append(structured_result)
+            output[position] = res
+            if self.result_cache and cacheable:
+                self.result_cache.put(keys[position], res)
+
+        logger.info("output res: {}".format(output))
+        return output
+
+    def _fuse(self, vector_hits: List[dict], lexical_hits: List[dict]) -> List[dict]:
+        '''
+        Merge vector and lexical results with reciprocal rank fusion
+        '''
+        scores = rrf([[hit["id"] for hit in vector_hits], [hit["id"] for hit in lexical_hits]],
+                     k=self.retrieval["rrf_k"])
+        hits = {hit["id"]: hit for hit in lexical_hits}
+        # Prefer the vector hit, which carries the distance
+        hits.update({hit["id"]: hit for hit in vector_hits})
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return [{**hits[_id], "score": score} for _id, score in ranked]
 
-        logger.info("output res: {}".format(res))
-        return res
+    def score(self, distance: float, space: Optional[str] = None) -> float:
+        '''
+        Convert a distance into a similarity score (higher is better),
+        which is the cosine similarity for normalized embeddings
+
+        :param space: distance function (default: that of the collection)
+        '''
+        if (space or self.space) == "l2":
+            return 1.0 - distance / 2.0
+        return 1.0 - distance
+
+    async def asearch(self, query, n_results=1, offset=0, where=None, min_score=None, mode=None, rerank=None):
+        '''
+        Execute a search without blocking the event loop.  Concurrent
+        identical searches (same normalized query and options) are
+        executed once.
+
+        :raises BgsBusyException: if the query pool is at capacity
+        '''
+        if not self.query_flight:
+            return await self.query_pool.run(self.search, query, n_results=n_results, offset=offset,
+                                             where=where, min_score=min_score, mode=mode, rerank=rerank)
+        key = _query_key(self.generation, query, n_results, offset, where, min_score,
+                         mode or self.retrieval["mode"], rerank)
+        return await self.query_flight.do(key, self.query_pool.run, self.search, query, n_results=n_results,
+                                          offset=offset, where=where, min_score=min_score, mode=mode,
+                                          rerank=rerank)
+
+    async def asearch_many(self, queries: List[str], n_results=1, offset=0, where=None, min_score=None,
+                           mode=None, rerank=None):
+        '''
+        Execute several searches without blocking the event loop
 
-    # async def search_artifacts(self, query, n_results=1):
-    async def search_artifacts(self, query, n_results=1):
-        results = self.search(query, n_results=n_results)
+        :raises BgsBusyException: if the query pool is at capacity
+        '''
+        return await self.query_pool.run(self.search_many, queries, n_results=n_results, offset=offset,
+                                         where=where, min_score=min_score, mode=mode, rerank=rerank)
+
+    async def search_artifacts(self, query, n_results=1, offset=0, where=None, min_score=None, mode=None,
+                               rerank=None):
+        '''
+        Execute a search and enrich each result with its artifacts.
+
+        Artifact lookups run concurrently (bounded by the proxy
+        concurrency setting) with a per-call timeout; a failed lookup
+        yields an empty artifact list and an "error" on that result
+        rather than failing the whole request.  Artifact lists are
+        cached briefly per product, and concurrent lookups of the same
+        product share one proxy call.
+        '''
+        results = await self.asearch(query, n_results=n_results, offset=offset,
+                                     where=where, min_score=min_score, mode=mode, rerank=rerank)
 
         if len(results) == 0:
             return results
 
-        res = []
-        for result in results:
-            host = "osc-dm-proxy-srv"
-            port = 8000
-            _uuid = result["metadata"]["id"]
-            service = f"/api/dataproduct/discovery/uuid/{_uuid}/artifacts"
-            logger.info(f"service being called: {service}")
-            method = "GET"
-
-            headers = {
-                constants.HEADER_USERNAME: constants.USERNAME,
-                constants.HEADER_CORRELATION_ID: str(uuid.uuid4())
-            }
-            response = await utilities.httprequest(
-                host, port, service, method, headers=headers)
-            formatted = []
-            for element in response:
-                logger.info(f"artifact: {element}")
-                formatted.append(element)
+        semaphore = asyncio.Semaphore(max(1, int(self.proxy["concurrency"])))
+        with tracing.span("enrich", results=len(results)), metrics.ARTIFACT_FANOUT_SECONDS.time():
+            await asyncio.gather(*[self._enrich(result, semaphore) for result in results])
 
-            logger.info("output from artifact query: {}".format(response))
-            result["artifact"] = formatted
-            res.append(result)
-        #  search the artifacts for this uuid
+        logger.info("final output: {}".format(results))
+        return results
 
+    async def _enrich(self, result: dict, semaphore: asyncio.Semaphore):
+        '''
+        Add the artifacts of the data product to a search result
+        '''
+        _uuid = result["metadata"]["id"]
+        try:
+            artifacts = self.artifact_cache.get(_uuid) if self.artifact_cache else None
+            if artifacts is None:
+                async with semaphore:
+                    if self.artifact_flight:
+                        artifacts = await self.artifact_flight.do(_uuid, self._artifacts, _uuid)
+                    else:
+                        artifacts = await self._artifacts(_uuid)
+            result["artifact"] = artifacts
+        except Exception as e:
+            msg = f"Artifact lookup failed for uuid:{_uuid}, exception:{e!r}"
+            logger.error(msg)
+            result["artifact"] = []
+            result["error"] = msg
 
-        logger.info("final output: {}".format(res))
-        return results
+    async def _artifacts(self, _uuid: str) -> list:
+        '''
+        Get the artifacts of a data product from the proxy (caching
+        them if successful)
+        '''
+        host = self.proxy["host"]
+        port = self.proxy["port"]
+        timeout = float(self.proxy["timeout_seconds"])
+        service = f"/api/dataproduct/discovery/uuid/{_uuid}/artifacts"
+        logger.info(f"service being called: {service}")
+        method = "GET"
+
+        headers = {
+            constants.HEADER_USERNAME: constants.USERNAME,
+            constants.HEADER_CORRELATION_ID: tracing.correlation_id() or str(uuid.uuid4())
+        }
+        response = await asyncio.wait_for(
+            utilities.httprequest(host, port, service, method, headers=headers, timeout=timeout),
+            timeout=timeout)
+        logger.info("output from artifact query: {}".format(response))
+        artifacts = list(response)
+        if self.artifact_cache:
+            self.artifact_cache.put(_uuid, artifacts)
+        return artifacts
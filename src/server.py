@@ -6,20 +6,29 @@
 #
 # Created: 2024-04-22 by graeham.broda@gmail.com
 # Library imports
+import asyncio
 import logging
-from typing import Optional
-import uuid
+import json
+import os
+import time
+from typing import List, Optional
 
 import uvicorn as uvicorn
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
+from pydantic import ValidationError
 import yaml
 
 # Project imports
-from models import AddData, QueryData
+from models import AddData, QueryData, QueryOptions, BatchQueryData, RebuildData
 import utilities
+import httpclient
+import tracing
 import state
+import middleware
+import metrics
 from middleware import LoggingMiddleware
-import constants
+from bgsexception import BgsBusyException
 
 # Set up logging
 LOGGING_FORMAT = \
@@ -41,8 +50,48 @@ DEFAULT_PORT = 8000
 STATE_CONFIG="state-config"
 
 # Setup database instance
-from searchdb import SearchDb
+from searchdb import SearchDb, DEFAULT_BATCH_SIZE, build_where, encode_cursor, decode_cursor
+from workerpool import DEFAULT_WORKERS, DEFAULT_QUEUE_DEPTH
+from sync import SyncEngine
+from vectorstore import ENGINE_CHROMA, ENGINE_NUMPY
+import snapshot
+from ingestion import IngestionPipeline
+from loader import RegistrarLoader
+import multiprocess
+from multiprocess import MetricsPublisher, ROLE_SINGLE, ROLE_WRITER, ROLE_READER
 db: SearchDb = None
+sync_engine: SyncEngine = None
+pipeline: IngestionPipeline = None
+loader: RegistrarLoader = None
+# Process role (see multiprocess) and metrics shared across processes
+role = ROLE_SINGLE
+publisher: MetricsPublisher = None
+# Ready to serve queries (restored from a snapshot or loaded from the registrar)
+ready = False
+# Collection generation captured in the last snapshot, and when it was saved
+snapshot_generation = None
+snapshot_saved = None
+# Collection rebuild in progress, and the status of the last one
+rebuild_task: Optional[asyncio.Task] = None
+rebuild_status = {"status": "idle"}
+
+
+#####
+# ERRORS
+#####
+
+
+@app.exception_handler(BgsBusyException)
+async def busy_exception_handler(request: Request, e: BgsBusyException):
+    """
+    Reject requests when the service is at capacity
+    """
+    logger.warning(f"Service busy url:{request.url.path} exception:{e}")
+    return JSONResponse(
+        status_code=e.status_code,
+        content={"detail": str(e)},
+        headers={"Retry-After": str(e.retry_after)}
+    )
 
 
 #####
@@ -52,20 +101,64 @@ db: SearchDb = None
 
 @app.post(ENDPOINT_PREFIX + "/add")
 async def add(
-        params: AddData
+        params: AddData,
+        request: Request
 ):
     """
-    Add data to the database
+    Queue data to be added to the database, returning the
+    job that tracks it (see /jobs/{job_id})
     """
-    print("in server")
+    if role == ROLE_READER:
+        return await _forward(request)
     logger.info(f"Received request with query:{params}")
+    job = pipeline.submit([params.model_dump()])
+    logger.info(f"data queued, job:{job['id']}")
+    return JSONResponse(status_code=202, content=job)
+
+
+@app.post(ENDPOINT_PREFIX + "/add/bulk")
+async def add_bulk(
+        request: Request
+):
+    """
+    Add many data products to the database in batches.  The body
+    is either a JSON array of products or NDJSON (one product per line)
+    """
+    if role == ROLE_READER:
+        return await _forward(request)
+    body = await request.body()
     try:
-        db.add_data(params.uuid, params.name, params.description)
-        logger.info("data added")
-    except Exception as e:
-        msg = f"Unknown exception:{e}"
+        products = _parse_products(body)
+    except (ValueError, ValidationError) as e:
+        msg = f"Invalid request body:{e}"
         logger.error(msg)
-        raise HTTPException(status_code=500, detail=msg)
+        raise HTTPException(status_code=400, detail=msg)
+
+    logger.info(f"Received bulk request with products:{len(products)}")
+    try:
+        job = pipeline.submit([product.model_dump() for product in products])
+    except ValueError as e:
+        msg = f"Request too large:{e}"
+        logger.error(msg)
+        raise HTTPException(status_code=413, detail=msg)
+    logger.info(f"data queued, job:{job['id']} count:{len(products)}")
+    return JSONResponse(status_code=202, content=job)
+
+
+@app.get(ENDPOINT_PREFIX + "/jobs/{job_id}")
+async def job_get(
+        job_id: str,
+        request: Request
+):
+    """
+    Get the status of an ingestion job
+    """
+    if role == ROLE_READER:
+        return await _forward(request)
+    job = pipeline.job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job:{job_id}")
+    return job
 
 
 @app.post(ENDPOINT_PREFIX + "/query")
@@ -76,15 +169,44 @@ async def search(
     Execute a search based upon the provided query
     """
     logger.info(f"Received request with query:{params.query}")
+    offset, where = _query_options(params)
     try:
-        res = db.search(params.query)
+        res = await db.asearch(params.query, n_results=params.k, offset=offset,
+                               where=where, min_score=params.min_score, mode=params.mode,
+                               rerank=_rerank_options(params))
+    except BgsBusyException:
+        raise
+    except Exception as e:
+        msg = f"Unknown exception:{e}"
+        logger.error(msg)
+        raise HTTPException(status_code=500, detail=msg)
+
+    return _page(res, params, offset)
+
+
+@app.post(ENDPOINT_PREFIX + "/query/batch")
+async def search_batch(
+        params: BatchQueryData
+):
+    """
+    Execute several searches in one call, returning results per query
+    """
+    logger.info(f"Received batch request with queries:{len(params.queries)}")
+    offset, where = _query_options(params)
+    try:
+        res = await db.asearch_many(params.queries, n_results=params.k, offset=offset,
+                                    where=where, min_score=params.min_score, mode=params.mode,
+                                    rerank=_rerank_options(params))
+    except BgsBusyException:
+        raise
     except Exception as e:
         msg = f"Unknown exception:{e}"
         logger.error(msg)
         raise HTTPException(status_code=500, detail=msg)
 
     return {
-        "data": res
+        "data": [{"query": query, **_page(results, params, offset)}
+                 for query, results in zip(params.queries, res)]
     }
 
 
@@ -96,16 +218,106 @@ async def search_artifacts(
     Execute a search absed upon the provided query
     """
     logger.info(f"Received request with query:{params.query}")
+    offset, where = _query_options(params)
     try:
-        res = db.search_artifacts(params.query)
+        res = await db.search_artifacts(params.query, n_results=params.k, offset=offset,
+                                        where=where, min_score=params.min_score, mode=params.mode,
+                                        rerank=_rerank_options(params))
+    except BgsBusyException:
+        raise
     except Exception as e:
         msg = f"Unknown exception:{e}"
         logger.error(msg)
         raise HTTPException(status_code=500, detail=msg)
 
+    return _page(res, params, offset)
+
+
+def _query_options(params: QueryOptions):
+    """
+    Get the result offset and "where" clause for a query
+    """
+    offset = params.offset
+    if params.cursor:
+        try:
+            offset = decode_cursor(params.cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    where = build_where(name=params.name, namespace=params.namespace, tags=params.tags)
+    return offset, where
+
+
+def _rerank_options(params: QueryOptions) -> dict:
+    """
+    Get the re-ranking settings a query overrides
+    """
     return {
+        "enabled": params.rerank,
+        "top_n": params.rerank_top_n,
+        "budget_ms": params.rerank_budget_ms
+    }
+
+
+def _page(res: list, params: QueryOptions, offset: int) -> dict:
+    """
+    Build a query response, with a cursor for the next page
+    if there may be more results
+    """
+    response = {
         "data": res
     }
+    if len(res) == params.k:
+        response["next_cursor"] = encode_cursor(offset + params.k)
+    return response
+
+
+#####
+# ADMIN
+#####
+
+
+@app.post(ENDPOINT_PREFIX + "/admin/rebuild")
+async def admin_rebuild(
+        request: Request,
+        params: Optional[RebuildData] = None
+):
+    """
+    Start rebuilding the collection (with new HNSW settings, if
+    given) into a new collection that is swapped in when complete.
+    Queries and writes continue meanwhile; the progress is reported
+    by GET /admin/rebuild
+    """
+    global rebuild_task, rebuild_status
+    if role == ROLE_READER:
+        return await _forward(request)
+    if rebuild_task is not None and not rebuild_task.done():
+        raise HTTPException(status_code=409, detail="A rebuild is already running")
+    hnsw = params.model_dump(exclude_none=True) if params else {}
+    rebuild_status = {"status": "running", "hnsw": hnsw, "started": time.time()}
+    rebuild_task = asyncio.create_task(_rebuild(hnsw))
+    return JSONResponse(status_code=202, content=rebuild_status)
+
+
+@app.get(ENDPOINT_PREFIX + "/admin/rebuild")
+async def admin_rebuild_get(
+        request: Request
+):
+    """
+    Get the status of the current or last rebuild
+    """
+    if role == ROLE_READER:
+        return await _forward(request)
+    return rebuild_status
+
+
+async def _rebuild(hnsw: dict):
+    global rebuild_status
+    try:
+        stats = await asyncio.to_thread(db.rebuild, hnsw)
+        rebuild_status = {**rebuild_status, **stats, "status": "done", "finished": time.time()}
+    except Exception as e:
+        logger.error(f"Rebuild failed, exception:{e}")
+        rebuild_status = {**rebuild_status, "status": "failed", "error": str(e), "finished": time.time()}
 
 
 #####
@@ -124,13 +336,74 @@ async def search_health_get():
     return response
 
 
+@app.get(ENDPOINT_PREFIX + "/ready")
+async def search_ready_get():
+    """
+    Get readiness information (liveness is reported by /health)
+    """
+    response = {
+        "ready": ready,
+        "documents": db.count()
+    }
+    if not ready:
+        return JSONResponse(status_code=503, content=response)
+    return response
+
+
 @app.get(ENDPOINT_PREFIX + "/metrics")
 async def search_metrics_get():
     """
     Get metrics information
     """
-    metrics = LoggingMiddleware.get_metrics()
-    response = metrics
+    response = {
+        "process": {"role": role, "pid": os.getpid()},
+        "metrics": _registry().to_dict(),
+        "query_pool": db.query_pool.stats(),
+        "result_cache": db.result_stats(),
+        "embedding_cache": db.embedding_stats(),
+        "artifact_cache": db.artifact_stats(),
+        "coalescing": db.coalesce_stats(),
+        "rerank": db.rerank_stats(),
+        "vector_store": db.vector_stats(),
+        "ingestion": pipeline.stats() if pipeline else {},
+        "http": httpclient.get_manager().stats()
+    }
+    return response
+
+
+@app.get(ENDPOINT_PREFIX + "/metrics/prometheus")
+async def search_metrics_prometheus_get():
+    """
+    Get metrics information in the Prometheus text format
+    """
+    return PlainTextResponse(_registry().to_prometheus(),
+                             media_type=metrics.PROMETHEUS_CONTENT_TYPE)
+
+
+@app.get(ENDPOINT_PREFIX + "/metrics/http")
+async def search_metrics_http_get():
+    """
+    Get outbound HTTP connection pool information
+    """
+    response = httpclient.get_manager().stats()
+    return response
+
+
+@app.get(ENDPOINT_PREFIX + "/metrics/results")
+async def search_metrics_results_get():
+    """
+    Get query result cache hit/miss information
+    """
+    response = db.result_stats()
+    return response
+
+
+@app.get(ENDPOINT_PREFIX + "/metrics/embeddings")
+async def search_metrics_embeddings_get():
+    """
+    Get embedding cache hit/miss information
+    """
+    response = db.embedding_stats()
     return response
 
 
@@ -143,50 +416,224 @@ async def _load(param1, param2):
     """
     Load data from registrar
     """
+    global ready
     logger.info(f"Loading data param1:{param1} param2:{param2}")
 
     try:
-        conf = state.gstate(STATE_CONFIG)
-        host = conf["registrar"]["host"]
-        port = conf["registrar"]["port"]
-        service = conf["registrar"]["service"]
-        method = conf["registrar"]["method"]
-        headers = {
-            constants.HEADER_USERNAME: constants.USERNAME,
-            constants.HEADER_CORRELATION_ID: str(uuid.uuid4())
-        }
-        logger.info(f"Issuing request using header:{headers}")
-        response = await utilities.httprequest(host, port, service, method, headers=headers)
-
-        for element in response:
-            logger.info("adding element: {}".format((element["uuid"], element["name"], element["description"])))
-            db.add_data(element["uuid"], element["name"], element["description"])
+        # Products are streamed and synced in batches (see RegistrarLoader)
+        stats = await loader.load()
+        logger.info(f"Loaded data, stats:{stats}")
+        ready = True
+        await _save_snapshot(force=True)
     except Exception as e:
         logger.error(f"Error loading data, exception:{e}")
 
 
+async def _save_snapshot(force: bool = False):
+    """
+    Save a snapshot if snapshots are enabled and the collection changed,
+    at most once per min_interval_seconds unless forced (a snapshot
+    exports the whole collection)
+    """
+    global snapshot_generation, snapshot_saved
+    conf = {**snapshot.DEFAULT_CONFIG, **(state.gstate(STATE_CONFIG).get("snapshot") or {})}
+    # Never replace a snapshot with an index that was not restored or loaded
+    if not conf["enabled"] or not ready or db.generation == snapshot_generation:
+        return
+    if not force and snapshot_saved is not None and \
+            time.monotonic() - snapshot_saved < float(conf["min_interval_seconds"]):
+        return
+    generation = db.generation
+    try:
+        await asyncio.to_thread(snapshot.save, db, conf["path"], sync_engine.last_sync)
+        snapshot_generation = generation
+        snapshot_saved = time.monotonic()
+    except Exception as e:
+        logger.error(f"Error saving snapshot, exception:{e}")
+
+
+async def _restore_snapshot():
+    """
+    Restore the collection from a snapshot if snapshots are enabled
+    """
+    global ready, snapshot_generation
+    conf = {**snapshot.DEFAULT_CONFIG, **(state.gstate(STATE_CONFIG).get("snapshot") or {})}
+    if not conf["enabled"]:
+        return
+    try:
+        info = await asyncio.to_thread(snapshot.restore, db, conf["path"])
+    except Exception as e:
+        logger.error(f"Error restoring snapshot, exception:{e}")
+        return
+    if info is not None:
+        sync_engine.last_sync = info["watermark"]
+        snapshot_generation = db.generation
+        ready = True
+
+
+async def _forward(request: Request) -> Response:
+    """
+    Forward a request to the writer process
+    """
+    conf = multiprocess.configure(state.gstate(STATE_CONFIG).get("multiprocess"))
+    headers = {key: value for key, value in request.headers.items()
+               if key.lower() not in ("host", "content-length")}
+    service = request.url.path + (f"?{request.url.query}" if request.url.query else "")
+    try:
+        response = await httpclient.get_manager().request(
+            request.method, conf["writer_host"], conf["writer_port"], service,
+            headers=headers, content=await request.body())
+    except Exception as e:
+        msg = f"Error forwarding to writer, exception:{e}"
+        logger.error(msg)
+        raise HTTPException(status_code=502, detail=msg)
+    forwarded = {key: value for key, value in response.headers.items() if key.lower() == "retry-after"}
+    return Response(content=response.content, status_code=response.status_code,
+                    media_type=response.headers.get("content-type"), headers=forwarded)
+
+
+def _registry() -> metrics.Registry:
+    """
+    Get the metrics of this process, or of all processes when
+    running in multi-process mode
+    """
+    if publisher is None:
+        return metrics.REGISTRY
+    return publisher.collect()
+
+
+def _register_metrics():
+    """
+    Register gauges that are computed when metrics are collected
+    """
+    metrics.COLLECTION_SIZE.set_function(db.count)
+    metrics.INGEST_QUEUE_SIZE.set_function(lambda: pipeline.stats()["queued"] if pipeline else 0)
+    metrics.SYNC_LAG_SECONDS.set_function(
+        lambda: sync_engine.lag() if sync_engine.lag() is not None else float("nan"))
+    metrics.CACHE_HITS.labels(cache="result").set_function(lambda: db.result_stats().get("hits", 0))
+    metrics.CACHE_MISSES.labels(cache="result").set_function(lambda: db.result_stats().get("misses", 0))
+    metrics.CACHE_HITS.labels(cache="embedding").set_function(
+        lambda: db.embedding_stats().get("memory_hits", 0) + db.embedding_stats().get("disk_hits", 0))
+    metrics.CACHE_MISSES.labels(cache="embedding").set_function(lambda: db.embedding_stats().get("misses", 0))
+    metrics.CACHE_HITS.labels(cache="artifact").set_function(lambda: db.artifact_stats().get("hits", 0))
+    metrics.CACHE_MISSES.labels(cache="artifact").set_function(lambda: db.artifact_stats().get("misses", 0))
+    for operation in ("query", "artifact"):
+        metrics.COALESCED_REQUESTS.labels(operation=operation).set_function(
+            lambda operation=operation: db.coalesce_stats().get(operation, {}).get("coalesced", 0))
+
+
+def _parse_products(body: bytes) -> List[AddData]:
+    """
+    Parse a JSON array or NDJSON body into products
+    """
+    text = body.decode("utf-8").strip()
+    if not text:
+        return []
+    if text.startswith("["):
+        elements = json.loads(text)
+    else:
+        elements = [json.loads(line) for line in text.splitlines() if line.strip()]
+    return [AddData.model_validate(element) for element in elements]
+
+
 async def _repeat_every(interval_sec, func, *args):
     """
     Setup a periodically called function
     """
-    import asyncio
     while True:
         await func(*args)
         await asyncio.sleep(interval_sec)
 
 
+async def _reload_collection():
+    """
+    Bring a reader up to date with the collection files saved by the
+    writer (numpy engine), which are mapped rather than copied
+    """
+    global ready
+    try:
+        await asyncio.to_thread(db.reload)
+    except Exception as e:
+        # Files being replaced by the writer, retried on the next round
+        logger.info(f"Collection not reloaded, exception:{e}")
+    if db.loaded_files is not None:
+        ready = True
+
+
+async def _reload_snapshot():
+    """
+    Bring a reader up to date with the snapshot published by the writer
+    """
+    global ready, snapshot_generation
+    conf = {**snapshot.DEFAULT_CONFIG, **(state.gstate(STATE_CONFIG).get("snapshot") or {})}
+    try:
+        modified = os.path.getmtime(conf["path"])
+    except OSError:
+        return
+    if modified == snapshot_generation:
+        return
+    try:
+        info = await asyncio.to_thread(snapshot.restore, db, conf["path"], True)
+    except Exception as e:
+        logger.error(f"Error reloading snapshot, exception:{e}")
+        return
+    if info is not None:
+        sync_engine.last_sync = info["watermark"]
+        # Readers track the snapshot file rather than a generation
+        snapshot_generation = modified
+        ready = True
+
+
 @app.on_event("startup")
 async def startup_event():
     """
-    At startup, immediately load data and then periodically thereafter
+    At startup, restore the latest snapshot (if any), then load data
+    in the background immediately and periodically thereafter.
+
+    Readers (multi-process mode) do not load data, they follow the
+    snapshots published by the writer.
     """
     conf = state.gstate(STATE_CONFIG)
-    logger.info("Running startup event")
+    process_conf = multiprocess.configure(conf.get("multiprocess"))
+    logger.info(f"Running startup event role:{role}")
+    await httpclient.get_manager().start()
+    if publisher is not None:
+        asyncio.create_task(publisher.run(process_conf["metrics_interval_seconds"]))
+
+    if role == ROLE_READER:
+        reload = _reload_collection if db.read_only else _reload_snapshot
+        asyncio.create_task(_repeat_every(process_conf["reload_seconds"], reload))
+        return
+
+    await pipeline.start()
+    await _restore_snapshot()
     param1 = "fake param 1"
     param2 = "fake param 2"
-    await _load(param1, param2)  # Immediate invocation at startup
-    import asyncio
-    asyncio.create_task(_repeat_every(conf["server"]["load_interval_seconds"], _load, param1, param2))  # Periodic invocation
+    # The first invocation catches up with the registrar; queries are
+    # served meanwhile (readiness is reported by /ready)
+    asyncio.create_task(_repeat_every(conf["server"]["load_interval_seconds"], _load, param1, param2))
+    if role == ROLE_WRITER:
+        # Publish writes (e.g. from the ingestion pipeline) to readers
+        asyncio.create_task(_repeat_every(process_conf["reload_seconds"], _save_snapshot))
+    if db.engine == ENGINE_NUMPY:
+        # Save writes held back by the save interval of the numpy engine
+        asyncio.create_task(_repeat_every(max(1.0, db.save_interval), asyncio.to_thread, db.flush))
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """
+    At shutdown, finish queued ingestion and release outbound connections
+    """
+    logger.info("Running shutdown event")
+    if pipeline is not None:
+        await pipeline.stop()
+    if role != ROLE_READER:
+        await asyncio.to_thread(db.flush)
+        await _save_snapshot(force=True)
+    if publisher is not None:
+        publisher.remove()
+    await httpclient.get_manager().close()
 
 
 #####
@@ -194,15 +641,76 @@ async def startup_event():
 #####
 
 
+def _setup(configuration: dict, process_role: str):
+    """
+    Create the database and services of this process
+    """
+    global db, sync_engine, pipeline, loader, role, publisher
+    role = process_role
+    state.gstate(STATE_CONFIG, configuration)
+    httpclient.configure(configuration.get("http"))
+    tracing.setup(configuration.get("tracing"))
+    database = configuration["database"]
+    # Readers of a persisted numpy collection map the writer's files (the
+    # vectors are shared through the page cache); otherwise readers hold
+    # their own in-memory copy of the writer's snapshot
+    engine = database.get("engine", ENGINE_CHROMA)
+    shared = role == ROLE_READER and engine == ENGINE_NUMPY and bool(database["persist"])
+    persist = bool(database["persist"]) and (role != ROLE_READER or shared)
+    db = SearchDb(database["db_location"],
+                  database["collection_name"],
+                  persist,
+                  configuration["registrar"],
+                  batch_size=database.get("batch_size", DEFAULT_BATCH_SIZE),
+                  embedding=configuration.get("embedding"),
+                  query_workers=database.get("query_workers", DEFAULT_WORKERS),
+                  query_queue_depth=database.get("query_queue_depth", DEFAULT_QUEUE_DEPTH),
+                  proxy=configuration.get("proxy"),
+                  result_cache=database.get("result_cache"),
+                  retrieval=database.get("retrieval"),
+                  engine=engine,
+                  numpy=database.get("numpy"),
+                  chunking=database.get("chunking"),
+                  rerank=configuration.get("rerank"),
+                  hnsw=database.get("hnsw"),
+                  coalesce=database.get("coalesce", True),
+                  read_only=shared)
+    sync_engine = SyncEngine(db)
+    if role != ROLE_READER:
+        pipeline = IngestionPipeline(db, configuration.get("ingestion"))
+        loader = RegistrarLoader(sync_engine, configuration["registrar"])
+    if role != ROLE_SINGLE:
+        process_conf = multiprocess.configure(configuration.get("multiprocess"))
+        publisher = MetricsPublisher(process_conf["metrics_dir"], role)
+    _register_metrics()
+
+
+def _serve_reader(configuration: dict, sock):
+    """
+    Run a reader process on the shared listening socket
+    """
+    listener = None
+    log_settings = middleware.configure(configuration.get("logging"))
+    if log_settings["queue"]:
+        listener = utilities.start_queue_logging()
+    try:
+        _setup(configuration, ROLE_READER)
+        server = uvicorn.Server(uvicorn.Config(app))
+        server.run(sockets=[sock])
+    finally:
+        if listener:
+            listener.stop()
+
+
 if __name__ == "__main__":
     # Set up argument parsing
     import argparse
-    import os
 
     parser = argparse.ArgumentParser(description="Run the FastAPI server.")
     parser.add_argument("--host", type=str, default=DEFAULT_HOST, help=f"Host for the server (default: {DEFAULT_HOST})")
     parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"Port for the server (default: {DEFAULT_PORT})")
     parser.add_argument("--configuration", help=f"Configuration file")
+    parser.add_argument("--workers", type=int, default=None, help=f"Reader processes (default: from configuration)")
     args = parser.parse_args()
 
     logger.info(f"Using current working directory:{os.getcwd()}")
@@ -212,21 +720,35 @@ if __name__ == "__main__":
     # Read the configuration file
     configuration = None
     with open(args.configuration, 'r') as file:
-        state.gstate(STATE_CONFIG, yaml.safe_load(file))
-
-    configuration = state.gstate(STATE_CONFIG)
+        configuration = yaml.safe_load(file)
     logger.info("config: {}".format(configuration))
+    process_conf = multiprocess.configure(configuration.get("multiprocess"))
+    workers = args.workers if args.workers is not None else int(process_conf["workers"])
+
+    readers = []
+    host, port = args.host, args.port
+    if workers > 1:
+        # Readers follow the writer through snapshots
+        configuration.setdefault("snapshot", {})["enabled"] = True
+        sock = multiprocess.bind_socket(args.host, args.port)
+        readers = multiprocess.spawn(workers, _serve_reader, configuration, sock)
+        host, port = process_conf["writer_host"], process_conf["writer_port"]
+
+    log_settings = middleware.configure(configuration.get("logging"))
+    listener = None
+    if log_settings["queue"]:
+        listener = utilities.start_queue_logging()
     # Setup the database
-    db = SearchDb(configuration["database"]["db_location"],
-                  configuration["database"]["collection_name"],
-                  bool(configuration["database"]["persist"]),
-                  configuration["registrar"])
+    _setup(configuration, ROLE_WRITER if readers else ROLE_SINGLE)
 
     # Start the server
     try:
-        logger.info(f"Starting service on host:{args.host} port:{args.port}")
-        uvicorn.run(app, host=args.host, port=args.port)
+        logger.info(f"Starting service on host:{host} port:{port} role:{role}")
+        uvicorn.run(app, host=host, port=port)
     except Exception as e:
         logger.info(f"Stopping server, exception:{e}")
     finally:
-        logger.info(f"Terminating service")
\ No newline at end of file
+        logger.info(f"Terminating service")
+        multiprocess.stop(readers)
+        if listener:
+            listener.stop()
@@ -0,0 +1,82 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""
+Coalescing of identical concurrent requests ("single-flight").
+
+The first caller for a key starts the computation; callers arriving
+with the same key while it is in flight wait for that computation
+instead of starting their own, and every caller gets its own copy of
+the result (or the exception it raised).  Nothing is kept once the
+computation finishes, so this bounds duplicate work during bursts
+without serving anything stale.
+"""
+
+import asyncio
+import copy
+import threading
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+
+class SingleFlight():
+    """
+    Share one in-flight computation between concurrent callers
+    with the same key (for use from one event loop)
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.flights: Dict[Hashable, asyncio.Task] = {}
+        self.lock = threading.Lock()
+        self.executed = 0
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, function: Callable[..., Awaitable], *args, **kwargs) -> Any:
+        """
+        Await function(*args, **kwargs), or the call already in
+        flight for the key
+
+        :return: a copy of the result, which callers may modify
+        """
+        task = self.flights.get(key)
+        if task is None:
+            task = asyncio.ensure_future(function(*args, **kwargs))
+            self.flights[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+            self._count(coalesced=False)
+        else:
+            self._count(coalesced=True)
+        # A caller that goes away (e.g. a client disconnect) must not
+        # cancel the computation the other callers are waiting for
+        return copy.deepcopy(await asyncio.shield(task))
+
+    def _finish(self, key: Hashable, task: asyncio.Task):
+        if self.flights.get(key) is task:
+            del self.flights[key]
+        # Retrieve the exception so an abandoned flight is not reported
+        if not task.cancelled():
+            task.exception()
+
+    def _count(self, coalesced: bool):
+        with self.lock:
+            if coalesced:
+                self.coalesced += 1
+            else:
+                self.executed += 1
+
+    def stats(self) -> dict:
+        """
+        Get the number of computations executed and of callers
+        that shared one
+        """
+        with self.lock:
+            calls = self.executed + self.coalesced
+            return {
+                "executed": self.executed,
+                "coalesced": self.coalesced,
+                "coalesce_rate": self.coalesced / calls if calls else 0.0,
+                "in_flight": len(self.flights)
+            }
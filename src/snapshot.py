@@ -0,0 +1,115 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""
+Snapshot and restore of the search collection.
+
+A snapshot holds the ids, documents, metadata and embeddings of
+every document plus the sync watermark, so a restarted service can
+serve immediately and only embed what changed since the snapshot.
+The file is a NumPy .npz archive: the embeddings as one float32
+matrix and everything else as a JSON header.
+"""
+
+import json
+import logging
+import os
+import time
+from typing import Optional
+
+import numpy as np
+
+from searchdb import SearchDb
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+
+DEFAULT_CONFIG = {
+    "enabled": False,
+    "path": "/app/data/snapshot.npz",
+    # Minimum time between periodic snapshots (each exports the whole
+    # collection); loads and shutdown always save
+    "min_interval_seconds": 60.0
+}
+
+
+def save(db: SearchDb, path: str, watermark: Optional[float] = None) -> int:
+    """
+    Write a snapshot of the collection
+
+    :param db: search database
+    :param path: snapshot file
+    :param watermark: time (epoch seconds) of the last registrar sync
+    :return: number of documents written
+    """
+    start = time.perf_counter()
+    contents = db.export()
+    embeddings = np.asarray(contents["embeddings"], dtype=np.float32)
+    header = {
+        "version": SNAPSHOT_VERSION,
+        "model": db.model_name(),
+        "watermark": watermark,
+        "created": time.time(),
+        "ids": contents["ids"],
+        "documents": contents["documents"],
+        "metadatas": contents["metadatas"]
+    }
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # Write then rename so a crash never leaves a partial snapshot
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as file:
+        np.savez(file, embeddings=embeddings,
+                 header=np.frombuffer(json.dumps(header).encode("utf-8"), dtype=np.uint8))
+    os.replace(temporary, path)
+    logger.info(f"Saved snapshot path:{path} documents:{len(header['ids'])} "
+                f"elapsed:{time.perf_counter() - start:.3f}s")
+    return len(header["ids"])
+
+
+def restore(db: SearchDb, path: str, replace: bool = False) -> Optional[dict]:
+    """
+    Load a snapshot into the collection (without embedding)
+
+    :param db: search database
+    :param path: snapshot file
+    :param replace: make the collection match the snapshot exactly
+        (only changed documents are written, others are removed)
+    :return: information about the snapshot (documents, watermark),
+        or None if there is no usable snapshot
+    """
+    if not os.path.exists(path):
+        logger.info(f"No snapshot path:{path}")
+        return None
+
+    start = time.perf_counter()
+    try:
+        with np.load(path) as archive:
+            header = json.loads(archive["header"].tobytes().decode("utf-8"))
+            embeddings = archive["embeddings"]
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable snapshot path:{path}, exception:{e}")
+        return None
+
+    if header.get("version") != SNAPSHOT_VERSION:
+        logger.warning(f"Ignoring snapshot path:{path} version:{header.get('version')}")
+        return None
+    # Vectors from another model cannot be compared with new queries
+    if header.get("model") != db.model_name():
+        logger.warning(f"Ignoring snapshot path:{path} model:{header.get('model')} "
+                       f"expected:{db.model_name()}")
+        return None
+
+    db.restore(header["ids"], embeddings, header["documents"], header["metadatas"], replace=replace)
+    logger.info(f"Restored snapshot path:{path} documents:{len(header['ids'])} "
+                f"elapsed:{time.perf_counter() - start:.3f}s")
+    return {
+        "documents": len(header["ids"]),
+        "watermark": header.get("watermark")
+    }
@@ -0,0 +1,134 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+import logging
+import time
+from typing import List, Optional, Set
+
+from searchdb import SearchDb, SOURCE_API, SOURCE_REGISTRAR, content_hash
+
+logger = logging.getLogger(__name__)
+
+
+class SyncSession():
+    """
+    One synchronization pass, fed incrementally.
+
+    Products are applied batch by batch as they arrive (so memory
+    stays bounded and results appear progressively); documents the
+    pass has not seen are removed only when the pass finishes.
+    """
+
+    def __init__(self, db: SearchDb, seen: Optional[Set[str]] = None):
+        self.db = db
+        self.manifest = db.manifest()
+        self.seen: Set[str] = set(seen or ())
+        self.added = 0
+        self.updated = 0
+        self.unchanged = 0
+
+    def apply(self, products: List[dict]):
+        """
+        Add new and changed products
+
+        :param products: products (uuid, name, description, namespace, tags) from the registrar
+        """
+        changed = []
+        for product in products:
+            _id = product["uuid"]
+            if _id in self.seen:
+                logger.warning(f"Ignoring duplicate product uuid:{_id}")
+                continue
+            self.seen.add(_id)
+
+            meta = self.manifest.get(_id)
+            if meta is not None and meta.get("hash") == content_hash(product):
+                self.unchanged += 1
+                continue
+
+            logger.info(f"Syncing product uuid:{_id} name:{product['name']}")
+            changed.append(product)
+            if meta is None:
+                self.added += 1
+            else:
+                self.updated += 1
+        if changed:
+            self.db.add_many(changed, source=SOURCE_REGISTRAR)
+
+    def finish(self) -> dict:
+        """
+        Remove products that are no longer in the registrar
+
+        :return: statistics describing the changes applied
+        """
+        # Products added directly through the API are not owned
+        # by the registrar and must survive a sync
+        deleted = [_id for _id, meta in self.manifest.items()
+                   if _id not in self.seen and (meta or {}).get("source") != SOURCE_API]
+        self.db.delete(deleted)
+
+        return {
+            "added": self.added,
+            "updated": self.updated,
+            "deleted": len(deleted),
+            "unchanged": self.unchanged,
+            "total": self.db.count()
+        }
+
+
+class SyncEngine():
+    """
+    Synchronize the search collection with the products in the registrar.
+
+    Documents are keyed by product uuid and carry a hash of their
+    content, so only new or changed products are (re)embedded and
+    products that have disappeared from the registrar are removed.
+    A sync against an unchanged registrar does no embedding at all.
+    """
+
+    def __init__(self, db: SearchDb):
+        self.db = db
+        # Time (epoch seconds) of the last successful sync
+        self.last_sync: Optional[float] = None
+
+    def sync(self, products: List[dict]) -> dict:
+        """
+        Bring the collection in line with the given registrar products
+
+        :param products: products (uuid, name, description, namespace, tags) from the registrar
+        :return: statistics describing the changes applied
+        """
+        session = self.begin()
+        session.apply(products)
+        return self.complete(session)
+
+    def begin(self, seen: Optional[Set[str]] = None) -> SyncSession:
+        """
+        Start an incremental sync (see SyncSession)
+
+        :param seen: products already applied by an interrupted pass
+        """
+        return SyncSession(self.db, seen)
+
+    def complete(self, session: SyncSession) -> dict:
+        """
+        Finish an incremental sync
+
+        :return: statistics describing the changes applied
+        """
+        stats = session.finish()
+        self.last_sync = time.time()
+        logger.info(f"Sync complete, stats:{stats}")
+        return stats
+
+    def lag(self) -> Optional[float]:
+        """
+        Get the number of seconds since the last successful sync
+        (None if there has not been one)
+        """
+        if self.last_sync is None:
+            return None
+        return time.time() - self.last_sync
@@ -0,0 +1,173 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""
+Optional OpenTelemetry tracing.
+
+Tracing is off unless enabled in the "tracing" section of the
+configuration (and the OpenTelemetry packages are installed);
+when off, span() costs next to nothing.  The correlation id
+(HEADER_CORRELATION_ID) travels as W3C baggage alongside the
+trace context so downstream services can link the two.
+"""
+
+import logging
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+EXPORTER_OTLP = "otlp"
+EXPORTER_FILE = "file"
+EXPORTER_CONSOLE = "console"
+
+DEFAULT_CONFIG = {
+    "enabled": False,
+    "service_name": "osc-dm-search-srv",
+    "exporter": EXPORTER_OTLP,
+    # OTLP gRPC collector endpoint
+    "endpoint": "http://localhost:4317",
+    # Output file for the "file" exporter (one JSON span per line)
+    "path": "/app/data/traces.jsonl"
+}
+
+BAGGAGE_CORRELATION_ID = "correlation_id"
+
+_enabled = False
+_tracer = None
+
+
+KIND_INTERNAL = "internal"
+KIND_SERVER = "server"
+KIND_CLIENT = "client"
+
+
+class _NoopSpan():
+    def set_attribute(self, key, value):
+        pass
+
+    def update_name(self, name):
+        pass
+
+    def record_exception(self, exception):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def setup(conf: Optional[dict] = None) -> bool:
+    """
+    Configure tracing from the "tracing" section of the configuration
+
+    Returns:
+    - bool: True if tracing is enabled
+    """
+    global _enabled, _tracer
+    conf = {**DEFAULT_CONFIG, **(conf or {})}
+    if not conf["enabled"]:
+        return False
+
+    try:
+        from opentelemetry import trace
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+    except ImportError as e:
+        logger.warning(f"Tracing requested but OpenTelemetry is not available, exception:{e}")
+        return False
+
+    exporter_name = conf["exporter"]
+    if exporter_name == EXPORTER_OTLP:
+        from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+        exporter = OTLPSpanExporter(endpoint=conf["endpoint"])
+    elif exporter_name == EXPORTER_FILE:
+        out = open(conf["path"], "a")
+        exporter = ConsoleSpanExporter(out=out, formatter=lambda span: span.to_json(indent=None) + "\n")
+    elif exporter_name == EXPORTER_CONSOLE:
+        exporter = ConsoleSpanExporter()
+    else:
+        logger.warning(f"Unknown tracing exporter:{exporter_name}, tracing disabled")
+        return False
+
+    provider = TracerProvider(resource=Resource.create({"service.name": conf["service_name"]}))
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+    _tracer = trace.get_tracer(__name__)
+    _enabled = True
+    logger.info(f"Tracing enabled, exporter:{exporter_name}")
+    return True
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+@contextmanager
+def span(name: str, headers: Optional[Dict] = None, kind: str = KIND_INTERNAL, **attributes):
+    """
+    Run the enclosed block in a span (a child of the current span)
+
+    Parameters:
+    - name (str): span name
+    - headers (dict, optional): incoming headers to continue a remote trace
+    - kind (str): KIND_INTERNAL, KIND_SERVER (incoming request) or KIND_CLIENT (outbound call)
+    - attributes: span attributes
+    """
+    if not _enabled:
+        yield _NOOP_SPAN
+        return
+
+    from opentelemetry import propagate, trace
+    ctx = propagate.extract(headers) if headers is not None else None
+    kinds = {
+        KIND_INTERNAL: trace.SpanKind.INTERNAL,
+        KIND_SERVER: trace.SpanKind.SERVER,
+        KIND_CLIENT: trace.SpanKind.CLIENT
+    }
+    with _tracer.start_as_current_span(name, context=ctx, kind=kinds[kind]) as current:
+        for key, value in attributes.items():
+            if value is not None:
+                current.set_attribute(key, value)
+        yield current
+
+
+@contextmanager
+def correlation(correlation_id: str):
+    """
+    Make the correlation id part of the trace context (as baggage)
+    for the enclosed block
+    """
+    if not _enabled:
+        yield
+        return
+
+    from opentelemetry import baggage, context
+    token = context.attach(baggage.set_baggage(BAGGAGE_CORRELATION_ID, correlation_id))
+    try:
+        yield
+    finally:
+        context.detach(token)
+
+
+def correlation_id() -> Optional[str]:
+    """
+    Get the correlation id of the current trace, if any
+    """
+    if not _enabled:
+        return None
+    from opentelemetry import baggage
+    return baggage.get_baggage(BAGGAGE_CORRELATION_ID)
+
+
+def inject(headers: Dict) -> Dict:
+    """
+    Add the current trace context (traceparent, baggage) to outbound headers
+    """
+    if _enabled:
+        from opentelemetry import propagate
+        propagate.inject(headers)
+    return headers
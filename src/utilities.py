@@ -8,19 +8,56 @@
 
 from typing import List, Optional, Dict, Any
 import httpx
+import requests
 import logging
+import logging.handlers
+import queue
 
 from bgsexception import BgsException, BgsNotFoundException
+import httpclient
+import tracing
 
 LOGGING_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
 logging.basicConfig(level=logging.INFO, format=LOGGING_FORMAT)
 logger = logging.getLogger(__name__)
 
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that leaves all formatting to the listener thread
+    (the standard handler formats the message in the calling thread)
+    """
+    def prepare(self, record):
+        return record
+
+
+def start_queue_logging() -> logging.handlers.QueueListener:
+    """
+    Move log formatting and output off the calling threads: the root
+    handlers are replaced by a queue that a background thread drains.
+
+    Returns:
+    - QueueListener: the listener, to be stopped at shutdown
+    """
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    for handler in handlers:
+        root.removeHandler(handler)
+
+    records = queue.SimpleQueue()
+    root.addHandler(_DeferredQueueHandler(records))
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
 async def httprequest(host: str, port: int, service: str, method: str,
              data: Optional[Any]=None, obj: Optional[Dict]=None,
-             files: Optional[Any]=None, headers: Optional[Dict]=None) -> Any:
+             files: Optional[Any]=None, headers: Optional[Dict]=None,
+             timeout: Optional[float]=None) -> Any:
     """
-    Generic request function using the ASYNC httpx library.
+    Generic request function using the ASYNC httpx library.  Requests
+    go through the application HTTP client manager (pooled connections,
+    retries and circuit breaking).
 
     Parameters:
     - service (str): The URL of the service to which the request is made
@@ -28,6 +65,7 @@ async def httprequest(host: str, port: int, service: str, method: str,
     - data (any, optional): Data to send in the request body, typically for POST requests
     - obj (dict, optional): JSON object to send in the request body
     - files (any, optional): Files to send in the request body
+    - timeout (float, optional): Timeout in seconds (default: configured timeout)
 
     Returns:
     - requests.Response: The response object
@@ -42,10 +80,18 @@ async def httprequest(host: str, port: int, service: str, method: str,
         headers = {"Content-Type": "application/json"}
 
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.request(method, url, headers=headers, json=obj, data=data, files=files)
-            response.raise_for_status()
-            return response.json()
+        kwargs = {"timeout": timeout} if timeout is not None else {}
+        with tracing.span(f"HTTP {method}", kind=tracing.KIND_CLIENT,
+                          **{"http.method": method, "http.url": url}) as current:
+            headers = tracing.inject(dict(headers))
+            response = await httpclient.get_manager().request(
+                method, host, port, service, headers=headers, json=obj, data=data, files=files, **kwargs)
+            current.set_attribute("http.status_code", response.status_code)
+        response.raise_for_status()
+        return response.json()
+
+    except BgsException:
+        raise
 
     except httpx.HTTPStatusError as e:
         details = e.response.json().get("detail", str(e))
@@ -68,8 +114,8 @@ async def httprequest(host: str, port: int, service: str, method: str,
         logger.error(msg)
         raise BgsException(msg)
 
-    except httpx.ReadTimeout:
-        msg = f"Read timeout for {url}"
+    except httpx.TimeoutException:
+        msg = f"Timeout for {url}"
         logger.error(msg)
         raise BgsException(msg)
 
@@ -82,7 +128,9 @@ def shttprequest(host: str, port: int, service: str, method: str,
              data: Optional[Any]=None, obj: Optional[Dict]=None,
              files: Optional[Any]=None, headers: Optional[Dict]=None) -> Any:
     """
-    Generic request function using the SYNCHRONOUS requests library.
+    Generic request function using the SYNCHRONOUS requests library.  Requests
+    go through the application HTTP client manager (pooled connections,
+    retries and circuit breaking).
 
     Parameters:
     - service (str): The URL of the service to which the request is made
@@ -104,11 +152,14 @@ def shttprequest(host: str, port: int, service: str, method: str,
         headers = {"Content-Type": "application/json"}
 
     try:
-        import requests
-        response = requests.request(method, url, headers=headers, json=obj, data=data, files=files)
+        response = httpclient.get_manager().srequest(
+            method, host, port, service, headers=headers, json=obj, data=data, files=files)
         response.raise_for_status()
         return response.json()
 
+    except BgsException:
+        raise
+
     except requests.HTTPError as e:
         details = e.response.json().get("detail", str(e))
         msg = f"HTTP status error for {url}: {details}"
@@ -0,0 +1,632 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+"""
+In-memory vector engine for small catalogs.
+
+NumpyCollection implements the subset of the chromadb collection
+API used by SearchDb (upsert, get, query, delete, count) on top of
+a contiguous float32 matrix of normalized embeddings.  Search is an
+exact (brute force) dot product, or an IVF (inverted file) search
+over k-means clusters for larger catalogs.  The matrix can be held
+in RAM or memory-mapped from disk.
+
+For large catalogs the vectors can also be kept in a compressed form
+(float16, int8 scalar quantization or product quantization) that the
+first pass of a search runs on; the best candidates are then
+re-scored with the full precision vectors.  Only the compressed
+vectors are held in RAM: the full precision matrix is memory-mapped
+from disk, so re-scoring only pages in the rows of the candidates.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from lexical import matches
+
+logger = logging.getLogger(__name__)
+
+ENGINE_CHROMA = "chroma"
+ENGINE_NUMPY = "numpy"
+
+INDEX_FLAT = "flat"
+INDEX_IVF = "ivf"
+
+QUANTIZATION_NONE = "none"
+QUANTIZATION_FLOAT16 = "float16"
+QUANTIZATION_INT8 = "int8"
+QUANTIZATION_PQ = "pq"
+QUANTIZATIONS = (QUANTIZATION_NONE, QUANTIZATION_FLOAT16, QUANTIZATION_INT8, QUANTIZATION_PQ)
+
+DEFAULT_CONFIG = {
+    # flat (exact) or ivf (approximate)
+    "index": INDEX_FLAT,
+    # IVF clusters and clusters searched per query
+    "nlist": 64,
+    "nprobe": 8,
+    # Memory-map the full precision matrix instead of holding it in RAM
+    # (always the case when quantized)
+    "mmap": False,
+    # Compressed vectors searched first (held in RAM): none, float16, int8 or pq
+    "quantization": QUANTIZATION_NONE,
+    # Candidates re-scored at full precision, per requested result
+    "rescore": 4,
+    # Product quantization sub-vectors (bytes per vector)
+    "pq_subvectors": 16
+}
+
+# IVF is only trained once there are enough vectors per cluster
+MIN_VECTORS_PER_LIST = 8
+# Retrain when the collection has grown by this factor since training
+RETRAIN_GROWTH = 2.0
+KMEANS_ITERATIONS = 10
+INITIAL_CAPACITY = 1024
+# Product quantization: centroids per sub-vector (one byte codes),
+# vectors needed before training and vectors sampled for training
+PQ_CENTROIDS = 256
+PQ_MIN_VECTORS = 4 * PQ_CENTROIDS
+PQ_TRAINING_SAMPLE = 64 * PQ_CENTROIDS
+# Rows decompressed at a time when scoring
+SCORE_BLOCK = 65536
+
+
+def _normalize(vectors) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors.reshape(1, -1)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Get the positions of the k highest scores, best first
+    """
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < len(scores):
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+class NumpyCollection():
+    """
+    Vector collection held in a NumPy matrix.
+
+    Distances use the cosine space (1 - cosine similarity), matching
+    the "hnsw:space" metadata chromadb reports for cosine collections.
+    """
+
+    def __init__(self, name: str, path: Optional[str] = None, index: str = INDEX_FLAT,
+                 nlist: int = 64, nprobe: int = 8, mmap: bool = False,
+                 quantization: str = QUANTIZATION_NONE, rescore: int = 4, pq_subvectors: int = 16):
+        if index not in (INDEX_FLAT, INDEX_IVF):
+            raise ValueError(f"Unknown vector index:{index}")
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unknown vector quantization:{quantization}")
+        self.name = name
+        self.metadata = {"hnsw:space": "cosine"}
+        self.path = path
+        self.index = index
+        self.nlist = max(1, int(nlist))
+        self.nprobe = max(1, int(nprobe))
+        self.mmap = bool(mmap)
+        self.quantization = quantization
+        self.rescore = max(1, int(rescore))
+        self.pq_subvectors = max(1, int(pq_subvectors))
+        # Full precision vectors stay on disk (mapped) rather than in RAM
+        self.disk_backed = self.mmap or quantization != QUANTIZATION_NONE
+        self.lock = threading.RLock()
+
+        self.matrix: Optional[np.ndarray] = None
+        self.size = 0
+        self.ids: List[str] = []
+        self.rows: Dict[str, int] = {}
+        self.documents: List[Optional[str]] = []
+        self.metadatas: List[Optional[dict]] = []
+
+        # IVF state: unit centroids and the cluster of each row
+        self.centroids: Optional[np.ndarray] = None
+        self.assignments: Optional[np.ndarray] = None
+        self.trained_size = 0
+
+        # Compressed vectors (one row of codes per matrix row), the
+        # int8 scale of each row and the product quantization codebooks
+        self.codes: Optional[np.ndarray] = None
+        self.scales: Optional[np.ndarray] = None
+        self.codebooks: Optional[List[np.ndarray]] = None
+        self.pq_trained_size = 0
+
+        if self.path and os.path.exists(self.path + ".npy"):
+            self._load()
+
+    #####
+    # COLLECTION API
+    #####
+
+    def upsert(self, ids: List[str], embeddings, metadatas: Optional[List[dict]] = None,
+               documents: Optional[List[str]] = None):
+        vectors = _normalize(embeddings)
+        metadatas = metadatas or [None] * len(ids)
+        documents = documents or [None] * len(ids)
+        with self.lock:
+            self._reserve(self.size + len(ids), vectors.shape[1])
+            rows = []
+            for _id, vector, metadata, document in zip(ids, vectors, metadatas, documents):
+                row = self.rows.get(_id)
+                if row is None:
+                    row = self.size
+                    self.size += 1
+                    self.rows[_id] = row
+                    self.ids.append(_id)
+                    self.documents.append(document)
+                    self.metadatas.append(metadata)
+                else:
+                    self.documents[row] = document
+                    self.metadatas[row] = metadata
+                self.matrix[row] = vector
+                rows.append(row)
+                if self.centroids is not None:
+                    self.assignments[row] = int(np.argmax(self.centroids @ vector))
+            self._encode(np.asarray(rows, dtype=np.int64))
+
+    def delete(self, ids: List[str]):
+        with self.lock:
+            self._writable()
+            for _id in ids:
+                row = self.rows.pop(_id, None)
+                if row is None:
+                    continue
+                # Move the last row into the hole to keep the matrix contiguous
+                last = self.size - 1
+                if row != last:
+                    moved = self.ids[last]
+                    self.matrix[row] = self.matrix[last]
+                    self.ids[row] = moved
+                    self.documents[row] = self.documents[last]
+                    self.metadatas[row] = self.metadatas[last]
+                    self.rows[moved] = row
+                    if self.assignments is not None:
+                        self.assignments[row] = self.assignments[last]
+                    if self.codes is not None:
+                        self.codes[row] = self.codes[last]
+                    if self.scales is not None:
+                        self.scales[row] = self.scales[last]
+                self.ids.pop()
+                self.documents.pop()
+                self.metadatas.pop()
+                self.size -= 1
+
+    def get(self, ids: Optional[List[str]] = None, include: Optional[List[str]] = None) -> dict:
+        include = include if include is not None else ["metadatas", "documents"]
+        with self.lock:
+            rows = list(range(self.size)) if ids is None else [self.rows[_id] for _id in ids if _id in self.rows]
+            results = {"ids": [self.ids[row] for row in rows]}
+            if "documents" in include:
+                results["documents"] = [self.documents[row] for row in rows]
+            if "metadatas" in include:
+                results["metadatas"] = [self.metadatas[row] for row in rows]
+            if "embeddings" in include:
+                results["embeddings"] = [self.matrix[row].tolist() for row in rows]
+        return results
+
+    def query(self, query_embeddings, n_results: int = 10, where: Optional[dict] = None,
+              include: Optional[List[str]] = None) -> dict:
+        include = include if include is not None else ["metadatas", "documents", "distances"]
+        queries = _normalize(query_embeddings)
+        results = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        with self.lock:
+            if self.size == 0:
+                for _ in range(len(queries)):
+                    for key in results:
+                        results[key].append([])
+                return results
+
+            matrix = self.matrix[:self.size]
+            allowed = None
+            if where:
+                allowed = np.fromiter((matches(where, metadata or {}) for metadata in self.metadatas),
+                                      dtype=bool, count=self.size)
+            use_ivf = self._ivf_ready()
+            quantized = self._quantized_ready()
+            # Compressed scores only shortlist candidates for exact scoring
+            shortlist = n_results * self.rescore if quantized else n_results
+
+            if not use_ivf:
+                # One matrix product for the whole batch of queries
+                scores = self._approximate(queries) if quantized else queries @ matrix.T
+                if allowed is not None:
+                    scores[:, ~allowed] = -np.inf
+
+            for position, query in enumerate(queries):
+                if use_ivf:
+                    candidates = self._probe(query)
+                    if allowed is not None:
+                        candidates = candidates[allowed[candidates]]
+                    candidate_scores = (self._approximate(query.reshape(1, -1), candidates)[0] if quantized
+                                        else matrix[candidates] @ query)
+                    best = candidates[_top_k(candidate_scores, min(shortlist, len(candidates)))]
+                else:
+                    available = self.size if allowed is None else int(allowed.sum())
+                    best = _top_k(scores[position], min(shortlist, available))
+                # Exact scores (of the shortlist, when quantized)
+                best_scores = matrix[best] @ query
+                if quantized:
+                    order = _top_k(best_scores, min(n_results, len(best)))
+                    best, best_scores = best[order], best_scores[order]
+                results["ids"].append([self.ids[row] for row in best])
+                results["documents"].append([self.documents[row] for row in best])
+                results["metadatas"].append([self.metadatas[row] for row in best])
+                results["distances"].append([float(1.0 - score) for score in best_scores])
+        return {key: value for key, value in results.items() if key == "ids" or key in include}
+
+    def count(self) -> int:
+        return self.size
+
+    #####
+    # PERSISTENCE AND STATISTICS
+    #####
+
+    def save(self):
+        """
+        Write the collection to disk (no-op without a path)
+        """
+        if not self.path:
+            return
+        with self.lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            matrix = self.matrix[:self.size] if self.matrix is not None else np.empty((0, 0), np.float32)
+            # Write then rename so readers never see a partial file; the
+            # documents are replaced last and name the matrix file they
+            # belong to, so readers can tell a matching pair
+            with open(self.path + ".npy.tmp", "wb") as file:
+                np.save(file, matrix)
+            os.replace(self.path + ".npy.tmp", self.path + ".npy")
+            with open(self.path + ".json.tmp", "w") as file:
+                json.dump({"ids": self.ids, "documents": self.documents, "metadatas": self.metadatas,
+                           "vectors": _file_identity(self.path + ".npy")}, file)
+            os.replace(self.path + ".json.tmp", self.path + ".json")
+
+    def drop(self):
+        """
+        Remove the persisted files of the collection
+        """
+        with self.lock:
+            for suffix in (".npy", ".json"):
+                if self.path and os.path.exists(self.path + suffix):
+                    os.remove(self.path + suffix)
+
+    def stats(self) -> dict:
+        """
+        Get size and memory information
+        """
+        with self.lock:
+            dimensions = 0 if self.matrix is None else self.matrix.shape[1]
+            mapped = isinstance(self.matrix, np.memmap)
+            return {
+                "engine": ENGINE_NUMPY,
+                "index": self.index,
+                "ivf_trained": self.centroids is not None,
+                "quantization": self.quantization,
+                "pq_trained": self.codebooks is not None,
+                "size": self.size,
+                "capacity": 0 if self.matrix is None else len(self.matrix),
+                "dimensions": dimensions,
+                "matrix_bytes": 0 if self.matrix is None else int(self.matrix.nbytes),
+                "code_bytes": self._code_bytes(),
+                # RAM held by the vectors (a mapped matrix is paged in
+                # from disk on demand), in total and per product
+                "resident_bytes": self._resident_matrix_bytes() + self._code_bytes(),
+                "bytes_per_product": (0 if mapped else dimensions * 4) + self._code_bytes_per_row(),
+                "full_bytes_per_product": dimensions * 4,
+                "mmap": mapped
+            }
+
+    def recall(self, k: int = 10, queries=None, sample: int = 100) -> float:
+        """
+        Measure the recall@k of the configured search (compressed
+        and/or IVF) against an exact search at full precision
+
+        :param queries: query embeddings (default: a sample of the stored vectors)
+        :return: mean fraction of the exact top k that was found
+        """
+        with self.lock:
+            if self.size == 0:
+                return 1.0
+            matrix = self.matrix[:self.size]
+            if queries is None:
+                rows = np.random.default_rng(0).choice(self.size, min(sample, self.size), replace=False)
+                queries = matrix[rows]
+            queries = _normalize(queries)
+            found = self.query(queries, n_results=k, include=[])["ids"]
+            exact = queries @ matrix.T
+            total = 0.0
+            for position, ids in enumerate(found):
+                expected = {self.ids[row] for row in _top_k(exact[position], min(k, self.size))}
+                total += len(expected & set(ids)) / len(expected)
+            return total / len(queries)
+
+    def _load(self):
+        """
+        Read the saved files
+
+        :raises ValueError: if the files do not match (they are being
+            replaced, or saving was interrupted)
+        """
+        identity = _file_identity(self.path + ".npy")
+        matrix = np.load(self.path + ".npy", mmap_mode="r" if self.disk_backed else None)
+        with open(self.path + ".json", "r") as file:
+            data = json.load(file)
+        if len(matrix) != len(data["ids"]) or data.get("vectors", identity) != identity \
+                or _file_identity(self.path + ".npy") != identity:
+            raise ValueError(f"Inconsistent vectors and documents path:{self.path}")
+        self.matrix = matrix
+        self.size = len(data["ids"])
+        self.ids = data["ids"]
+        self.documents = data["documents"]
+        self.metadatas = data["metadatas"]
+        self.rows = {_id: row for row, _id in enumerate(self.ids)}
+        # Codes are not persisted, they are cheap to rebuild
+        if self.quantization in (QUANTIZATION_FLOAT16, QUANTIZATION_INT8) and self.size:
+            self._allocate_codes(self.size, self.matrix.shape[1])
+            for start in range(0, self.size, SCORE_BLOCK):
+                self._encode(np.arange(start, min(start + SCORE_BLOCK, self.size)))
+        logger.info(f"Loaded vectors:{self.size} path:{self.path} mmap:{self.disk_backed}")
+
+    #####
+    # STORAGE
+    #####
+
+    def _reserve(self, size: int, dimensions: int):
+        """
+        Make room for "size" rows, growing the matrix geometrically
+        """
+        if self.matrix is None or self.matrix.shape[1] == 0:
+            self.matrix = self._allocate_matrix(max(INITIAL_CAPACITY, size), dimensions)
+            self.assignments = None
+            self.codebooks = None
+            self._allocate_codes(len(self.matrix), dimensions)
+            return
+        if self.matrix.shape[1] != dimensions:
+            raise ValueError(f"Embedding dimensions:{dimensions} do not match collection:{self.matrix.shape[1]}")
+        if size > len(self.matrix) or not self.matrix.flags.writeable:
+            capacity = len(self.matrix)
+            if size > capacity:
+                capacity = max(size, 2 * capacity, INITIAL_CAPACITY)
+            matrix = self._allocate_matrix(capacity, dimensions)
+            for start in range(0, self.size, SCORE_BLOCK):
+                end = min(start + SCORE_BLOCK, self.size)
+                matrix[start:end] = self.matrix[start:end]
+            self.matrix = matrix
+            if self.assignments is not None:
+                assignments = np.zeros(capacity, dtype=np.int32)
+                assignments[:self.size] = self.assignments[:self.size]
+                self.assignments = assignments
+            if self.codes is not None and len(self.codes) != capacity:
+                codes = np.zeros((capacity,) + self.codes.shape[1:], dtype=self.codes.dtype)
+                codes[:self.size] = self.codes[:self.size]
+                self.codes = codes
+            if self.scales is not None and len(self.scales) != capacity:
+                scales = np.zeros(capacity, dtype=np.float32)
+                scales[:self.size] = self.scales[:self.size]
+                self.scales = scales
+
+    def _writable(self):
+        # A matrix mapped from the saved file is read-only; copy it into
+        # a writable (RAM or working file) matrix on first write
+        if self.matrix is not None and not self.matrix.flags.writeable:
+            self._reserve(self.size, self.matrix.shape[1])
+
+    def _allocate_matrix(self, capacity: int, dimensions: int) -> np.ndarray:
+        """
+        Allocate a zeroed matrix, in RAM or (when disk backed) mapped
+        from a working file next to the saved collection
+        """
+        if not self.disk_backed:
+            return np.zeros((capacity, dimensions), dtype=np.float32)
+        directory = os.path.dirname(self.path) if self.path else None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        descriptor, name = tempfile.mkstemp(prefix=f"{self.name}-", suffix=".vectors", dir=directory or None)
+        try:
+            os.ftruncate(descriptor, capacity * dimensions * 4)
+            matrix = np.memmap(name, dtype=np.float32, mode="r+", shape=(capacity, dimensions))
+        finally:
+            os.close(descriptor)
+            # The mapping keeps the working file until it is released
+            os.remove(name)
+        return matrix
+
+    def _resident_matrix_bytes(self) -> int:
+        if self.matrix is None or isinstance(self.matrix, np.memmap):
+            return 0
+        return int(self.matrix.nbytes)
+
+    #####
+    # IVF
+    #####
+
+    def _ivf_ready(self) -> bool:
+        if self.index != INDEX_IVF or self.size < self.nlist * MIN_VECTORS_PER_LIST:
+            return False
+        if self.centroids is None or self.size >= self.trained_size * RETRAIN_GROWTH:
+            self._train()
+        return True
+
+    def _train(self):
+        """
+        Cluster the vectors with spherical k-means
+        """
+        matrix = self.matrix[:self.size]
+        generator = np.random.default_rng(0)
+        centroids = matrix[generator.choice(self.size, self.nlist, replace=False)].copy()
+        for _ in range(KMEANS_ITERATIONS):
+            assignments = np.argmax(matrix @ centroids.T, axis=1)
+            for cluster in range(self.nlist):
+                members = matrix[assignments == cluster]
+                # Empty clusters keep their previous centroid
+                if len(members):
+                    centroids[cluster] = members.sum(axis=0)
+            centroids = _normalize(centroids)
+        self.centroids = centroids
+        self.assignments = np.zeros(len(self.matrix), dtype=np.int32)
+        self.assignments[:self.size] = np.argmax(matrix @ centroids.T, axis=1)
+        self.trained_size = self.size
+        logger.info(f"Trained IVF index, vectors:{self.size} lists:{self.nlist}")
+
+    def _probe(self, query: np.ndarray) -> np.ndarray:
+        """
+        Get the rows in the clusters closest to the query
+        """
+        lists = _top_k(self.centroids @ query, min(self.nprobe, self.nlist))
+        return np.flatnonzero(np.isin(self.assignments[:self.size], lists))
+
+    #####
+    # QUANTIZATION
+    #####
+
+    def _allocate_codes(self, capacity: int, dimensions: int):
+        if self.quantization == QUANTIZATION_FLOAT16:
+            self.codes = np.zeros((capacity, dimensions), dtype=np.float16)
+        elif self.quantization == QUANTIZATION_INT8:
+            self.codes = np.zeros((capacity, dimensions), dtype=np.int8)
+            self.scales = np.zeros(capacity, dtype=np.float32)
+        else:
+            # Product quantization codes are allocated once trained
+            self.codes = None
+
+    def _encode(self, rows: np.ndarray):
+        """
+        Compress matrix rows into their codes
+        """
+        if self.codes is None or not len(rows):
+            return
+        vectors = self.matrix[rows]
+        if self.quantization == QUANTIZATION_FLOAT16:
+            self.codes[rows] = vectors.astype(np.float16)
+        elif self.quantization == QUANTIZATION_INT8:
+            # Symmetric per-vector scale onto [-127, 127]
+            scales = np.abs(vectors).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            self.codes[rows] = np.round(vectors / scales[:, None]).astype(np.int8)
+            self.scales[rows] = scales
+        elif self.quantization == QUANTIZATION_PQ:
+            self.codes[rows] = self._pq_encode(vectors)
+
+    def _quantized_ready(self) -> bool:
+        if self.quantization == QUANTIZATION_NONE:
+            return False
+        if self.quantization != QUANTIZATION_PQ:
+            return self.codes is not None
+        # Product quantization is exact until there is enough to train on
+        if self.size < PQ_MIN_VECTORS:
+            return False
+        if (self.codebooks is None or self.size >= self.pq_trained_size * RETRAIN_GROWTH):
+            self._train_pq()
+        return self.codebooks is not None
+
+    def _approximate(self, queries: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Score queries against the compressed vectors (all rows, or the
+        given rows), one block of rows at a time
+        """
+        count = self.size if rows is None else len(rows)
+        scores = np.empty((len(queries), count), dtype=np.float32)
+        if self.quantization == QUANTIZATION_PQ:
+            codes = self.codes[:self.size] if rows is None else self.codes[rows]
+            subspaces = np.arange(len(self.codebooks))
+            for position, query in enumerate(queries):
+                # Asymmetric distance: table of query x centroid products
+                table = np.stack([codebook @ query[start:end] for codebook, (start, end)
+                                  in zip(self.codebooks, self._pq_bounds())])
+                for start in range(0, count, SCORE_BLOCK):
+                    block = codes[start:start + SCORE_BLOCK]
+                    scores[position, start:start + len(block)] = table[subspaces, block].sum(axis=1)
+            return scores
+        for start in range(0, count, SCORE_BLOCK):
+            block = slice(start, min(start + SCORE_BLOCK, count))
+            selection = slice(block.start, block.stop) if rows is None else rows[block]
+            scores[:, block] = queries @ self.codes[selection].astype(np.float32).T
+            if self.scales is not None:
+                scores[:, block] *= self.scales[selection]
+        return scores
+
+    def _pq_bounds(self) -> List[tuple]:
+        dimensions = self.matrix.shape[1]
+        edges = np.linspace(0, dimensions, min(self.pq_subvectors, dimensions) + 1).astype(int)
+        return list(zip(edges[:-1], edges[1:]))
+
+    def _train_pq(self):
+        """
+        Learn a codebook per sub-vector with k-means and encode every row
+        """
+        matrix = self.matrix[:self.size]
+        generator = np.random.default_rng(0)
+        sample = matrix[generator.choice(self.size, min(self.size, PQ_TRAINING_SAMPLE), replace=False)]
+        codebooks = []
+        for start, end in self._pq_bounds():
+            vectors = sample[:, start:end]
+            centroids = vectors[generator.choice(len(vectors), PQ_CENTROIDS, replace=False)].copy()
+            for _ in range(KMEANS_ITERATIONS):
+                assignments = _nearest(vectors, centroids)
+                for cluster in range(PQ_CENTROIDS):
+                    members = vectors[assignments == cluster]
+                    if len(members):
+                        centroids[cluster] = members.mean(axis=0)
+            codebooks.append(centroids)
+        self.codebooks = codebooks
+        self.codes = np.zeros((len(self.matrix), len(codebooks)), dtype=np.uint8)
+        for start in range(0, self.size, SCORE_BLOCK):
+            self._encode(np.arange(start, min(start + SCORE_BLOCK, self.size)))
+        self.pq_trained_size = self.size
+        logger.info(f"Trained product quantizer, vectors:{self.size} subvectors:{len(codebooks)}")
+
+    def _pq_encode(self, vectors: np.ndarray) -> np.ndarray:
+        codes = np.empty((len(vectors), len(self.codebooks)), dtype=np.uint8)
+        for subspace, (codebook, (start, end)) in enumerate(zip(self.codebooks, self._pq_bounds())):
+            codes[:, subspace] = _nearest(vectors[:, start:end], codebook)
+        return codes
+
+    def _code_bytes(self) -> int:
+        total = 0
+        for array in (self.codes, self.scales):
+            if array is not None:
+                total += int(array.nbytes)
+        for codebook in self.codebooks or []:
+            total += int(codebook.nbytes)
+        return total
+
+    def _code_bytes_per_row(self) -> int:
+        per_row = 0
+        if self.codes is not None:
+            per_row += self.codes.itemsize * int(np.prod(self.codes.shape[1:]))
+        if self.scales is not None:
+            per_row += self.scales.itemsize
+        return per_row
+
+
+def _file_identity(path: str) -> List[int]:
+    info = os.stat(path)
+    return [info.st_ino, info.st_size, info.st_mtime_ns]
+
+
+def _nearest(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """
+    Get the closest (Euclidean) centroid of each vector
+    """
+    distances = (centroids ** 2).sum(axis=1) - 2.0 * vectors @ centroids.T
+    return np.argmin(distances, axis=1)
@@ -0,0 +1,73 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+
+import asyncio
+import contextvars
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from bgsexception import BgsBusyException
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 8
+DEFAULT_QUEUE_DEPTH = 64
+
+
+class WorkerPool():
+    """
+    Run blocking work on a bounded thread pool from async code.
+
+    At most "workers" calls run at once and at most "queue_depth"
+    more may wait; beyond that calls are rejected immediately with
+    a BgsBusyException so the event loop is never blocked and
+    queues cannot grow without bound.
+    """
+
+    def __init__(self, name: str, workers: int = DEFAULT_WORKERS,
+                 queue_depth: int = DEFAULT_QUEUE_DEPTH):
+        self.name = name
+        self.workers = max(1, int(workers))
+        self.queue_depth = max(0, int(queue_depth))
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=name)
+        # Only modified from the event loop thread
+        self.pending = 0
+        self.rejected = 0
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        """
+        Run func(*args, **kwargs) on the pool and await its result
+        """
+        if self.pending >= self.workers + self.queue_depth:
+            self.rejected += 1
+            msg = f"Worker pool:{self.name} is at capacity pending:{self.pending}"
+            logger.warning(msg)
+            raise BgsBusyException(msg)
+
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            # Carry context variables (e.g. the current trace span) into the thread
+            context = contextvars.copy_context()
+            return await loop.run_in_executor(self.executor, functools.partial(context.run, func, *args, **kwargs))
+        finally:
+            self.pending -= 1
+
+    def stats(self) -> dict:
+        """
+        Get pool usage information
+        """
+        return {
+            "workers": self.workers,
+            "queue_depth": self.queue_depth,
+            "pending": self.pending,
+            "rejected": self.rejected
+        }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,69 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+import json
+
+import httpclient
+import benchmark
+from benchmark import compare, generate_catalog, percentile, summarize
+
+
+def _report(results):
+    return {"version": benchmark.RESULTS_VERSION, "results": results}
+
+
+class TestBenchmark:
+    def test_catalog_is_reproducible(self):
+        catalog = generate_catalog(20, seed=3)
+        assert catalog == generate_catalog(20, seed=3)
+        assert len({product["uuid"] for product in catalog}) == 20
+        assert catalog != generate_catalog(20, seed=4)
+
+    def test_percentiles(self):
+        values = [float(value) for value in range(1, 101)]
+        assert percentile(values, 0.50) == 50.0
+        assert percentile(values, 0.95) == 95.0
+        assert percentile(values, 0.99) == 99.0
+        assert percentile([], 0.5) == 0.0
+
+        summary = summarize([0.001] * 10, elapsed=0.5, errors=1)
+        assert summary["requests"] == 10
+        assert summary["errors"] == 1
+        assert summary["qps"] == 20.0
+        assert summary["p99_ms"] == 1.0
+
+    def test_compare_reports_regressions(self):
+        baseline = _report({"search": {"8": {"p99_ms": 10.0, "qps": 100.0, "max_ms": 20.0}},
+                            "ingest": {"products_per_second": 1000.0}})
+        current = _report({"search": {"8": {"p99_ms": 10.5, "qps": 70.0, "max_ms": 90.0}},
+                           "ingest": {"products_per_second": 2000.0}})
+        regressions = compare(baseline, current, threshold=0.10)
+        assert [regression["metric"] for regression in regressions] == ["search.8.qps"]
+
+    def test_run_offline(self, tmp_path):
+        output = tmp_path / "results.json"
+        try:
+            code = benchmark.main(["--products", "60", "--queries", "12", "--requests", "12",
+                                   "--concurrency", "1,4", "--engine", "numpy", "--dimensions", "32",
+                                   "--proxy-latency-ms", "0", "--output", str(output)])
+        finally:
+            httpclient.configure()
+        assert code == 0
+
+        report = json.loads(output.read_text())
+        results = report["results"]
+        assert results["ingest"]["products"] == 60
+        for scenario in ("search", "search_artifacts"):
+            assert set(results[scenario]) == {"1", "4"}
+            assert results[scenario]["4"]["requests"] == 12
+            assert results[scenario]["4"]["errors"] == 0
+        assert results["middleware"]["with"]["1"]["requests"] == 12
+
+        # A run compared with itself has no regressions
+        assert benchmark.main(["--products", "60", "--queries", "12", "--requests", "12",
+                               "--concurrency", "1,4", "--engine", "numpy", "--dimensions", "32",
+                               "--proxy-latency-ms", "0", "--scenarios", "search",
+                               "--compare", str(output), "--threshold", "100"]) == 0
+        httpclient.configure()
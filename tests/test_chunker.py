@@ -0,0 +1,102 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+import pytest
+
+import chunker
+from chunker import aggregate, chunk_text, AGGREGATE_MAX, AGGREGATE_SUM
+from searchdb import SearchDb
+from sync import SyncEngine
+
+CHUNKING = {"enabled": True, "size": 8, "overlap": 2}
+
+
+def _db(name, engine="numpy", chunking=CHUNKING):
+    return SearchDb("test", name, False, {}, embedding={"backend": "hash", "dimensions": 64},
+                    engine=engine, chunking=chunking)
+
+
+def _words(prefix, count):
+    return " ".join(f"{prefix}{index}" for index in range(count))
+
+
+class TestChunker:
+    def test_chunk_text(self):
+        assert chunk_text("short text", 8, 2) == ["short text"]
+        chunks = chunk_text(_words("w", 20), 8, 2)
+        assert chunks[0] == _words("w", 8)
+        # Consecutive chunks share the overlap
+        assert chunks[0].split()[-2:] == chunks[1].split()[:2]
+        assert chunks[-1].split()[-1] == "w19"
+        assert len(chunks) == 3
+
+    def test_configure_validates(self):
+        with pytest.raises(ValueError):
+            chunker.configure({"aggregate": "mean"})
+        with pytest.raises(ValueError):
+            chunker.configure({"size": 10, "overlap": 10})
+
+    def test_aggregate(self):
+        hits = [
+            {"id": "a#1", "metadata": {"id": "a"}, "data": "a1", "score": 0.9},
+            {"id": "b#0", "metadata": {"id": "b"}, "data": "b0", "score": 0.8},
+            {"id": "a#0", "metadata": {"id": "a"}, "data": "a0", "score": 0.5},
+            {"id": "b#2", "metadata": {"id": "b"}, "data": "b2", "score": 0.7},
+        ]
+        best = aggregate(hits, AGGREGATE_MAX)
+        assert [(hit["id"], hit["data"], hit["score"]) for hit in best] == [("a", "a1", 0.9), ("b", "b0", 0.8)]
+        total = aggregate(hits, AGGREGATE_SUM)
+        assert [hit["id"] for hit in total] == ["b", "a"]
+        assert total[0]["data"] == "b0"
+        assert total[0]["score"] == pytest.approx(1.5)
+
+    @pytest.mark.parametrize("engine", ["numpy", "chroma"])
+    def test_search_returns_best_passage_per_product(self, engine):
+        db = _db(f"chunks-{engine}", engine=engine)
+        description = f"{_words('intro', 16)} flood risk coastal exposure {_words('outro', 16)}"
+        db.add_many([
+            {"uuid": "p1", "name": "one", "description": description},
+            {"uuid": "p2", "name": "two", "description": _words("other", 20)}
+        ])
+        assert db.count() > 2
+        assert set(db.manifest()) == {"p1", "p2"}
+
+        results = db.search("flood risk coastal exposure", n_results=2, mode="vector")
+        assert [result["metadata"]["id"] for result in results] == ["p1", "p2"]
+        assert "flood risk coastal exposure" in results[0]["data"]
+        assert "intro0" not in results[0]["data"]
+
+        lexical = db.search("coastal", n_results=5, mode="lexical")
+        assert [result["metadata"]["id"] for result in lexical] == ["p1"]
+
+    def test_rewrite_and_delete_remove_all_chunks(self):
+        db = _db("chunks-rewrite")
+        db.add_many([{"uuid": "p1", "name": "one", "description": _words("long", 40)}])
+        assert db.count() == 7
+        db.add_many([{"uuid": "p1", "name": "one", "description": "now short"}])
+        assert db.count() == 1
+        assert db.search("long3", n_results=5, mode="lexical") == []
+
+        db.add_many([{"uuid": "p1", "name": "one", "description": _words("long", 40)}])
+        db.delete(["p1"])
+        assert db.count() == 0
+
+    def test_switching_chunking_replaces_documents(self):
+        db = _db("chunks-switch", chunking=None)
+        db.add_many([{"uuid": "p1", "name": "one", "description": _words("long", 20)}])
+        db.chunking = chunker.configure(CHUNKING)
+        db.add_many([{"uuid": "p1", "name": "one", "description": _words("long", 20)}])
+        assert sorted(db.export()["ids"]) == ["p1#0", "p1#1", "p1#2"]
+
+    def test_sync_by_product(self):
+        db = _db("chunks-sync")
+        engine = SyncEngine(db)
+        products = [{"uuid": f"p{index}", "name": f"n{index}", "description": _words("d", 20)}
+                    for index in range(3)]
+        assert engine.sync(products)["added"] == 3
+        stats = engine.sync(products[:2])
+        assert stats["unchanged"] == 2
+        assert stats["deleted"] == 1
+        assert set(db.manifest()) == {"p0", "p1"}
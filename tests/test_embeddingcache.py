@@ -0,0 +1,71 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+import array
+
+import numpy as np
+import pytest
+
+from embeddingcache import CachedEmbeddingFunction
+from embeddings import HashingEmbeddingFunction
+
+
+class _CountingEmbeddings():
+    def __init__(self):
+        self.embeddings = HashingEmbeddingFunction(dimensions=8)
+        self.texts = []
+
+    def __call__(self, input):
+        self.texts.extend(input)
+        return self.embeddings(input)
+
+
+class TestEmbeddingCache:
+    def test_memory_hit(self):
+        inner = _CountingEmbeddings()
+        cache = CachedEmbeddingFunction(inner, "test")
+        first = cache(["emissions", "emissions"])
+        second = cache(["emissions"])
+        assert inner.texts == ["emissions"]
+        assert first[0] == second[0]
+        assert cache.stats()["memory_hits"] == 1
+        assert cache.stats()["misses"] == 1
+
+    def test_disk_hit_after_restart(self, tmp_path):
+        path = str(tmp_path / "embeddings.db")
+        cache = CachedEmbeddingFunction(_CountingEmbeddings(), "test", path=path)
+        expected = cache(["carbon", "water"])
+
+        inner = _CountingEmbeddings()
+        restarted = CachedEmbeddingFunction(inner, "test", path=path)
+        actual = restarted(["carbon", "water"])
+        assert inner.texts == []
+        assert restarted.stats()["disk_hits"] == 2
+        for a, e in zip(actual, expected):
+            assert a == pytest.approx(e, rel=1e-6)
+
+    def test_model_name_is_part_of_key(self, tmp_path):
+        path = str(tmp_path / "embeddings.db")
+        CachedEmbeddingFunction(_CountingEmbeddings(), "model-a", path=path)(["carbon"])
+        inner = _CountingEmbeddings()
+        CachedEmbeddingFunction(inner, "model-b", path=path)(["carbon"])
+        assert inner.texts == ["carbon"]
+
+    def test_lru_eviction(self):
+        inner = _CountingEmbeddings()
+        cache = CachedEmbeddingFunction(inner, "test", max_entries=2)
+        cache(["a", "b", "c"])
+        cache(["a"])
+        assert inner.texts == ["a", "b", "c", "a"]
+        assert cache.stats()["memory_entries"] == 2
+
+    def test_memory_holds_float32_vectors(self):
+        cache = CachedEmbeddingFunction(lambda input: [np.full(4, 0.5, dtype=np.float32) for _ in input], "test")
+        first = cache(["carbon"])
+        second = cache(["carbon"])
+        # Compact in memory, plain lists for callers
+        assert all(isinstance(vector, array.array) and vector.typecode == "f" for vector in cache.memory.values())
+        assert first == second == [[0.5, 0.5, 0.5, 0.5]]
+        assert isinstance(second[0], list)
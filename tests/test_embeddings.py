@@ -0,0 +1,54 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+import math
+import pytest
+
+import embeddings
+from embeddings import HashingEmbeddingFunction, create_embedding_function
+from bgsexception import BgsException
+
+
+class TestEmbeddings:
+    def test_hash_embedding_is_deterministic(self):
+        embeddings = HashingEmbeddingFunction(dimensions=64)
+        first = embeddings(["carbon emissions by sector"])
+        second = HashingEmbeddingFunction(dimensions=64)(["carbon emissions by sector"])
+        assert first == second
+        assert len(first[0]) == 64
+
+    def test_hash_embedding_is_normalized(self):
+        embeddings = HashingEmbeddingFunction(dimensions=64)
+        vector = embeddings(["physical risk of flooding"])[0]
+        assert math.isclose(sum(v * v for v in vector), 1.0, rel_tol=1e-6)
+
+    def test_pooled_embedding_preserves_order(self):
+        embeddings = create_embedding_function({"backend": "hash", "dimensions": 32,
+                                                "batch_size": 3, "workers": 2})
+        texts = [f"product {i}" for i in range(10)]
+        assert embeddings(texts) == HashingEmbeddingFunction(dimensions=32)(texts)
+
+    def test_unknown_backend(self):
+        with pytest.raises(BgsException):
+            create_embedding_function({"backend": "unknown"})
+
+    def test_onnx_model_warmed_before_pooling(self, monkeypatch):
+        calls = []
+
+        class _Model:
+            MODEL_NAME = "model"
+
+            def __init__(self, preferred_providers):
+                pass
+
+            def __call__(self, texts):
+                calls.append(list(texts))
+                return [[1.0] for _ in texts]
+
+        monkeypatch.setattr(embeddings.embedding_functions, "ONNXMiniLM_L6_V2", _Model)
+        function = create_embedding_function({"backend": "onnx", "workers": 4})
+        # A single call loads the model before any worker can
+        assert calls == [["warm-up"]]
+        assert function(["a", "b"]) == [[1.0], [1.0]]
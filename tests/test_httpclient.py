@@ -0,0 +1,71 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+import asyncio
+import httpx
+import pytest
+
+from httpclient import HttpClientManager, CircuitBreaker, CIRCUIT_OPEN, CIRCUIT_CLOSED
+from bgsexception import BgsException
+
+CONF = {"retries": 2, "backoff_seconds": 0.0, "failure_threshold": 3, "reset_seconds": 60}
+
+
+def _run(manager, method="GET"):
+    async def scenario():
+        try:
+            return await manager.request(method, "host", 8000, "/api/test")
+        finally:
+            await manager.close()
+    return asyncio.run(scenario())
+
+
+class TestHttpClient:
+    def test_retries_server_errors(self):
+        calls = []
+
+        def handler(request):
+            calls.append(request)
+            return httpx.Response(503 if len(calls) < 3 else 200, json={"ok": True})
+
+        manager = HttpClientManager(CONF, transport=httpx.MockTransport(handler))
+        response = _run(manager)
+        assert response.status_code == 200
+        assert len(calls) == 3
+
+    def test_post_is_not_retried(self):
+        calls = []
+
+        def handler(request):
+            calls.append(request)
+            return httpx.Response(503)
+
+        manager = HttpClientManager(CONF, transport=httpx.MockTransport(handler))
+        response = _run(manager, method="POST")
+        assert response.status_code == 503
+        assert len(calls) == 1
+
+    def test_circuit_opens(self):
+        def handler(request):
+            raise httpx.ConnectError("refused")
+
+        manager = HttpClientManager(CONF, transport=httpx.MockTransport(handler))
+
+        async def scenario():
+            with pytest.raises(httpx.ConnectError):
+                await manager.request("GET", "host", 8000, "/api/test")
+            with pytest.raises(BgsException):
+                await manager.request("GET", "host", 8000, "/api/test")
+            await manager.close()
+
+        asyncio.run(scenario())
+
+    def test_circuit_breaker_half_open(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_seconds=0)
+        breaker.record_failure()
+        assert breaker.state == CIRCUIT_OPEN
+        assert breaker.allow()
+        breaker.record_success()
+        assert breaker.state == CIRCUIT_CLOSED
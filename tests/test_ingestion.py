@@ -0,0 +1,174 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+import asyncio
+import threading
+import time
+
+import pytest
+
+from bgsexception import BgsBusyException
+from ingestion import IngestionPipeline, JOB_DONE, JOB_FAILED
+
+
+class _FakeDb:
+    def __init__(self, fail_on=None):
+        self.batches = []
+        self.written = []
+        self.fail_on = fail_on
+        self.release = threading.Event()
+        self.release.set()
+        self.contents = []
+        # Seconds to spend embedding a product, by description
+        self.delays = {}
+
+    def prepare(self, products, source):
+        self.release.wait()
+        if any(product["uuid"] == self.fail_on for product in products):
+            raise ValueError("embedding failed")
+        if len({product["uuid"] for product in products}) != len(products):
+            raise ValueError("duplicate ids in batch")
+        time.sleep(max([self.delays.get(product["description"], 0) for product in products]))
+        self.batches.append(len(products))
+        return {"ids": [product["uuid"] for product in products],
+                "documents": [product["description"] for product in products]}
+
+    def write(self, prepared):
+        self.written.extend(prepared["ids"])
+        self.contents.extend(zip(prepared["ids"], prepared["documents"]))
+
+
+def _products(count, prefix="p"):
+    return [{"uuid": f"{prefix}{i}", "name": "n", "description": "d"} for i in range(count)]
+
+
+async def _wait(pipeline, job_id):
+    for _ in range(200):
+        job = pipeline.job(job_id)
+        if job["status"] in (JOB_DONE, JOB_FAILED):
+            return job
+        await asyncio.sleep(0.01)
+    raise AssertionError("job did not finish")
+
+
+class TestIngestionPipeline:
+    def test_batches_and_job_status(self):
+        db = _FakeDb()
+        pipeline = IngestionPipeline(db, {"workers": 1, "batch_size": 4, "linger_seconds": 0.01})
+
+        async def scenario():
+            await pipeline.start()
+            job = pipeline.submit(_products(10))
+            finished = await _wait(pipeline, job["id"])
+            await pipeline.stop()
+            return job, finished
+
+        job, finished = asyncio.run(scenario())
+        assert job["status"] == "queued"
+        assert finished["status"] == JOB_DONE
+        assert finished["written"] == 10
+        assert sorted(db.written) == sorted(f"p{i}" for i in range(10))
+        # Queued products are coalesced into batches
+        assert db.batches == [4, 4, 2]
+
+    def test_failure_is_reported(self):
+        db = _FakeDb(fail_on="p1")
+        pipeline = IngestionPipeline(db, {"workers": 1, "batch_size": 10, "linger_seconds": 0.01})
+
+        async def scenario():
+            await pipeline.start()
+            job = pipeline.submit(_products(3))
+            finished = await _wait(pipeline, job["id"])
+            await pipeline.stop()
+            return finished
+
+        finished = asyncio.run(scenario())
+        assert finished["status"] == JOB_FAILED
+        assert finished["failed"] == 3
+        assert finished["errors"] == ["embedding failed"]
+
+    def test_rejects_when_full(self):
+        db = _FakeDb()
+        db.release.clear()
+        pipeline = IngestionPipeline(db, {"workers": 1, "queue_depth": 5, "batch_size": 1,
+                                          "linger_seconds": 0, "retry_after_seconds": 2})
+
+        async def scenario():
+            await pipeline.start()
+            pipeline.submit(_products(5))
+            with pytest.raises(BgsBusyException) as e:
+                pipeline.submit(_products(1, prefix="q"))
+            db.release.set()
+            await pipeline.stop()
+            return e.value
+
+        error = asyncio.run(scenario())
+        assert error.status_code == 429
+        assert error.retry_after == 2
+        assert pipeline.stats()["rejected"] == 1
+        assert len(db.written) == 5
+
+    def test_rejects_oversized_submission(self):
+        pipeline = IngestionPipeline(_FakeDb(), {"queue_depth": 5})
+
+        async def scenario():
+            await pipeline.start()
+            with pytest.raises(ValueError):
+                pipeline.submit(_products(6))
+            await pipeline.stop()
+
+        asyncio.run(scenario())
+
+    def test_duplicates_in_a_batch_keep_last_submission(self):
+        db = _FakeDb()
+        pipeline = IngestionPipeline(db, {"workers": 1, "batch_size": 10, "linger_seconds": 0.01})
+
+        async def scenario():
+            await pipeline.start()
+            first = pipeline.submit([{"uuid": "a", "name": "n", "description": "old"},
+                                     {"uuid": "b", "name": "n", "description": "b"}])
+            second = pipeline.submit([{"uuid": "a", "name": "n", "description": "new"}])
+            finished = [await _wait(pipeline, job["id"]) for job in (first, second)]
+            await pipeline.stop()
+            return finished
+
+        finished = asyncio.run(scenario())
+        assert [job["status"] for job in finished] == [JOB_DONE, JOB_DONE]
+        assert sorted(db.contents) == [("a", "new"), ("b", "b")]
+
+    def test_batches_are_written_in_submission_order(self):
+        db = _FakeDb()
+        # The older version embeds slower than the newer one
+        db.delays = {"old": 0.1}
+        pipeline = IngestionPipeline(db, {"workers": 2, "batch_size": 1, "linger_seconds": 0})
+
+        async def scenario():
+            await pipeline.start()
+            first = pipeline.submit([{"uuid": "a", "name": "n", "description": "old"}])
+            second = pipeline.submit([{"uuid": "a", "name": "n", "description": "new"}])
+            for job in (first, second):
+                await _wait(pipeline, job["id"])
+            await pipeline.stop()
+
+        asyncio.run(scenario())
+        assert db.contents == [("a", "old"), ("a", "new")]
+
+    def test_later_submission_wins_with_lingering_workers(self):
+        db = _FakeDb()
+        pipeline = IngestionPipeline(db, {"workers": 2, "batch_size": 64, "linger_seconds": 0.05})
+
+        async def scenario():
+            await pipeline.start()
+            jobs = []
+            for version in ("v1", "v2", "v3"):
+                jobs.append(pipeline.submit([{"uuid": "x", "name": "n", "description": version}]))
+                # Let an idle worker take the submission before the next one
+                await asyncio.sleep(0)
+            for job in jobs:
+                await _wait(pipeline, job["id"])
+            await pipeline.stop()
+
+        asyncio.run(scenario())
+        assert db.contents[-1] == ("x", "v3")
@@ -0,0 +1,64 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+from lexical import LexicalIndex, is_identifier, matches, rrf
+
+
+def _index():
+    index = LexicalIndex()
+    index.add(["1", "2", "3"],
+              ["Emissions TSX-123 carbon emissions by company",
+               "Rainfall daily rainfall totals",
+               "Carbon price historical carbon prices"],
+              ["carbon emissions by company", "daily rainfall totals", "historical carbon prices"],
+              [{"name": "Emissions", "namespace": "a"},
+               {"name": "Rainfall", "namespace": "b"},
+               {"name": "Carbon price", "namespace": "b"}])
+    return index
+
+
+class TestLexicalIndex:
+    def test_search_ranks_by_bm25(self):
+        results = _index().search("carbon", 3)
+        assert [result["id"] for result in results] == ["3", "1"]
+        assert results[0]["score"] > results[1]["score"]
+        assert results[0]["data"] == "historical carbon prices"
+
+    def test_identifier(self):
+        results = _index().search("TSX-123", 3)
+        assert [result["id"] for result in results] == ["1"]
+
+    def test_where(self):
+        results = _index().search("carbon", 3, where={"namespace": "a"})
+        assert [result["id"] for result in results] == ["1"]
+
+    def test_replace_and_delete(self):
+        index = _index()
+        index.add(["3"], ["Wind speed"], ["wind speed"], [{"name": "Wind"}])
+        assert [result["id"] for result in index.search("carbon", 3)] == ["1"]
+        index.delete(["1", "3"])
+        assert index.search("carbon", 3) == []
+        assert index.count() == 1
+        assert index.total_length == 4
+
+
+class TestHelpers:
+    def test_is_identifier(self):
+        assert is_identifier("TSX-123")
+        assert is_identifier("AAPL")
+        assert is_identifier("0f8fad5b-d9cb-469f-a165-70867728950e")
+        assert not is_identifier("carbon")
+        assert not is_identifier("carbon emissions 2020")
+
+    def test_matches(self):
+        meta = {"name": "x", "tag:a": True}
+        assert matches(None, meta)
+        assert matches({"$and": [{"name": "x"}, {"tag:a": True}]}, meta)
+        assert not matches({"$and": [{"name": "x"}, {"tag:b": True}]}, meta)
+        assert matches({"name": {"$eq": "x"}}, meta)
+
+    def test_rrf(self):
+        scores = rrf([["a", "b"], ["b", "c"]], k=60)
+        assert scores["b"] > scores["a"] > scores["c"]
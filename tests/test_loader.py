@@ -0,0 +1,120 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+import asyncio
+import json
+import os
+
+import httpx
+import pytest
+
+import httpclient
+from loader import RegistrarLoader, iter_json_items
+from sync import SyncEngine
+from tests.test_sync import _FakeDb
+
+REGISTRAR = {"host": "registrar", "port": 8000, "service": "/api/registrar/products", "method": "GET"}
+
+
+def _products(count):
+    return [{"uuid": f"u{i}", "name": f"name{i}", "description": f"description{i}"} for i in range(count)]
+
+
+async def _chunks(data: bytes, size: int):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+async def _collect(data: bytes, size: int):
+    return [item async for item in iter_json_items(_chunks(data, size))]
+
+
+class TestIterJsonItems:
+    def test_array_in_small_chunks(self):
+        products = _products(5)
+        data = json.dumps(products, indent=2).encode("utf-8")
+        assert asyncio.run(_collect(data, 7)) == products
+
+    def test_ndjson(self):
+        products = _products(3)
+        data = "\n".join(json.dumps(product) for product in products).encode("utf-8")
+        assert asyncio.run(_collect(data, 5)) == products
+
+    def test_multibyte_characters_split_across_chunks(self):
+        products = [{"uuid": "u1", "name": "é", "description": "données"}]
+        assert asyncio.run(_collect(json.dumps(products, ensure_ascii=False).encode("utf-8"), 1)) == products
+
+    def test_truncated(self):
+        with pytest.raises(ValueError):
+            asyncio.run(_collect(b'[{"uuid": "u1"}, {"uuid"', 4))
+
+
+class TestRegistrarLoader:
+    def _configure(self, handler):
+        httpclient.configure({"retries": 0}, transport=httpx.MockTransport(handler))
+
+    def test_stream_load(self):
+        products = _products(7)
+        self._configure(lambda request: httpx.Response(200, json=products))
+        db = _FakeDb()
+        loader = RegistrarLoader(SyncEngine(db), {**REGISTRAR, "batch_size": 3})
+        stats = asyncio.run(loader.load())
+        assert stats["added"] == 7
+        assert stats["consumed"] == 7
+        assert db.count() == 7
+
+    def test_paged_load(self):
+        products = _products(5)
+        requests = []
+
+        def handler(request):
+            offset = int(request.url.params["offset"])
+            limit = int(request.url.params["limit"])
+            requests.append(offset)
+            return httpx.Response(200, json=products[offset:offset + limit])
+
+        self._configure(handler)
+        db = _FakeDb()
+        loader = RegistrarLoader(SyncEngine(db), {**REGISTRAR, "page_size": 2, "batch_size": 2})
+        stats = asyncio.run(loader.load())
+        assert requests == [0, 2, 4]
+        assert stats["added"] == 5
+
+    def test_resume_from_checkpoint(self, tmp_path):
+        products = _products(6)
+        path = str(tmp_path / "checkpoint.json")
+        failing = {"enabled": True}
+
+        def handler(request):
+            offset = int(request.url.params["offset"])
+            if failing["enabled"] and offset >= 4:
+                return httpx.Response(500)
+            return httpx.Response(200, json=products[offset:offset + 2])
+
+        self._configure(handler)
+        db = _FakeDb()
+        conf = {**REGISTRAR, "page_size": 2, "batch_size": 2, "checkpoint_path": path, "checkpoint_batches": 1}
+        with pytest.raises(httpx.HTTPStatusError):
+            asyncio.run(RegistrarLoader(SyncEngine(db), conf).load())
+        assert db.count() == 4
+        checkpoint = json.load(open(path))
+        assert checkpoint["offset"] == 4
+        # Applied ids are appended to a companion file, not rewritten each time
+        assert "seen" not in checkpoint
+        with open(path + ".seen") as file:
+            assert file.read().split() == ["u0", "u1", "u2", "u3"]
+        # An append that was not committed by a checkpoint is ignored
+        with open(path + ".seen", "a") as file:
+            file.write("u9\n")
+
+        failing["enabled"] = False
+        stats = asyncio.run(RegistrarLoader(SyncEngine(db), conf).load())
+        assert stats["resumed_from"] == 4
+        assert stats["added"] == 2
+        # Products applied before the interruption are not deleted
+        assert stats["deleted"] == 0
+        assert db.count() == 6
+        assert not os.path.exists(path)
+        assert not os.path.exists(path + ".seen")
@@ -0,0 +1,44 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+import pytest
+
+from metrics import Registry, status_class
+
+
+class TestMetrics:
+    def test_histogram(self):
+        registry = Registry()
+        histogram = registry.histogram("latency_seconds", "latency", ("route",), buckets=(0.1, 1.0))
+        histogram.labels(route="/a").observe(0.05)
+        histogram.labels(route="/a").observe(0.5)
+        histogram.labels(route="/a").observe(5.0)
+        series = registry.to_dict()["latency_seconds"]["series"][0]
+        assert series["labels"] == {"route": "/a"}
+        assert series["count"] == 3
+        assert series["buckets"] == {"0.1": 1, "1.0": 2}
+        assert series["p50"] == 1.0
+
+    def test_prometheus_exposition(self):
+        registry = Registry()
+        registry.counter("requests_total", "requests", ("status",)).labels(status="2xx").inc()
+        registry.gauge("size", "size").set_function(lambda: 42)
+        registry.histogram("latency_seconds", "latency", buckets=(0.1,)).observe(0.05)
+        text = registry.to_prometheus()
+        assert '# TYPE requests_total counter' in text
+        assert 'requests_total{status="2xx"} 1.0' in text
+        assert 'size 42.0' in text
+        assert 'latency_seconds_bucket{le="0.1"} 1' in text
+        assert 'latency_seconds_bucket{le="+Inf"} 1' in text
+        assert 'latency_seconds_count 1' in text
+
+    def test_labels_required(self):
+        registry = Registry()
+        histogram = registry.histogram("latency_seconds", "latency", ("route",))
+        with pytest.raises(ValueError):
+            histogram.observe(1.0)
+
+    def test_status_class(self):
+        assert status_class(404) == "4xx"
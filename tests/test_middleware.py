@@ -0,0 +1,49 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+import logging
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import middleware
+from middleware import LoggingMiddleware, HEADER_CORRELATION_ID
+
+
+def _client():
+    app = FastAPI()
+    app.add_middleware(LoggingMiddleware)
+
+    @app.post("/echo")
+    async def echo(params: dict):
+        return params
+
+    return TestClient(app)
+
+
+class TestMiddleware:
+    def teardown_method(self):
+        middleware.configure()
+
+    def test_correlation_id_added(self):
+        response = _client().post("/echo", json={"a": 1})
+        assert response.status_code == 200
+        assert response.headers.get(HEADER_CORRELATION_ID)
+
+    def test_payload_truncated(self, caplog):
+        middleware.configure({"sample_rate": 1.0, "max_payload": 10})
+        with caplog.at_level(logging.INFO, logger="middleware"):
+            _client().post("/echo", json={"text": "x" * 100})
+        messages = [r.getMessage() for r in caplog.records if "-REQ:" in r.getMessage()]
+        assert len(messages) == 1
+        assert "more bytes" in messages[0]
+        assert "x" * 20 not in messages[0]
+
+    def test_unsampled_requests_not_logged(self, caplog):
+        middleware.configure({"sample_rate": 0.0})
+        with caplog.at_level(logging.INFO, logger="middleware"):
+            _client().post("/echo", json={"a": 1})
+        assert not [r for r in caplog.records if "TRACE-" in r.getMessage()]
+        assert not [r for r in caplog.records if "Missing header" in r.getMessage()]
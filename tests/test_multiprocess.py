@@ -0,0 +1,57 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+import json
+import os
+
+import metrics
+from multiprocess import MetricsPublisher, ROLE_READER, ROLE_WRITER
+
+
+def _registry():
+    registry = metrics.Registry()
+    registry.counter("requests", "Requests", ("route",))
+    registry.histogram("latency", "Latency", buckets=(0.1, 1.0))
+    registry.gauge("size", "Size", aggregate=metrics.AGGREGATE_MAX)
+    registry.gauge("queued", "Queued")
+    return registry
+
+
+class TestMerge:
+    def test_merge(self):
+        first = _registry()
+        first.metrics["requests"].labels(route="/a").inc(2)
+        first.metrics["latency"].observe(0.05)
+        first.metrics["size"].set(10)
+        first.metrics["queued"].set(1)
+        second = _registry()
+        second.metrics["requests"].labels(route="/a").inc(3)
+        second.metrics["latency"].observe(0.5)
+        second.metrics["size"].set(7)
+        second.metrics["queued"].set(float("nan"))
+
+        merged = first.merge([first.export(), second.export()]).to_dict()
+        assert merged["requests"]["series"][0]["value"] == 5
+        assert merged["latency"]["series"][0]["count"] == 2
+        assert merged["latency"]["series"][0]["buckets"] == {"0.1": 1, "1.0": 2}
+        assert merged["size"]["series"][0]["value"] == 10
+        assert merged["queued"]["series"][0]["value"] == 1
+
+
+class TestMetricsPublisher:
+    def test_collect(self, tmp_path):
+        directory = str(tmp_path)
+        other = _registry()
+        other.metrics["requests"].labels(route="/a").inc(4)
+        # A running process (this one, under another role) and an exited one
+        MetricsPublisher(directory, ROLE_WRITER, other).publish()
+        with open(os.path.join(directory, "reader-0.json"), "w") as file:
+            json.dump({"pid": 0, "role": ROLE_READER, "metrics": other.export()}, file)
+
+        own = _registry()
+        own.metrics["requests"].labels(route="/a").inc(1)
+        publisher = MetricsPublisher(directory, ROLE_READER, own)
+        merged = publisher.collect().to_dict()
+        assert merged["requests"]["series"][0]["value"] == 5
@@ -0,0 +1,99 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+import threading
+
+import pytest
+
+import metrics
+from reranker import Reranker, OverlapCrossEncoder, OUTCOME_DONE, OUTCOME_TIMEOUT
+from searchdb import SearchDb
+
+RERANK = {"enabled": True, "backend": "overlap", "top_n": 10, "budget_ms": 1000}
+
+
+class _SlowModel(OverlapCrossEncoder):
+    def __init__(self):
+        self.release = threading.Event()
+
+    def score(self, pairs):
+        self.release.wait(5)
+        return super().score(pairs)
+
+
+def _hits(*texts):
+    return [{"id": str(index), "data": text, "metadata": {"id": str(index)}, "score": 1.0 - index / 10}
+            for index, text in enumerate(texts)]
+
+
+def _db(name, rerank=RERANK, model=None):
+    db = SearchDb("test", name, False, {}, embedding={"backend": "hash", "dimensions": 64},
+                  engine="numpy", rerank=rerank, result_cache={"enabled": True})
+    if model is not None:
+        db.reranker.model = model
+    return db
+
+
+class TestReranker:
+    def test_rerank_reorders_top_n(self):
+        reranker = Reranker(RERANK)
+        hits = _hits("storm", "flood risk", "flood", "flood risk maps")
+        reranked = reranker.rerank([("flood risk", hits)], top_n=3, budget_ms=1000)[0]
+        assert [hit["id"] for hit in reranked] == ["1", "2", "0", "3"]
+        assert reranked[0]["score"] == 1.0
+        # Beyond top_n the first-stage hit is unchanged
+        assert reranked[3] == hits[3]
+        assert reranker.stats()[OUTCOME_DONE] == 1
+
+    def test_options(self):
+        reranker = Reranker({**RERANK, "default": False})
+        assert reranker.options() == {"enabled": False, "top_n": 10, "budget_ms": 1000.0}
+        assert reranker.options({"enabled": True, "top_n": None, "budget_ms": 5}) == \
+            {"enabled": True, "top_n": 10, "budget_ms": 5}
+
+    def test_budget_exceeded_falls_back(self):
+        model = _SlowModel()
+        reranker = Reranker(RERANK, model=model)
+        timeouts = metrics.RERANK_SECONDS.labels(outcome=OUTCOME_TIMEOUT).snapshot()["count"]
+        try:
+            assert reranker.rerank([("flood", _hits("flood"))], top_n=5, budget_ms=20) is None
+        finally:
+            model.release.set()
+        assert reranker.stats()[OUTCOME_TIMEOUT] == 1
+        assert metrics.RERANK_SECONDS.labels(outcome=OUTCOME_TIMEOUT).snapshot()["count"] == timeouts + 1
+
+    def test_search_reranks_per_request(self):
+        db = _db("rerank-search")
+        db.add_many([
+            {"uuid": "a", "name": "alpha", "description": "flood flood flood flood coastal"},
+            {"uuid": "b", "name": "beta", "description": "flood coastal risk exposure maps"},
+            {"uuid": "c", "name": "gamma", "description": "drought"}
+        ])
+        query = "coastal flood risk exposure"
+        reranked = db.search(query, n_results=2, mode="vector")
+        assert reranked[0]["metadata"]["id"] == "b"
+        assert reranked[0]["score"] == 1.0
+
+        plain = db.search(query, n_results=3, mode="vector", rerank={"enabled": False})
+        assert [result["score"] for result in plain] == sorted([result["score"] for result in plain], reverse=True)
+        assert db.rerank_stats()[OUTCOME_DONE] == 1
+
+    def test_fallback_is_not_cached(self):
+        model = _SlowModel()
+        db = _db("rerank-fallback", model=model)
+        db.add_many([{"uuid": "a", "name": "alpha", "description": "flood"}])
+        try:
+            results = db.search("flood", mode="vector", rerank={"budget_ms": 10})
+        finally:
+            model.release.set()
+        assert [result["metadata"]["id"] for result in results] == ["a"]
+        assert db.result_stats()["entries"] == 0
+
+    def test_disabled_without_configuration(self):
+        db = _db("rerank-off", rerank=None)
+        db.add_many([{"uuid": "a", "name": "alpha", "description": "flood"}])
+        assert db.reranker is None
+        assert db.search("flood", mode="vector", rerank={"enabled": True})[0]["metadata"]["id"] == "a"
+        assert db.rerank_stats() == {}
@@ -0,0 +1,41 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+import time
+import pytest
+
+from resultcache import ResultCache
+
+
+class TestResultCache:
+    def test_hit_and_miss(self):
+        cache = ResultCache(max_entries=10)
+        assert cache.get("key") is None
+        cache.put("key", [{"data": "value"}])
+        assert cache.get("key") == [{"data": "value"}]
+        assert cache.stats()["hits"] == 1
+        assert cache.stats()["misses"] == 1
+
+    def test_values_are_copied(self):
+        cache = ResultCache(max_entries=10)
+        cache.put("key", [{"data": "value"}])
+        cache.get("key")[0]["artifact"] = []
+        assert cache.get("key") == [{"data": "value"}]
+
+    def test_lru_eviction(self):
+        cache = ResultCache(max_entries=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+        assert cache.get("b") is None
+        assert cache.get("a") == 1
+        assert cache.stats()["evictions"] == 1
+
+    def test_ttl_expiry(self):
+        cache = ResultCache(max_entries=10, ttl_seconds=0.01)
+        cache.put("key", 1)
+        time.sleep(0.02)
+        assert cache.get("key") is None
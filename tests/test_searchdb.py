@@ -5,44 +5,429 @@
 # https://opensource.org/licenses/MIT.
 #
 # Created: 2024-05-02 by graeham.broda@gmail.com
+import asyncio
+import os
+import threading
+import time
+
+import httpx
 import pytest
 import yaml
 
-from  src.searchdb import SearchDb
-from src.bgsexception import BgsException
+import httpclient
+
+from searchdb import SearchDb, TAG_PREFIX, build_where, decode_cursor, encode_cursor
+from bgsexception import BgsException
 # from state import gstate
 
 db: SearchDb = None
 
+# Deterministic local embeddings, no model download or API key needed
+EMBEDDING = {"backend": "hash"}
+
+
 class TestSearchdb:
     def test_add_data_successful(self):
         db = SearchDb("test",
-                      "test",
-                      False)
+                      "test-add",
+                      False,
+                      {},
+                      embedding=EMBEDDING)
         data_id = "id1"
         db.add_data(data_id, "name1", "description1")
         res = db.search("description1")
         res_id = res[0]["metadata"]["id"]
-        assert data_id == data_id
+        assert res_id == data_id
 
 
     def test_search(self):
         db = SearchDb("test",
-                      "test",
-                      False)
+                      "test-search",
+                      False,
+                      {},
+                      embedding=EMBEDDING)
         data_id = "id2"
         db.add_data("1231231231", "name1", "this is a sample description, orange")
         db.add_data(data_id, "name2", "this is a sample description, purple")
 
         res = db.search("purple")
         res_id = res[0]["metadata"]["id"]
-        assert data_id == data_id
+        assert res_id == data_id
 
     def test_search_no_results(self):
         db = SearchDb("test",
-                      "test",
-                      False)
+                      "test-empty",
+                      False,
+                      {},
+                      embedding=EMBEDDING)
 
         res = db.search("purple")
         assert len(res) == 0
 
+
+def _products(count, prefix="p"):
+    return [{"uuid": f"{prefix}{index}", "name": f"name{index}",
+             "description": f"description {index} flood risk {'coastal' if index % 2 else 'inland'}"}
+            for index in range(count)]
+
+
+class TestRebuild:
+    def test_rebuild_applies_settings_and_compacts(self):
+        db = SearchDb("test", "test-rebuild", False, {}, embedding=EMBEDDING)
+        db.add_many(_products(20))
+        db.delete([f"p{index}" for index in range(10)])
+        assert db.vector_stats()["hnsw"]["space"] == "l2"
+
+        stats = db.rebuild({"space": "cosine", "search_ef": 50})
+        assert stats["collection"] == "test-rebuild-v1"
+        assert stats["copied"] == 10
+        assert db.count() == 10
+        vector = db.vector_stats()
+        assert vector["hnsw"]["space"] == "cosine"
+        assert vector["hnsw"]["search_ef"] == 50
+        assert "test-rebuild" not in [collection.name for collection in db.client.list_collections()]
+
+        res = db.search("description 15 flood risk coastal", mode="vector")
+        assert res[0]["metadata"]["id"] == "p15"
+        assert res[0]["score"] == pytest.approx(1.0 - res[0]["distance"])
+
+    def test_writes_during_rebuild_are_replayed(self):
+        db = SearchDb("test", "test-rebuild-journal", False, {}, embedding=EMBEDDING)
+        db.add_many(_products(10))
+        copy = db._copy
+
+        def copy_while_writing(source, target, ids):
+            if db.journal is not None and not db.journal["upserted"] and not db.journal["deleted"]:
+                db.add_many(_products(2, prefix="new"))
+                db.delete(["p0"])
+            return copy(source, target, ids)
+
+        db._copy = copy_while_writing
+        stats = db.rebuild()
+        assert stats["replayed"] == 2
+        assert set(db.manifest()) == {f"p{index}" for index in range(1, 10)} | {"new0", "new1"}
+        assert db.journal is None
+
+    def test_rebuild_is_exclusive(self):
+        db = SearchDb("test", "test-rebuild-busy", False, {}, embedding=EMBEDDING)
+        db.rebuild_lock.acquire()
+        try:
+            with pytest.raises(BgsException):
+                db.rebuild()
+        finally:
+            db.rebuild_lock.release()
+
+    def test_persisted_rebuild_survives_restart(self, tmp_path):
+        location = str(tmp_path)
+        db = SearchDb(location, "numpy-rebuild", True, {}, embedding=EMBEDDING, engine="numpy")
+        db.add_many(_products(5))
+        db.rebuild()
+        assert sorted(os.listdir(location)) == ["numpy-rebuild-v1.json", "numpy-rebuild-v1.npy"]
+
+        # An unfinished rebuild (newer version) is dropped at startup
+        with open(os.path.join(location, "numpy-rebuild-v2.json"), "w") as file:
+            file.write('{"ids": [], "documents": [], "metadatas": []}')
+        reopened = SearchDb(location, "numpy-rebuild", True, {}, embedding=EMBEDDING, engine="numpy")
+        assert reopened.collection_version == 1
+        assert reopened.count() == 5
+        assert not os.path.exists(os.path.join(location, "numpy-rebuild-v2.json"))
+
+
+class TestCoalescing:
+    def _proxy(self, latency=0.01, status=200):
+        calls = []
+
+        async def handler(request):
+            calls.append(request.url.path)
+            await asyncio.sleep(latency)
+            return httpx.Response(status, json=[{"uuid": "a1", "name": "artifact"}])
+
+        httpclient.configure({"retries": 0}, transport=httpx.MockTransport(handler))
+        return calls
+
+    def test_identical_queries_share_one_search(self):
+        db = SearchDb("test", "test-coalesce", False, {}, embedding=EMBEDDING)
+        db.add_many(_products(5))
+        searched = []
+        search = db.search
+
+        def counting_search(*args, **kwargs):
+            searched.append(args[0])
+            time.sleep(0.02)
+            return search(*args, **kwargs)
+
+        db.search = counting_search
+
+        async def scenario():
+            return await asyncio.gather(*[db.asearch(query, n_results=2)
+                                          for query in ["Flood risk", "flood  RISK", "flood risk", "other"]])
+
+        results = asyncio.run(scenario())
+        assert len(searched) == 2
+        assert results[0] == results[1] == results[2]
+        assert db.coalesce_stats()["query"]["coalesced"] == 2
+
+    def test_artifact_lookups_are_coalesced_and_cached(self):
+        calls = self._proxy()
+        db = SearchDb("test", "test-coalesce-artifacts", False, {}, embedding=EMBEDDING,
+                      proxy={"host": "proxy", "port": 8000})
+        db.add_many(_products(3))
+
+        async def scenario():
+            return await asyncio.gather(*[db.search_artifacts(f"description {index % 3}", n_results=3, mode="lexical")
+                                          for index in range(6)])
+
+        results = asyncio.run(scenario())
+        assert all(result["artifact"] == [{"uuid": "a1", "name": "artifact"}]
+                   for res in results for result in res)
+        # One proxy call per product, then served from the cache
+        assert sorted(calls) == sorted(f"/api/dataproduct/discovery/uuid/p{index}/artifacts" for index in range(3))
+        asyncio.run(db.search_artifacts("description 1", n_results=3, mode="lexical"))
+        assert len(calls) == 3
+        assert db.artifact_stats()["hits"] >= 3
+
+    def test_failed_artifact_lookup_is_not_cached(self):
+        calls = self._proxy(latency=0, status=500)
+        db = SearchDb("test", "test-coalesce-failure", False, {}, embedding=EMBEDDING,
+                      proxy={"host": "proxy", "port": 8000})
+        db.add_many(_products(1))
+        for _ in range(2):
+            res = asyncio.run(db.search_artifacts("description 0", mode="lexical"))
+            assert res[0]["artifact"] == [] and "error" in res[0]
+        assert len(calls) == 2
+
+
+class TestRebuildUnderLoad:
+    def test_queries_during_rebuilds_do_not_fail(self):
+        db = SearchDb("test", "test-rebuild-load", False, {}, embedding=EMBEDDING)
+        db.add_many(_products(200))
+        errors = []
+        done = threading.Event()
+
+        def query():
+            while not done.is_set():
+                try:
+                    db.search("flood risk coastal", n_results=5, mode="vector")
+                    db.count()
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=query) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        try:
+            for _ in range(5):
+                db.rebuild()
+        finally:
+            done.set()
+            for thread in threads:
+                thread.join()
+        assert errors == []
+        assert db.collection_version == 5
+
+
+class TestMinScore:
+    def test_min_score_applies_to_similarity_in_every_mode(self):
+        db = SearchDb("test", "test-min-score", False, {}, embedding=EMBEDDING)
+        db.add_many(_products(10))
+        query = "description 3 flood risk coastal"
+
+        vector = db.search(query, n_results=10, mode="vector", min_score=0.99)
+        assert [res["metadata"]["id"] for res in vector] == ["p3"]
+
+        # Fused scores are far below the threshold, the similarity is not
+        hybrid = db.search(query, n_results=10, mode="hybrid", min_score=0.99)
+        assert hybrid[0]["metadata"]["id"] == "p3"
+        assert hybrid[0]["score"] < 0.99
+        auto = db.search(query, n_results=10, min_score=0.99)
+        assert auto[0]["metadata"]["id"] == "p3"
+
+        # Lexical mode thresholds the BM25 score
+        lexical = db.search(query, n_results=10, mode="lexical")
+        cutoff = lexical[1]["score"]
+        filtered = db.search(query, n_results=10, mode="lexical", min_score=cutoff)
+        assert filtered == [res for res in lexical if res["score"] >= cutoff]
+        assert 0 < len(filtered) < len(lexical)
+
+    def test_min_score_applies_to_identifier_queries_in_auto_mode(self):
+        db = SearchDb("test", "test-min-score-auto", False, {}, embedding=EMBEDDING)
+        db.add_many([{"uuid": "a", "name": "a", "description": "ticker ABC-123 flood"},
+                     {"uuid": "b", "name": "b", "description": "ticker ABC-123 drought"}])
+        # Identifier-like queries are answered lexically in auto mode
+        assert len(db.search("ABC-123", n_results=10)) == 2
+        assert db.search("ABC-123", n_results=10, min_score=1e9) == []
+        assert db.search("ABC-123", n_results=10, mode="lexical", min_score=1e9) == []
+
+
+class TestFiltersAndPaging:
+    def test_build_where(self):
+        assert build_where() is None
+        assert build_where(name="n1") == {"name": "n1"}
+        assert build_where(namespace="ns", tags=["flood", "coastal"]) == {
+            "$and": [{"namespace": "ns"}, {f"{TAG_PREFIX}flood": True}, {f"{TAG_PREFIX}coastal": True}]}
+
+    def test_cursor_round_trip(self):
+        assert decode_cursor(encode_cursor(0)) == 0
+        assert decode_cursor(encode_cursor(40)) == 40
+        for cursor in ["not-a-cursor", encode_cursor(-1), ""]:
+            with pytest.raises(ValueError):
+                decode_cursor(cursor)
+
+    def test_tag_and_namespace_filters(self):
+        db = SearchDb("test", "test-filters", False, {}, embedding=EMBEDDING)
+        db.add_many([
+            {"uuid": "a", "name": "a", "description": "flood risk", "namespace": "ns1", "tags": ["flood", "coastal"]},
+            {"uuid": "b", "name": "b", "description": "flood risk", "namespace": "ns1", "tags": ["flood"]},
+            {"uuid": "c", "name": "c", "description": "flood risk", "namespace": "ns2", "tags": ["flood", "coastal"]}
+        ])
+        for mode in ("vector", "lexical"):
+            res = db.search("flood risk", n_results=10, mode=mode, where=build_where(tags=["flood", "coastal"]))
+            assert sorted(hit["metadata"]["id"] for hit in res) == ["a", "c"]
+            res = db.search("flood risk", n_results=10, mode=mode,
+                            where=build_where(namespace="ns1", tags=["coastal"]))
+            assert [hit["metadata"]["id"] for hit in res] == ["a"]
+            # Tags are returned as a list, without the internal tag keys
+            assert res[0]["metadata"]["tags"] == ["flood", "coastal"]
+            assert not any(key.startswith(TAG_PREFIX) for key in res[0]["metadata"])
+
+    def test_offset_paging(self):
+        db = SearchDb("test", "test-paging", False, {}, embedding=EMBEDDING)
+        # Distinct similarities, so the order does not depend on ties
+        db.add_many([{"uuid": f"p{index}", "name": f"name{index}", "description": "flood " * (index + 1) + "risk"}
+                     for index in range(10)])
+        query = "flood risk"
+        everything = db.search(query, n_results=6, mode="vector")
+        pages = [db.search(query, n_results=3, offset=offset, mode="vector") for offset in (0, 3)]
+        assert pages[0] + pages[1] == everything
+        assert db.search(query, n_results=3, offset=9, mode="vector") == \
+            db.search(query, n_results=10, mode="vector")[9:]
+        assert db.search(query, n_results=3, offset=10, mode="vector") == []
+
+
+class TestSearchMany:
+    def test_one_embedding_call_and_one_query_per_batch(self):
+        db = SearchDb("test", "test-search-many", False, {}, embedding=EMBEDDING, engine="numpy",
+                      result_cache={"enabled": True})
+        db.add_many([{"uuid": f"p{index}", "name": f"name{index}", "description": "flood " * (index + 1) + "risk"}
+                     for index in range(10)])
+        queries = ["flood risk", "flood flood flood risk", "risk", "flood " * 9 + "risk"]
+        expected = [db.search(query, n_results=3, mode="vector") for query in queries]
+        db.result_cache.clear()
+
+        embedded = []
+        queried = []
+        embeddings, query = db.embeddings, db.collection.query
+        db.embeddings = lambda texts: embedded.append(list(texts)) or embeddings(texts)
+        db.collection.query = lambda **kwargs: queried.append(len(kwargs["query_embeddings"])) or query(**kwargs)
+
+        # Results come back in the order of the queries
+        assert db.search_many(queries[:2], n_results=3, mode="vector") == expected[:2]
+        assert (embedded, queried) == ([queries[:2]], [2])
+
+        # Cached queries are answered without embedding or querying them
+        embedded.clear()
+        queried.clear()
+        mixed = [queries[2], queries[0], queries[3], queries[1]]
+        assert db.search_many(mixed, n_results=3, mode="vector") == [expected[2], expected[0], expected[3], expected[1]]
+        assert (embedded, queried) == ([[queries[2], queries[3]]], [2])
+        assert db.result_stats()["hits"] >= 2
+
+
+class TestResultCaching:
+    def test_results_are_cached_until_a_write(self):
+        db = SearchDb("test", "test-result-cache", False, {}, embedding=EMBEDDING,
+                      result_cache={"enabled": True})
+        db.add_many(_products(3))
+        embedded = []
+        embeddings = db.embeddings
+        db.embeddings = lambda texts: embedded.append(list(texts)) or embeddings(texts)
+
+        def search():
+            return db.search("description 1 flood risk coastal", n_results=5, mode="vector")
+
+        first = search()
+        assert search() == first
+        assert len(embedded) == 1
+        assert db.result_stats()["hits"] == 1
+
+        # Every kind of write invalidates the cached results
+        contents = db.export()
+        writes = [
+            lambda: db.add_many(_products(1, prefix="new")),
+            # Restoring the earlier contents removes the new product
+            lambda: db.restore(contents["ids"], contents["embeddings"], contents["documents"],
+                               contents["metadatas"], replace=True),
+            lambda: db.delete(["p0"])
+        ]
+        for write in writes:
+            generation = db.generation
+            write()
+            assert db.generation > generation
+            calls = len(embedded)
+            search()
+            assert len(embedded) == calls + 1
+        assert [hit["metadata"]["id"] for hit in search()] == [hit["metadata"]["id"] for hit in first
+                                                              if hit["metadata"]["id"] != "p0"]
+
+
+class TestReadOnly:
+    def test_reader_follows_the_writer_files(self, tmp_path):
+        location = str(tmp_path)
+        numpy = {"save_interval_seconds": 0}
+        writer = SearchDb(location, "shared", True, {}, embedding=EMBEDDING, engine="numpy", numpy=numpy)
+        writer.add_many(_products(5))
+        reader = SearchDb(location, "shared", True, {}, embedding=EMBEDDING, engine="numpy", numpy=numpy,
+                          read_only=True)
+        assert reader.count() == 5
+        # Vectors are mapped from the writer's file, not copied
+        assert reader.vector_stats()["mmap"]
+        assert reader.vector_stats()["resident_bytes"] == 0
+        assert not reader.reload()
+
+        writer.add_many(_products(2, prefix="new"))
+        generation = reader.generation
+        assert reader.reload()
+        assert reader.generation > generation
+        assert reader.count() == 7
+        assert reader.search("description 1 flood risk coastal", mode="vector")[0]["metadata"]["id"] in ("p1", "new1")
+        assert reader.lexical.count() == 7
+
+        # A reader never drops the writer's files (e.g. a rebuild in progress)
+        writer.rebuild()
+        assert reader.reload()
+        assert reader.collection_version == 1
+        assert sorted(os.listdir(location)) == ["shared-v1.json", "shared-v1.npy"]
+
+    def test_reader_rejects_mismatched_files(self, tmp_path):
+        location = str(tmp_path)
+        writer = SearchDb(location, "shared", True, {}, embedding=EMBEDDING, engine="numpy")
+        writer.add_many(_products(3))
+        reader = SearchDb(location, "shared", True, {}, embedding=EMBEDDING, engine="numpy", read_only=True)
+        # Documents of a newer save next to the older matrix
+        path = os.path.join(location, "shared")
+        os.replace(path + ".npy", path + ".old")
+        writer.add_many(_products(1, prefix="new"))
+        writer.flush()
+        os.replace(path + ".old", path + ".npy")
+        with pytest.raises(ValueError):
+            reader.reload()
+        assert reader.count() == 3
+
+    def test_read_only_requires_persisted_numpy(self):
+        with pytest.raises(ValueError):
+            SearchDb("test", "test-read-only", False, {}, embedding=EMBEDDING, engine="numpy", read_only=True)
+
+    def test_saves_are_deferred_to_flush(self, tmp_path):
+        location = str(tmp_path)
+        db = SearchDb(location, "deferred", True, {}, embedding=EMBEDDING, engine="numpy",
+                      numpy={"save_interval_seconds": 3600})
+        db.add_many(_products(2))
+        db.add_many(_products(2, prefix="new"))
+
+        def saved():
+            return SearchDb(location, "deferred", True, {}, embedding=EMBEDDING, engine="numpy",
+                            read_only=True).count()
+
+        assert saved() == 2
+        db.flush()
+        assert saved() == 4
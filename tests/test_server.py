@@ -0,0 +1,148 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+import time
+import uuid
+
+import httpx
+import pytest
+import yaml
+from fastapi.testclient import TestClient
+
+import httpclient
+import server
+import state
+from multiprocess import ROLE_READER, ROLE_SINGLE
+from searchdb import SearchDb, encode_cursor
+
+EMBEDDING = {"backend": "hash"}
+QUERY = server.ENDPOINT_PREFIX + "/query"
+
+
+def _products(count):
+    # Distinct similarities to "flood risk", so the order does not depend on ties
+    return [{"uuid": f"p{index}", "name": f"name{index}", "description": "flood " * (index + 1) + "risk"}
+            for index in range(count)]
+
+
+@pytest.fixture
+def client():
+    # Endpoints use the module's database; startup (loading, pipeline) is not run
+    previous = server.db
+    server.db = SearchDb("test", f"test-server-{uuid.uuid4().hex}", False, {}, embedding=EMBEDDING)
+    server.db.add_many(_products(7))
+    yield TestClient(server.app)
+    server.db = previous
+
+
+class TestQueryPaging:
+    def test_cursor_round_trip(self, client):
+        seen = []
+        body = {"query": "flood risk", "k": 3, "mode": "vector"}
+        pages = 0
+        while True:
+            response = client.post(QUERY, json=body)
+            assert response.status_code == 200
+            page = response.json()
+            seen.extend(hit["metadata"]["id"] for hit in page["data"])
+            pages += 1
+            if "next_cursor" not in page:
+                break
+            body = {**body, "cursor": page["next_cursor"]}
+        # Full pages carry a cursor; the last (partial) page does not
+        assert pages == 3
+        assert sorted(seen) == sorted(f"p{index}" for index in range(7))
+
+    def test_cursor_matches_offset(self, client):
+        by_cursor = client.post(QUERY, json={"query": "flood risk", "k": 2, "cursor": encode_cursor(4),
+                                             "mode": "vector"}).json()
+        by_offset = client.post(QUERY, json={"query": "flood risk", "k": 2, "offset": 4, "mode": "vector"}).json()
+        assert by_cursor == by_offset
+        assert by_cursor["next_cursor"] == encode_cursor(6)
+
+    @pytest.mark.parametrize("cursor", ["not-a-cursor", encode_cursor(-5)])
+    def test_bad_cursor_is_rejected(self, client, cursor):
+        response = client.post(QUERY, json={"query": "flood risk", "cursor": cursor})
+        assert response.status_code == 400
+
+
+class TestQueryBatch:
+    def test_results_per_query_in_order(self, client):
+        queries = ["risk", "flood risk", "flood flood flood risk"]
+        response = client.post(server.ENDPOINT_PREFIX + "/query/batch",
+                               json={"queries": queries, "k": 2, "mode": "vector"})
+        assert response.status_code == 200
+        data = response.json()["data"]
+        assert [entry["query"] for entry in data] == queries
+        for entry in data:
+            single = client.post(QUERY, json={"query": entry["query"], "k": 2, "mode": "vector"}).json()
+            assert entry["data"] == single["data"]
+            assert entry["next_cursor"] == single["next_cursor"]
+
+    def test_empty_batch_is_rejected(self, client):
+        response = client.post(server.ENDPOINT_PREFIX + "/query/batch", json={"queries": []})
+        assert response.status_code == 422
+
+
+@pytest.fixture
+def configuration(tmp_path, monkeypatch):
+    # Startup and shutdown replace the module's services; put them back afterwards
+    for name in ("db", "sync_engine", "pipeline", "loader", "role", "publisher",
+                 "ready", "snapshot_generation", "snapshot_saved"):
+        monkeypatch.setattr(server, name, getattr(server, name))
+    monkeypatch.setattr(httpclient, "_manager", None)
+    monkeypatch.setitem(state.global_state, server.STATE_CONFIG, None)
+    with open("tests/test_data/config.yaml") as file:
+        conf = yaml.safe_load(file)
+    conf["database"]["db_location"] = str(tmp_path / "db")
+    conf["database"]["collection_name"] = f"test-lifecycle-{uuid.uuid4().hex}"
+    conf["registrar"]["checkpoint_path"] = str(tmp_path / "checkpoint.json")
+    conf["multiprocess"]["metrics_dir"] = str(tmp_path / "metrics")
+    conf["snapshot"]["enabled"] = False
+    conf["logging"]["queue"] = False
+    return conf
+
+
+def _stub_registrar(products):
+    httpclient.configure({"retries": 0},
+                         transport=httpx.MockTransport(lambda request: httpx.Response(200, json=products)))
+
+
+def _wait_ready(client):
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        response = client.get(server.ENDPOINT_PREFIX + "/ready")
+        if response.status_code == 200:
+            return response.json()
+        time.sleep(0.05)
+    raise AssertionError("Not ready")
+
+
+class TestLifecycle:
+    @pytest.mark.parametrize("engine", ["chroma", "numpy"])
+    def test_startup_loads_and_shutdown_stops(self, configuration, engine):
+        configuration["database"]["engine"] = engine
+        server._setup(configuration, ROLE_SINGLE)
+        _stub_registrar(_products(3))
+        with TestClient(server.app) as client:
+            assert _wait_ready(client)["documents"] == 3
+            response = client.post(QUERY, json={"query": "flood risk", "k": 5, "mode": "vector"})
+            assert response.status_code == 200
+            assert len(response.json()["data"]) == 3
+
+    def test_reader_of_persisted_numpy_collection(self, configuration):
+        configuration["database"]["engine"] = "numpy"
+        configuration["database"]["persist"] = True
+        server._setup(configuration, ROLE_SINGLE)
+        _stub_registrar(_products(2))
+        with TestClient(server.app) as client:
+            _wait_ready(client)
+
+        server._setup(configuration, ROLE_READER)
+        assert server.db.read_only
+        with TestClient(server.app) as client:
+            response = client.post(QUERY, json={"query": "flood risk", "k": 5, "mode": "vector"})
+            assert response.status_code == 200
+            assert len(response.json()["data"]) == 2
@@ -0,0 +1,82 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+import asyncio
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+class TestSingleFlight:
+    def test_concurrent_calls_share_one_execution(self):
+        flight = SingleFlight("test")
+        calls = []
+
+        async def compute(value):
+            calls.append(value)
+            await asyncio.sleep(0.01)
+            return [{"value": value}]
+
+        async def scenario():
+            return await asyncio.gather(*[flight.do("key", compute, 1) for _ in range(5)])
+
+        results = asyncio.run(scenario())
+        assert calls == [1]
+        assert results == [[{"value": 1}]] * 5
+        # Every caller gets its own copy
+        results[0][0]["value"] = 2
+        assert results[1][0]["value"] == 1
+        stats = flight.stats()
+        assert (stats["executed"], stats["coalesced"], stats["in_flight"]) == (1, 4, 0)
+
+    def test_different_keys_and_later_calls_execute(self):
+        flight = SingleFlight("test")
+        calls = []
+
+        async def compute(value):
+            calls.append(value)
+            await asyncio.sleep(0)
+            return value
+
+        async def scenario():
+            await asyncio.gather(flight.do("a", compute, "a"), flight.do("b", compute, "b"))
+            # Nothing is kept once a flight lands
+            await flight.do("a", compute, "a")
+
+        asyncio.run(scenario())
+        assert sorted(calls) == ["a", "a", "b"]
+
+    def test_exception_is_shared(self):
+        flight = SingleFlight("test")
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise ValueError("boom")
+
+        async def scenario():
+            return await asyncio.gather(*[flight.do("key", fail) for _ in range(3)], return_exceptions=True)
+
+        results = asyncio.run(scenario())
+        assert all(isinstance(result, ValueError) for result in results)
+        assert flight.stats()["executed"] == 1
+
+    def test_cancelled_caller_does_not_cancel_others(self):
+        flight = SingleFlight("test")
+
+        async def compute():
+            await asyncio.sleep(0.02)
+            return "done"
+
+        async def scenario():
+            first = asyncio.ensure_future(flight.do("key", compute))
+            second = asyncio.ensure_future(flight.do("key", compute))
+            await asyncio.sleep(0.005)
+            first.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await first
+            return await second
+
+        assert asyncio.run(scenario()) == "done"
@@ -0,0 +1,46 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+import snapshot
+from searchdb import SearchDb
+from vectorstore import ENGINE_NUMPY
+
+PRODUCTS = [
+    {"uuid": "u1", "name": "Emissions", "description": "carbon emissions by company", "tags": ["ghg"]},
+    {"uuid": "u2", "name": "Rainfall", "description": "daily rainfall totals"}
+]
+
+
+def _db(dimensions=64):
+    return SearchDb("unused", "test", False, {}, embedding={"backend": "hash", "dimensions": dimensions},
+                    engine=ENGINE_NUMPY)
+
+
+class TestSnapshot:
+    def test_save_and_restore(self, tmp_path):
+        path = str(tmp_path / "snapshot.npz")
+        db = _db()
+        db.add_many(PRODUCTS)
+        assert snapshot.save(db, path, watermark=123.0) == 2
+
+        restored = _db()
+        info = snapshot.restore(restored, path)
+        assert info == {"documents": 2, "watermark": 123.0}
+        assert restored.count() == 2
+        assert restored.manifest() == db.manifest()
+        assert restored.search("carbon emissions", mode="vector")[0]["metadata"]["id"] == "u1"
+        assert restored.search("rainfall", mode="lexical")[0]["metadata"]["id"] == "u2"
+
+    def test_missing_snapshot(self, tmp_path):
+        assert snapshot.restore(_db(), str(tmp_path / "missing.npz")) is None
+
+    def test_other_model_ignored(self, tmp_path):
+        path = str(tmp_path / "snapshot.npz")
+        db = _db()
+        db.add_many(PRODUCTS)
+        snapshot.save(db, path)
+        other = _db(dimensions=32)
+        assert snapshot.restore(other, path) is None
+        assert other.count() == 0
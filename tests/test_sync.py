@@ -0,0 +1,81 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+import pytest
+
+from sync import SyncEngine
+from searchdb import SOURCE_API, SOURCE_REGISTRAR, content_hash
+
+
+class _FakeDb():
+    """
+    In-memory stand-in for SearchDb that records writes
+    """
+    def __init__(self):
+        self.documents = {}
+        self.writes = 0
+
+    def add_data(self, _id, name, description, source=SOURCE_API):
+        self.add_many([{"uuid": _id, "name": name, "description": description}], source=source)
+
+    def add_many(self, products, source=SOURCE_API):
+        for product in products:
+            self.writes += 1
+            self.documents[product["uuid"]] = {
+                "id": product["uuid"], "name": product["name"],
+                "hash": content_hash(product), "source": source}
+
+    def manifest(self):
+        return dict(self.documents)
+
+    def delete(self, ids):
+        for _id in ids:
+            del self.documents[_id]
+
+    def count(self):
+        return len(self.documents)
+
+
+def _products():
+    return [
+        {"uuid": "u1", "name": "name1", "description": "description1"},
+        {"uuid": "u2", "name": "name2", "description": "description2"},
+    ]
+
+
+class TestSyncEngine:
+    def test_initial_sync_adds_all(self):
+        db = _FakeDb()
+        stats = SyncEngine(db).sync(_products())
+        assert stats["added"] == 2
+        assert stats["total"] == 2
+
+    def test_steady_state_sync_does_no_writes(self):
+        db = _FakeDb()
+        engine = SyncEngine(db)
+        engine.sync(_products())
+        db.writes = 0
+        stats = engine.sync(_products())
+        assert db.writes == 0
+        assert stats["unchanged"] == 2
+        assert stats["total"] == 2
+
+    def test_changed_and_removed_products(self):
+        db = _FakeDb()
+        engine = SyncEngine(db)
+        engine.sync(_products())
+        products = [{"uuid": "u1", "name": "name1", "description": "changed"}]
+        stats = engine.sync(products)
+        assert stats["updated"] == 1
+        assert stats["deleted"] == 1
+        assert sorted(db.documents) == ["u1"]
+
+    def test_api_products_survive_sync(self):
+        db = _FakeDb()
+        db.add_data("api1", "name", "description")
+        stats = SyncEngine(db).sync(_products())
+        assert stats["deleted"] == 0
+        assert "api1" in db.documents
+        assert db.documents["u1"]["source"] == SOURCE_REGISTRAR
@@ -0,0 +1,123 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+import asyncio
+import contextvars
+import uuid
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+
+import httpclient
+import server
+import tracing
+from searchdb import SearchDb
+from workerpool import WorkerPool
+
+_request_id = contextvars.ContextVar("request_id", default=None)
+
+
+@pytest.fixture
+def exporter(monkeypatch):
+    # Record spans in memory (without touching the global tracer provider)
+    exporter = InMemorySpanExporter()
+    provider = TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+    monkeypatch.setattr(tracing, "_tracer", provider.get_tracer(__name__))
+    monkeypatch.setattr(tracing, "_enabled", True)
+    yield exporter
+    provider.shutdown()
+
+
+@pytest.fixture
+def outbound(monkeypatch):
+    # Answer artifact lookups locally, keeping the headers they were sent with
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(200, json=[{"name": "artifact"}])
+
+    monkeypatch.setattr(httpclient, "_manager", None)
+    httpclient.configure({"retries": 0}, transport=httpx.MockTransport(handler))
+    yield requests
+
+
+@pytest.fixture
+def client(monkeypatch):
+    db = SearchDb("test", f"test-tracing-{uuid.uuid4().hex}", False, {}, embedding={"backend": "hash"})
+    db.add_many([{"uuid": f"p{index}", "name": f"name{index}", "description": "flood " * (index + 1) + "risk"}
+                 for index in range(3)])
+    monkeypatch.setattr(server, "db", db)
+    yield TestClient(server.app)
+
+
+def _ancestors(span, spans):
+    by_id = {other.context.span_id: other for other in spans}
+    names = []
+    while span.parent is not None and span.parent.span_id in by_id:
+        span = by_id[span.parent.span_id]
+        names.append(span.name)
+    return names
+
+
+class TestTracing:
+    def test_disabled_by_default(self):
+        assert tracing.setup({"enabled": False}) is False
+        assert not tracing.enabled()
+
+    def test_noop_span(self):
+        with tracing.span("test", headers={}, kind=tracing.KIND_SERVER, attribute=1) as current:
+            current.set_attribute("key", "value")
+            current.update_name("renamed")
+        with tracing.correlation("abc"):
+            assert tracing.correlation_id() is None
+        assert tracing.inject({"a": "b"}) == {"a": "b"}
+
+    def test_context_reaches_pool_threads(self):
+        pool = WorkerPool("test", workers=1, queue_depth=1)
+
+        async def scenario():
+            _request_id.set("abc")
+            return await pool.run(_request_id.get)
+
+        assert asyncio.run(scenario()) == "abc"
+
+
+class TestTracingEnabled:
+    def test_search_spans_nest_under_request(self, exporter, client):
+        response = client.post(server.ENDPOINT_PREFIX + "/query", json={"query": "flood risk", "mode": "vector"})
+        assert response.status_code == 200
+        spans = exporter.get_finished_spans()
+        request = [span for span in spans if span.name == "POST " + server.ENDPOINT_PREFIX + "/query"]
+        assert len(request) == 1
+        # Loading the fixture's products also embeds, outside of any request
+        spans = [span for span in spans if span.context.trace_id == request[0].context.trace_id]
+        for name in ("embed", "ann"):
+            [child] = [span for span in spans if span.name == name]
+            assert request[0].name in _ancestors(child, spans)
+
+    def test_artifact_enrichment_propagates_context(self, exporter, outbound, client):
+        response = client.post(server.ENDPOINT_PREFIX + "/query/artifacts",
+                               json={"query": "flood risk", "k": 2, "mode": "vector"})
+        assert response.status_code == 200
+        assert all(hit["artifact"] == [{"name": "artifact"}] for hit in response.json()["data"])
+        spans = exporter.get_finished_spans()
+        [request] = [span for span in spans if span.name == "POST " + server.ENDPOINT_PREFIX + "/query/artifacts"]
+        [enrich] = [span for span in spans if span.name == "enrich"]
+        assert request.name in _ancestors(enrich, spans)
+        calls = [span for span in spans if span.name == "HTTP GET"]
+        assert len(calls) == len(outbound) == 2
+        for call in calls:
+            assert _ancestors(call, spans)[0] == "enrich"
+        # Each outbound call carries its own span as the W3C parent
+        parents = {sent.headers["traceparent"].split("-")[2] for sent in outbound}
+        assert parents == {format(call.context.span_id, "016x") for call in calls}
+        assert all(sent.headers["traceparent"].split("-")[1] == format(enrich.context.trace_id, "032x")
+                   for sent in outbound)
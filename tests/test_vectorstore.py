@@ -0,0 +1,124 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+import os
+
+import numpy as np
+import pytest
+
+from vectorstore import NumpyCollection, INDEX_IVF, PQ_MIN_VECTORS
+
+
+def _vectors(count, dimensions=16, seed=1):
+    return np.random.default_rng(seed).normal(size=(count, dimensions)).astype(np.float32)
+
+
+def _collection(count=50, **kwargs):
+    collection = NumpyCollection("test", **kwargs)
+    vectors = _vectors(count)
+    collection.upsert(ids=[f"id{i}" for i in range(count)], embeddings=vectors,
+                      metadatas=[{"name": f"n{i}", "even": i % 2 == 0} for i in range(count)],
+                      documents=[f"doc{i}" for i in range(count)])
+    return collection, vectors
+
+
+class TestNumpyCollection:
+    def test_query_exact(self):
+        collection, vectors = _collection()
+        results = collection.query(query_embeddings=vectors[[3, 7]], n_results=3)
+        assert results["ids"][0][0] == "id3"
+        assert results["ids"][1][0] == "id7"
+        assert results["distances"][0][0] == pytest.approx(0.0, abs=1e-5)
+        assert results["distances"][0] == sorted(results["distances"][0])
+        assert results["documents"][0][0] == "doc3"
+
+    def test_query_where(self):
+        collection, vectors = _collection()
+        results = collection.query(query_embeddings=vectors[[3]], n_results=100, where={"even": True})
+        assert len(results["ids"][0]) == 25
+        assert all(metadata["even"] for metadata in results["metadatas"][0])
+
+    def test_upsert_replaces_and_delete(self):
+        collection, vectors = _collection()
+        collection.upsert(ids=["id0"], embeddings=vectors[[5]], metadatas=[{"name": "x"}], documents=["new"])
+        assert collection.count() == 50
+        collection.delete(["id1", "id49", "missing"])
+        assert collection.count() == 48
+        results = collection.query(query_embeddings=vectors[[5]], n_results=2)
+        assert set(results["ids"][0]) == {"id0", "id5"}
+        assert collection.get(ids=["id0"])["documents"] == ["new"]
+
+    def test_ivf(self):
+        collection, vectors = _collection(count=400, index=INDEX_IVF, nlist=4, nprobe=4)
+        # Probing every list is exact
+        results = collection.query(query_embeddings=vectors[[10]], n_results=5)
+        assert results["ids"][0][0] == "id10"
+        assert collection.stats()["ivf_trained"]
+
+    def test_save_and_mmap(self, tmp_path):
+        path = str(tmp_path / "test")
+        collection, vectors = _collection(path=path)
+        collection.save()
+        loaded = NumpyCollection("test", path=path, mmap=True)
+        assert loaded.count() == 50
+        assert loaded.stats()["mmap"]
+        assert loaded.query(query_embeddings=vectors[[3]], n_results=1)["ids"] == [["id3"]]
+        # Writes copy the mapped matrix into a mapped working file
+        loaded.delete(["id3"])
+        assert loaded.stats()["mmap"]
+        assert loaded.stats()["resident_bytes"] == 0
+        assert loaded.count() == 49
+        assert loaded.query(query_embeddings=vectors[[4]], n_results=1)["ids"] == [["id4"]]
+        # The working file is unlinked, only the saved files remain
+        assert sorted(os.listdir(tmp_path)) == ["test.json", "test.npy"]
+
+
+class TestQuantization:
+    @pytest.mark.parametrize("quantization", ["float16", "int8"])
+    def test_scalar_quantization(self, quantization):
+        collection, vectors = _collection(200, quantization=quantization)
+        results = collection.query(query_embeddings=vectors[[3]], n_results=5)
+        assert results["ids"][0][0] == "id3"
+        # Distances are re-scored at full precision
+        assert results["distances"][0][0] == pytest.approx(0.0, abs=1e-5)
+        assert collection.recall(k=5) == pytest.approx(1.0)
+
+        # Only the codes are resident, the full precision matrix is mapped
+        stats = collection.stats()
+        assert stats["mmap"]
+        assert stats["full_bytes_per_product"] == 16 * 4
+        assert stats["bytes_per_product"] == (16 * 2 if quantization == "float16" else 16 + 4)
+        assert stats["resident_bytes"] == stats["code_bytes"]
+
+        # Codes follow writes
+        collection.delete(["id0", "id1"])
+        collection.upsert(ids=["id3"], embeddings=vectors[[9]])
+        assert set(collection.query(query_embeddings=vectors[[9]], n_results=2)["ids"][0]) == {"id3", "id9"}
+        assert collection.recall(k=5) == pytest.approx(1.0)
+
+    def test_product_quantization(self):
+        count = PQ_MIN_VECTORS + 100
+        collection, vectors = _collection(count, quantization="pq", pq_subvectors=4, rescore=10)
+        # Exact search on the mapped matrix until trained
+        assert collection.stats()["bytes_per_product"] == 0
+        results = collection.query(query_embeddings=vectors[[3]], n_results=3)
+        assert results["ids"][0][0] == "id3"
+
+        stats = collection.stats()
+        assert stats["pq_trained"]
+        assert stats["bytes_per_product"] == 4
+        assert collection.recall(k=10) > 0.5
+
+    def test_quantized_reload(self, tmp_path):
+        path = str(tmp_path / "vectors")
+        collection, vectors = _collection(100, path=path, quantization="int8")
+        collection.save()
+        loaded = NumpyCollection("test", path=path, mmap=True, quantization="int8")
+        assert loaded.query(query_embeddings=vectors[[5]], n_results=1)["ids"][0] == ["id5"]
+        assert loaded.stats()["code_bytes"] > 0
+
+    def test_unknown_quantization(self):
+        with pytest.raises(ValueError):
+            NumpyCollection("test", quantization="int4")
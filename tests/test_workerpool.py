@@ -0,0 +1,48 @@
+# Copyright 2024 Broda Group Software Inc.
+#
+# Use of this source code is governed by an MIT-style
+# license that can be found in the LICENSE file or at
+# https://opensource.org/licenses/MIT.
+import asyncio
+import threading
+import pytest
+
+from workerpool import WorkerPool
+from bgsexception import BgsBusyException
+
+
+class TestWorkerPool:
+    def test_run(self):
+        pool = WorkerPool("test", workers=2, queue_depth=2)
+        result = asyncio.run(pool.run(lambda a, b=0: a + b, 1, b=2))
+        assert result == 3
+        assert pool.stats()["pending"] == 0
+
+    def test_rejects_when_full(self):
+        pool = WorkerPool("test", workers=1, queue_depth=0)
+        release = threading.Event()
+
+        async def scenario():
+            blocked = asyncio.ensure_future(pool.run(release.wait))
+            await asyncio.sleep(0)
+            with pytest.raises(BgsBusyException):
+                await pool.run(lambda: None)
+            release.set()
+            await blocked
+
+        asyncio.run(scenario())
+        assert pool.stats()["rejected"] == 1
+
+    def test_event_loop_not_blocked(self):
+        pool = WorkerPool("test", workers=1, queue_depth=1)
+        release = threading.Event()
+
+        async def scenario():
+            blocked = asyncio.ensure_future(pool.run(release.wait))
+            # The loop keeps serving other work while the call blocks
+            await asyncio.sleep(0.01)
+            assert not blocked.done()
+            release.set()
+            await blocked
+
+        asyncio.run(scenario())